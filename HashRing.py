@@ -1,3 +1,4 @@
+import bisect
 import hashlib
 __author__ = 'http://amix.dk/blog/post/19367'
 
@@ -5,10 +6,27 @@ class Server():
     """ Conveience class that holds a host and a port
         and provides a method for getting them as a tuple
         for binding.
+        `weight` is the relative capacity of the server, a server
+        with weight 2 gets twice as many points on the ring.
     """
-    def __init__(self,host,port):
+    def __init__(self,host,port,weight=1):
         self.host = host
         self.port = int(port)
+        self.weight = float(weight)
+
+    @staticmethod
+    def fromstring(string):
+        """ Create a `Server` from `host`:`port` or `host`:`port`:`weight`
+        """
+        return Server(*string.split(":"))
+
+    def tostring(self):
+        """ Returns `host`:`port`, followed by :`weight` if
+            weight is not 1. This is the format used in the ring string.
+        """
+        if self.weight == 1:
+            return str(self)
+        return "%s:%g" % (self, self.weight)
 
     def __str__(self):
         """ Returns `host`:`port`
@@ -34,12 +52,13 @@ class Server():
         return self.host,self.port
 
 class HashRing(object):
-    def __init__(self, nodes=None, replicas=3, distribution_points=3):
+    def __init__(self, nodes=None, replicas=3, distribution_points=160):
         """Manages a hash ring.
 
         `nodes` is a list of objects that have a proper __str__ representation.
         `distribution_points` indicates how many virtual points should be used pr. node,
         distribution_points are required to improve the distribution.
+        A node gets `distribution_points` * `weight` points.
 
         I, Johan, Borrowed this code from:
         http://amix.dk/blog/post/19367
@@ -50,6 +69,21 @@ class HashRing(object):
 
         self.ring = dict()
         self._sorted_keys = []
+        # str(server) -> server for every node in the ring
+        self._nodes = dict()
+        # Sorted list of nodes, rebuilt on demand after membership changes
+        self._nodelist = None
+        # (tokens, replica sets) snapshot used by get_replicas, rebuilt on demand
+        self._lookup_table = None
+        # Incremented on every membership change
+        self.version = 0
+        # The highest epoch of the ring changes that have been seen,
+        # it is the same on all nodes that have seen the same changes
+        self.epoch = 0
+        # str(node) -> (epoch, origin, node, present) of the last change of every node
+        self.events = dict()
+        # (version, digest) of the last call to digest
+        self._digest = None
 
         if nodes:
             for node in nodes:
@@ -58,32 +92,151 @@ class HashRing(object):
     def __str__(self):
         return " ".join(map(lambda server: str(server),self.get_nodelist()))
 
+    @staticmethod
+    def fromstring(string):
+        """ Create a `HashRing` from a string created by `tostring`
+            Rings from servers that don't send the distribution points
+            use the old default of 3.
+        """
+        ring = string.split(",")
+        nodes, replicas = ring[0], ring[1]
+        distribution_points = len(ring) > 2 and ring[2] or 3
+        nodes = map(Server.fromstring,filter(None,nodes.split("|")))
+        hash_ring = HashRing(nodes,int(replicas),int(distribution_points))
+        if len(ring) > 3:
+            hash_ring.epoch = int(ring[3])
+        return hash_ring
+
+    def tostring(self):
+        """ Returns a |-separated list of the nodes
+            ","  the number of replicas
+            ","  the number of distribution points per server
+            ","  the epoch.
+            Servers with a weight other than 1 are written as host:port:weight.
+            Example:
+            localhost:50140|localhost:50141:2,3,160,2
+        """
+        return self.membership() + "," + str(self.epoch)
+
+    def membership(self):
+        """ Returns the nodes, replicas and distribution points
+            as in `tostring`, but without the epoch
+        """
+        nodes = "|".join(map(lambda server: server.tostring(),self.get_nodelist()))
+        return nodes + "," + str(self.replicas) + "," + str(self.distribution_points)
+
+    def digest(self):
+        """ Returns a 32 bit hash of the membership of the ring,
+            rings with the same nodes have the same digest.
+        """
+        cached = self._digest
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+        digest = int(hashlib.md5(self.membership()).hexdigest()[:8], 16)
+        self._digest = (self.version, digest)
+        return digest
+
+    def change(self, node, present, origin):
+        """ Add (if `present`) or remove `node` with a new event in the
+            next epoch, `origin` is the server that made the change.
+            Returns the event.
+        """
+        if not isinstance(node,Server):
+            node = Server.fromstring(node)
+        event = (self.epoch + 1, str(origin), node, present)
+        self.apply(event)
+        return event
+
+    def apply(self, event):
+        """ Apply a change `event` from `change` unless the node has a
+            newer event (compared by epoch and origin), so nodes that
+            apply the same events in any order get the same ring.
+            Returns True if the nodes of the ring changed.
+        """
+        epoch, origin, node, present = event
+        self.epoch = max(self.epoch, epoch)
+        last = self.events.get(str(node))
+        if last is not None and last[:2] >= (epoch, origin):
+            return False
+        self.events[str(node)] = event
+        current = self._nodes.get(str(node))
+        if present:
+            if current is not None and current.weight == node.weight:
+                return False
+            self.add_node(node)
+            return True
+        if current is None:
+            return False
+        self.remove_node(node)
+        return True
+
+    def get_events(self, since=0):
+        """ Returns the events of the nodes that changed in epoch `since` or later
+        """
+        return [event for event in self.events.values() if event[0] >= since]
+
+    @staticmethod
+    def pack_events(events):
+        """ Returns `events` as lines of epoch, origin, node and + or -
+        """
+        return "\n".join("%d %s %s %s" % (epoch, origin, node.tostring(), present and "+" or "-")
+                         for epoch, origin, node, present in events)
+
+    @staticmethod
+    def unpack_events(data):
+        """ Returns the events in a string created by `pack_events`
+        """
+        events = []
+        for line in filter(None,data.split("\n")):
+            epoch, origin, node, present = line.split(" ")
+            events.append((int(epoch), origin, Server.fromstring(node), present == "+"))
+        return events
+
     def add_node(self, node):
         """Adds a `node` to the hash ring (including a number of replicas).
            If node is not already a `Server` it will become one.
         """
         if not isinstance(node,Server):
-            host, port = node.split(":")
-            node = Server(host,port)
+            node = Server.fromstring(node)
 
-        for i in xrange(0, self.distribution_points):
+        # Remove the node first if it has been re-added with another weight
+        if str(node) in self._nodes:
+            self.remove_node(node)
+
+        for i in xrange(0, self.get_points(node)):
             key = self.gen_key('%s:%s' % (node, i))
+            if key not in self.ring:
+                bisect.insort(self._sorted_keys, key)
             self.ring[key] = node
-            if key not in self._sorted_keys:
-                self._sorted_keys.append(key)
 
-        self._sorted_keys.sort()
+        self._nodes[str(node)] = node
+        self._nodelist = None
+        self._lookup_table = None
+        self.version += 1
 
     def remove_node(self, node):
         """Removes `node` from the hash ring and its replicas.
         """
-        for i in xrange(0, self.distribution_points):
+        if not isinstance(node,Server):
+            node = Server.fromstring(node)
+        # Use the weight the node was added with
+        node = self._nodes.get(str(node), node)
+
+        for i in xrange(0, self.get_points(node)):
             key = self.gen_key('%s:%s' % (node, i))
             if self.ring.has_key(key):
                 del self.ring[key]
-            if key in self._sorted_keys:
-                self._sorted_keys.remove(key)
+                del self._sorted_keys[bisect.bisect_left(self._sorted_keys, key)]
 
+        if self._nodes.pop(str(node), None) is not None:
+            self._nodelist = None
+        self._lookup_table = None
+        self.version += 1
+
+    def get_points(self, node):
+        """ Returns the number of points `node` has on the ring
+        """
+        return max(1, int(round(self.distribution_points * node.weight)))
 
     def get_node(self, string_key):
         """Given a string key a corresponding node in the hash ring is returned.
@@ -103,42 +256,77 @@ class HashRing(object):
 
         key = self.gen_key(string_key)
 
+        # First token that is >= key, wrapping around to the start of the ring
         nodes = self._sorted_keys
-        for i in xrange(0, len(nodes)):
-            node = nodes[i]
-            if key <= node:
-                return self.ring[node], i
-
-        return self.ring[nodes[0]], 0
+        pos = bisect.bisect_left(nodes, key)
+        if pos == len(nodes):
+            pos = 0
+        return self.ring[nodes[pos]], pos
 
     def get_replicas(self, string_key, exclude_server=None):
         """ Given a `string_key` return the replica nodes that can hold the key
             `exclude_server` will be removed from the list before return.
-            The replica nodes is just 3 consecutive nodes at the moment
+            The replica nodes are the first distinct nodes found walking
+            the ring clockwise from the key, they are looked up by bisection
+            in the precomputed replica table.
         """
 
         # Return empty list if empty ring
         if not self.ring:
             return []
 
-        nodelist = []
-
-        active_replicas = self.replicas
-        number_of_servers = len(self.ring) / self.distribution_points
-        if number_of_servers < self.replicas:
-            active_replicas = number_of_servers
-
-        for key in self.get_nodes(string_key):
-            if key not in nodelist:
-                nodelist.append(key)
-            if len(nodelist) == active_replicas:
-                break
-
+        nodelist = list(self.get_token_replicas(self.gen_key(string_key)))
         if exclude_server in nodelist:
             nodelist.remove(exclude_server)
 
         return nodelist
 
+    def get_token_replicas(self, token):
+        """ Returns the tuple of replica nodes for keys that hash to `token`
+        """
+        if not self.ring:
+            return ()
+
+        tokens, replica_sets = self.get_lookup_table()
+        pos = bisect.bisect_left(tokens, token)
+        if pos == len(tokens):
+            pos = 0
+        return replica_sets[pos]
+
+    def get_lookup_table(self):
+        """ Returns a (`tokens`, `replica_sets`) tuple where `tokens` is a
+            sorted snapshot of the ring and `replica_sets[i]` is the tuple of
+            replica nodes for keys that hash into the range ending at `tokens[i]`.
+            The table is rebuilt after the ring has changed, lookups in between
+            only need a bisection.
+        """
+        table = self._lookup_table
+        if table is None:
+            table = self._build_lookup_table()
+            self._lookup_table = table
+        return table
+
+    def _build_lookup_table(self):
+        """ Walk the ring once from every token and record the first
+            `replicas` distinct nodes found.
+        """
+        tokens = list(self._sorted_keys)
+        nodes = [self.ring[token] for token in tokens]
+        active_replicas = min(self.replicas, self.number_of_nodes())
+
+        replica_sets = []
+        for i in xrange(0, len(tokens)):
+            replica_set = []
+            j = i
+            while len(replica_set) < active_replicas:
+                node = nodes[j % len(nodes)]
+                if node not in replica_set:
+                    replica_set.append(node)
+                j += 1
+            replica_sets.append(tuple(replica_set))
+
+        return tokens, replica_sets
+
     def get_nodes(self, string_key):
         """Given a string key it returns the nodes as a generator that can hold the key.
 
@@ -156,19 +344,39 @@ class HashRing(object):
             for key in self._sorted_keys:
                 yield self.ring[key]
 
-    def get_nodelist(self):
-        """ Return a unique sorted list of nodes
+    def has_node(self, node):
+        """ Returns True if `node` is in the ring
         """
-        if not self.ring:
-            return []
+        return str(node) in self._nodes
 
-        nodelist = []
-        for key in self._sorted_keys:
-            if self.ring[key] not in nodelist:
-                nodelist.append(self.ring[key])
+    def copy(self):
+        """ Returns a copy of the ring that isn't affected by later
+            membership changes of this ring.
+        """
+        ring = HashRing(None, self.replicas, self.distribution_points)
+        ring.ring = dict(self.ring)
+        ring._sorted_keys = list(self._sorted_keys)
+        ring._nodes = dict(self._nodes)
+        # The lookup table is never changed, only replaced
+        ring._lookup_table = self._lookup_table
+        ring.version = self.version
+        ring.epoch = self.epoch
+        ring.events = dict(self.events)
+        return ring
 
-        nodelist.sort()
-        return nodelist
+    def get_nodelist(self):
+        """ Return a unique sorted list of nodes
+        """
+        nodelist = self._nodelist
+        if nodelist is None:
+            nodelist = sorted(self._nodes.values(), key=str)
+            self._nodelist = nodelist
+        return list(nodelist)
+
+    def number_of_nodes(self):
+        """ Return the number of unique nodes in the ring
+        """
+        return len(self._nodes)
 
 
     def gen_key(self, key):
@@ -177,4 +385,40 @@ class HashRing(object):
         """
         m = hashlib.md5()
         m.update(key)
-        return long(m.hexdigest(), 16)
\ No newline at end of file
+        return long(m.hexdigest(), 16)
+
+class RingDiff():
+    """ The ranges of the ring where the replica set differs between
+        `old_ring` and `new_ring`, ie the ranges that change owner when
+        a node joins or leaves.
+
+        The tokens of both rings split the ring into ranges where the keys
+        have the same replicas in both rings, so it is enough to compare
+        the replicas once per range.
+    """
+    def __init__(self, old_ring, new_ring):
+        self.hash_ring = new_ring
+        # Sorted end tokens of all ranges, a range starts after the previous end
+        self._ends = sorted(set(old_ring._sorted_keys) | set(new_ring._sorted_keys))
+        # range -> (old replicas, new replicas) or None if they are the same
+        self._changes = []
+        for token in self._ends:
+            old = old_ring.get_token_replicas(token)
+            new = new_ring.get_token_replicas(token)
+            self._changes.append(old != new and (old, new) or None)
+
+    def __len__(self):
+        """ Returns the number of ranges that have changed
+        """
+        return len(self._changes) - self._changes.count(None)
+
+    def get_change(self, string_key):
+        """ Returns (old replicas, new replicas) for `string_key` or
+            None if the replicas of the key haven't changed.
+        """
+        if not self._ends:
+            return None
+        pos = bisect.bisect_left(self._ends, self.hash_ring.gen_key(string_key))
+        if pos == len(self._ends):
+            pos = 0
+        return self._changes[pos]
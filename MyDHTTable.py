@@ -3,6 +3,8 @@ import threading
 import urllib
 from HashRing import HashRing
 from dhtcommand import DHTCommand
+from merkletree import MerkleTree
+from storage import MemoryStorage
 
 __author__ = 'Johan'
 
@@ -10,31 +12,162 @@ class MyDHTTable():
     """ Represents the hash table
         This is really just a dictionary with some convenience methods.
         Most of it is used to render a html-page for debugging purposes.
+        The keys and values are kept in `storage`, in memory by default.
+
+        Writes lock one of `stripes` locks chosen by the hash of the key,
+        so writes of different keys rarely wait for each other. Reads
+        don't lock, the storage returns whole values. Commands that go
+        through all keys work on a snapshot of the keys and only lock
+        one key at a time.
     """
-    def __init__(self,server_name,hash_ring):
-        self._map = {}
-        self._timemap = {}
+    def __init__(self,server_name,hash_ring,storage=None,stripes=64):
+        if storage is None:
+            storage = MemoryStorage()
+        self.storage = storage
         self.hash_ring = hash_ring
         self.server_name = server_name
-        self._lock = threading.RLock()
+        self._locks = [threading.RLock() for i in xrange(stripes)]
+        # str(server) -> MerkleTree of the keys in this map that server
+        # is a replica for, rebuilt when the ring has changed
+        self._trees = {}
+        self._trees_version = None
+        # Protects the trees
+        self._trees_lock = threading.RLock()
+        # Only one rebuild of the trees at a time
+        self._build_lock = threading.Lock()
+        # Keys that have been changed during a rebuild, None if there is no rebuild
+        self._changed = None
 
     def __str__(self):
         """ Returns a string representation of the map
         """
         values = []
-        for key in self._map.keys():
-            values.append(key + ": " + self._map[key])
+        for key in self.storage.keys():
+            value = self.storage.get(key)
+            if value is not None:
+                values.append(key + ": " + value)
         return "\n".join(values)
 
+    def get_lock(self,key):
+        """ Returns the lock for `key`
+        """
+        return self._locks[hash(key) % len(self._locks)]
+
     def get_keys(self):
-        """ Returns all keys currently in the map
-            Lock first, just in case
+        """ Returns a snapshot of all keys currently in the map
         """
-        self._lock.acquire()
-        keys = self._map.keys()
-        self._lock.release()
-        return keys
+        return self.storage.keys()
     
+    def build_trees(self):
+        """ Build the hash trees from all keys in the map if the ring has
+            changed since they were built.
+            The trees are built without blocking writes, keys that are
+            written meanwhile are updated in the new trees at the end.
+        """
+        self._build_lock.acquire()
+        try:
+            self._trees_lock.acquire()
+            version = self.hash_ring.version
+            if self._trees_version == version:
+                self._trees_lock.release()
+                return
+            self._changed = set()
+            self._trees_lock.release()
+
+            trees = {}
+            for key in self.storage.keys():
+                self.add_to_trees(trees,key)
+
+            self._trees_lock.acquire()
+            for key in self._changed:
+                for tree in trees.itervalues():
+                    tree.remove(key)
+                self.add_to_trees(trees,key)
+            self._trees = trees
+            self._trees_version = version
+            self._changed = None
+            self._trees_lock.release()
+        finally:
+            self._build_lock.release()
+
+    def add_to_trees(self,trees,key):
+        """ Add `key` to the trees of its replicas in `trees`
+            if it is in the map
+        """
+        timestamp = self.storage.get_timestamp(key)
+        if timestamp is None:
+            return
+        for server in self.hash_ring.get_replicas(key,self.server_name):
+            if str(server) not in trees:
+                trees[str(server)] = MerkleTree()
+            trees[str(server)].update(key,timestamp)
+
+    def update_trees(self,key):
+        """ Add or update `key` in the trees of its replicas
+            Must be called with the lock of the key held.
+        """
+        self._trees_lock.acquire()
+        try:
+            if self._changed is not None:
+                # Updated at the end of the rebuild
+                self._changed.add(key)
+            if self._trees_version != self.hash_ring.version:
+                # Rebuilt with the new key the next time they are used
+                return
+            self.add_to_trees(self._trees,key)
+        finally:
+            self._trees_lock.release()
+
+    def remove_from_trees(self,key):
+        """ Remove `key` from the trees of its replicas
+            Must be called with the lock of the key held.
+        """
+        self._trees_lock.acquire()
+        try:
+            if self._changed is not None:
+                self._changed.add(key)
+            if self._trees_version != self.hash_ring.version:
+                return
+            for server in self.hash_ring.get_replicas(key,self.server_name):
+                if str(server) in self._trees:
+                    self._trees[str(server)].remove(key)
+        finally:
+            self._trees_lock.release()
+
+    def get_tree(self,server):
+        """ Returns the hash tree of the keys `server` is a replica for
+        """
+        self.build_trees()
+        self._trees_lock.acquire()
+        try:
+            return self._trees.get(str(server)) or MerkleTree()
+        finally:
+            self._trees_lock.release()
+
+    def get_tree_hashes(self,server,nodes):
+        """ Returns the hashes of `nodes` in the hash tree for `server`
+        """
+        tree = self.get_tree(server)
+        self._trees_lock.acquire()
+        try:
+            return map(tree.hash,nodes)
+        finally:
+            self._trees_lock.release()
+
+    def get_tree_items(self,server,leaves):
+        """ Returns a list of (key, timestamp) in `leaves`
+            of the hash tree for `server`
+        """
+        tree = self.get_tree(server)
+        self._trees_lock.acquire()
+        try:
+            items = []
+            for leaf in leaves:
+                items.extend(tree.items(leaf))
+            return items
+        finally:
+            self._trees_lock.release()
+
     def getsizewithsuffix(self,size):
         """ Adds a suffix to `size` and returns
             "`size` suffix"
@@ -55,21 +188,31 @@ class MyDHTTable():
         webpage = StringIO()
         webpage.write("<html>\n<head><title>DHT status page for " + str(self.server_name) + "</title>\n")
         webpage.write("</head>\n<body>\nDHT status page for " + str(self.server_name) + "<br />")
-        webpage.write("key count: " + str(len(self._map)) + "</br>")
+        webpage.write("key count: " + str(len(self.storage)) + "</br>")
         webpage.write("Ring is:<br />")
         for server in self.hash_ring.get_nodelist():
-            webpage.write("<a href=http://"+str(server) + ">" + str(server) + "</a><br />")
+            webpage.write("<a href=http://"+str(server) + ">" + str(server) + "</a>")
+            webpage.write(" (weight: %g, points: %d)<br />" % (server.weight, self.hash_ring.get_points(server)))
         webpage.write("</br>")
-        webpage.write("Number of replicas: " + str(self.hash_ring.replicas) + "<br /><br />")
+        webpage.write("Number of replicas: " + str(self.hash_ring.replicas) + "<br />")
+        webpage.write("Distribution points: " + str(self.hash_ring.distribution_points) + "<br /><br />")
+        if hasattr(self.storage,"get_stats"):
+            for name, value in self.storage.get_stats():
+                webpage.write(name + ": " + str(value) + "<br />")
+            webpage.write("<br />")
 
         webpage.write("<table border=\"1\">\n<tr>\n<td>key</td>\n<td>size</td>\n<td>time</td>\n<td>hash</td>\n<td>replicas</td></tr>\n")
         size = 0
-        for key in self._map.keys():
+        for key in self.storage.keys():
+            keysize = self.storage.get_size(key)
+            if keysize is None:
+                # Deleted since the snapshot of the keys was taken
+                continue
             webpage.write("<tr>\n")
             webpage.write("<td><a href=/"+ urllib.quote(key) + ">" + key + "</a></td>")
-            size += len(self._map[key])
-            webpage.write("<td>" + self.getsizewithsuffix(len(self._map[key])) + "</td>")
-            webpage.write("<td>" + str(self._timemap.get(key)) + "</td>")
+            size += keysize
+            webpage.write("<td>" + self.getsizewithsuffix(keysize) + "</td>")
+            webpage.write("<td>" + str(self.storage.get_timestamp(key)) + "</td>")
             webpage.write("<td>" + str(HashRing().gen_key(key)) + "</td>")
             webpage.write("<td>")
             for server in self.hash_ring.get_replicas(key):
@@ -85,33 +228,52 @@ class MyDHTTable():
         """ Perform `command` on this map
             return BAD_COMMAND if the command is invalid
         """
-        self._lock.acquire()
+        # Sequence number of a write that must be committed
+        sequence = None
         
         if command.action == DHTCommand.PUT:
             """ Put key and value in map """
-            self._map[command.key] = command.value
-            self._timemap[command.key] = command.timestamp
+            lock = self.get_lock(command.key)
+            lock.acquire()
+            try:
+                # A forwarded PUT (a repair, a transfer or a hint) doesn't replace a newer value
+                current = self.storage.get_timestamp(command.key)
+                if not command.forwarded or current is None or current <= command.timestamp:
+                    sequence = self.storage.put(command.key,command.value,command.timestamp)
+                    self.update_trees(command.key)
+            finally:
+                lock.release()
             status = "PUT OK "+command.key
 
         elif command.action == DHTCommand.GET or command.action == DHTCommand.HTTPGETKEY:
             """ Get value from map if key exists """
-            if command.key in self._map:
-                status = self._map[command.key]
-            else:
+            status = self.storage.get(command.key)
+            if status is None:
                 status = "ERR_VALUE_NOT_FOUND"
 
         elif command.action == DHTCommand.DEL:
             """ Delete key from map if it exists """
-            if command.key in self._map:
-                del self._map[command.key]
-                status = "DEL OK "+command.key
-            else:
-                status = "ERR_VALUE_NOT_FOUND"
+            lock = self.get_lock(command.key)
+            lock.acquire()
+            try:
+                # A forwarded DEL (a hint) doesn't delete a newer value
+                current = self.storage.get_timestamp(command.key)
+                if command.forwarded and current is not None and current > command.timestamp:
+                    status = "DEL OK "+command.key
+                else:
+                    sequence = self.delete(command.key)
+                    if sequence is not None:
+                        status = "DEL OK "+command.key
+                    else:
+                        status = "ERR_VALUE_NOT_FOUND"
+            finally:
+                lock.release()
 
         elif command.action == DHTCommand.HASKEY:
             """ Return the timestamp if key is found, else 0.0 (epoch) """
-            if command.key in self._timemap and command.key in self._map:
-                status = str(self._timemap.get(command.key))
+            timestamp = self.storage.get_timestamp(command.key)
+            if timestamp is not None:
+                status = repr(timestamp)
             else: status = "0.0"
 
         elif command.action == DHTCommand.HTTPGET:
@@ -120,12 +282,51 @@ class MyDHTTable():
 
         elif command.action == DHTCommand.PURGE:
             """ Remove all keys in this map that don't belong here """
-            for key in self._map.keys():
+            for key in self.storage.keys():
                 if self.server_name not in self.hash_ring.get_replicas(key):
-                    del self._map[key]
+                    sequence = self.delete(key) or sequence
             status = "PURGE ok"
         else:
             status = "BAD_COMMAND: "+str(command)
 
-        self._lock.release()
-        return status
\ No newline at end of file
+        # Wait for the write to be on disk without blocking other commands
+        self.storage.commit(sequence)
+        return status
+
+    def delete(self,key):
+        """ Delete `key` and return the sequence number of the
+            delete, None if the key wasn't found.
+        """
+        lock = self.get_lock(key)
+        lock.acquire()
+        try:
+            sequence = self.storage.delete(key)
+            if sequence is not None:
+                self.remove_from_trees(key)
+            return sequence
+        finally:
+            lock.release()
+
+    def get(self,key,stream_size):
+        """ Returns (value, timestamp) of `key` or (None, None) if it is missing.
+            A value of at least `stream_size` bytes is returned as a stream
+            if the storage can stream it.
+        """
+        lock = self.get_lock(key)
+        lock.acquire()
+        try:
+            size = self.storage.get_size(key)
+            if size is None:
+                return None, None
+            if size >= stream_size:
+                value = self.storage.open(key)
+            else:
+                value = self.storage.get(key)
+            return value, self.storage.get_timestamp(key)
+        finally:
+            lock.release()
+
+    def close(self):
+        """ Close the storage
+        """
+        self.storage.close()
@@ -0,0 +1,55 @@
+import glob
+import unittest
+from HashRing import Server
+from dhtcommand import DHTCommand, pack_batch
+from mydhtclient import MyDHTClient
+
+__author__ = 'Johan'
+
+class TestMyDHT(unittest.TestCase):
+
+    def setUp(self):
+        host = "localhost"
+        self.ports = [50140] #range(50140,50144)
+        self.servers = []
+        for port in self.ports:
+            self.servers.append(Server(host,port))
+        self.dht = MyDHTClient(True)
+
+    def testBatch(self):
+        """ Put, get and delete all files in upload/
+            with one batch command each
+        """
+        files = glob.glob("upload/*")
+        entries = []
+        for file in files:
+            with open(file, "rb") as f:
+                entries.append((file,f.read()))
+
+        response = self.dht.sendbatch(self.servers[0],DHTCommand.MPUT,entries)
+        self.assertEquals(response,[(file,"PUT OK " + file) for file in files])
+
+        response = self.dht.sendbatch(self.servers[0],DHTCommand.MGET,files + ["no such key"])
+        self.assertEquals(response,entries + [("no such key","ERR_VALUE_NOT_FOUND")])
+
+        response = self.dht.sendbatch(self.servers[0],DHTCommand.MDEL,files)
+        self.assertEquals(response,[(file,"DEL OK " + file) for file in files])
+
+        response = self.dht.sendbatch(self.servers[0],DHTCommand.MGET,files)
+        self.assertEquals(response,[(file,"ERR_VALUE_NOT_FOUND") for file in files])
+
+    def testForwardedOlder(self):
+        """ A forwarded MPUT (a transfer or a hint) doesn't replace
+            keys that have newer values
+        """
+        self.dht.sendbatch(self.servers[0],DHTCommand.MPUT,[("newer","new value")])
+        command = DHTCommand(DHTCommand.MPUT,"",pack_batch([("newer","old value",1.0),("older","old value",1.0)]))
+        command.forwarded = True
+        self.dht.sendcommand(self.servers[0],command)
+
+        response = self.dht.sendbatch(self.servers[0],DHTCommand.MGET,["newer","older"])
+        self.assertEquals(response,[("newer","new value"),("older","old value")])
+        self.dht.sendbatch(self.servers[0],DHTCommand.MDEL,["newer","older"])
+
+if __name__ == '__main__':
+    unittest.main()
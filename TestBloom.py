@@ -0,0 +1,77 @@
+import time
+import unittest
+from HashRing import HashRing, Server
+from bloom import BloomFilter, KeyFilters
+
+__author__ = 'Johan'
+
+class FakeServer():
+    def __init__(self):
+        self.this_server = Server("localhost",50140)
+        self.hash_ring = HashRing([Server("localhost",50140 + i) for i in range(3)])
+        self.gossip = None
+
+    def ring_mismatch(self,server,epoch,digest):
+        pass
+
+class TestBloom(unittest.TestCase):
+
+    def testFilter(self):
+        """ Added keys are always in the filter and the false
+            positive rate is about the error rate
+        """
+        bloom = BloomFilter(1000,0.01)
+        for i in range(1000):
+            bloom.add("key%d" % i)
+        bloom = BloomFilter.fromstring(bloom.tostring())
+        for i in range(1000):
+            self.assertTrue("key%d" % i in bloom)
+        false_positives = len([i for i in range(10000) if "other%d" % i in bloom])
+        self.assertTrue(false_positives < 300)
+
+    def testStale(self):
+        """ Old filters and filters from another epoch of the ring are not used
+        """
+        server = FakeServer()
+        filters = KeyFilters(server,interval=1.0)
+        bloom = BloomFilter()
+        bloom.add("key")
+        filters.receive("localhost:50141 0 1",bloom.tostring(),server.hash_ring.epoch)
+        self.assertTrue(filters.may_have(Server("localhost",50141),"key"))
+        self.assertFalse(filters.may_have(Server("localhost",50141),"other"))
+        self.assertTrue(filters.may_have(Server("localhost",50142),"other"))
+        server.hash_ring.epoch += 1
+        self.assertTrue(filters.may_have(Server("localhost",50141),"other"))
+        server.hash_ring.epoch -= 1
+        filters.filters["localhost:50141"][0] = (bloom,1,time.time() - 10,server.hash_ring.epoch)
+        self.assertTrue(filters.may_have(Server("localhost",50141),"other"))
+
+    def testWorkers(self):
+        """ The filter of the worker that has the key is used
+        """
+        server = FakeServer()
+        filters = KeyFilters(server)
+        for worker in range(2):
+            filters.receive("localhost:50141 %d 2" % worker,BloomFilter().tostring(),server.hash_ring.epoch)
+        self.assertFalse(filters.may_have(Server("localhost",50141),"key"))
+        del filters.filters["localhost:50141"][filters.partitionings[2].worker_for("key")]
+        self.assertTrue(filters.may_have(Server("localhost",50141),"key"))
+
+    def testSelect(self):
+        """ The servers that may have the key are selected, and the first
+            of the others if too few may have it
+        """
+        server = FakeServer()
+        filters = KeyFilters(server)
+        bloom = BloomFilter()
+        bloom.add("key")
+        filters.receive("localhost:50141 0 1",bloom.tostring(),server.hash_ring.epoch)
+        filters.receive("localhost:50142 0 1",BloomFilter().tostring(),server.hash_ring.epoch)
+        servers = [Server("localhost",50142),Server("localhost",50141)]
+        self.assertEquals(map(str,filters.select(servers,"key",1)),["localhost:50141"])
+        self.assertEquals(map(str,filters.select(servers,"key",2)),["localhost:50141","localhost:50142"])
+        self.assertEquals(map(str,filters.select(servers,"other",1)),["localhost:50142"])
+        self.assertEquals(filters.select(servers,"other",0),[])
+
+if __name__ == '__main__':
+    unittest.main()
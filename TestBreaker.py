@@ -0,0 +1,67 @@
+import time
+import unittest
+from socket import socket, create_connection
+from HashRing import Server
+from breaker import CircuitBreakers, OPEN, HALF_OPEN
+from dhtcommand import DHTCommand
+from mydhtclient import MyDHTClient
+
+__author__ = 'Johan'
+
+class TestBreaker(unittest.TestCase):
+
+    def testOpen(self):
+        """ The circuit opens after `threshold` failures in a row and
+            a success closes it
+        """
+        breakers = CircuitBreakers(threshold=3)
+        breakers.failure("localhost:50141")
+        breakers.failure("localhost:50141")
+        self.assertTrue(breakers.allow("localhost:50141"))
+        breakers.success("localhost:50141")
+        for i in range(3):
+            breakers.failure("localhost:50141")
+        self.assertFalse(breakers.allow("localhost:50141"))
+        self.assertTrue(breakers.is_open("localhost:50141"))
+        self.assertTrue(breakers.allow("localhost:50142"))
+
+    def testHalfOpen(self):
+        """ One try is let through when the circuit has been open long
+            enough, if it fails the circuit is open for twice as long
+        """
+        breakers = CircuitBreakers(threshold=1,min_open=1.0)
+        breakers.failure("localhost:50141")
+        circuit = breakers._circuits["localhost:50141"]
+        self.assertEquals(circuit.state,OPEN)
+        circuit.retry_at = time.time()
+        self.assertTrue(breakers.allow("localhost:50141"))
+        self.assertEquals(circuit.state,HALF_OPEN)
+        self.assertFalse(breakers.allow("localhost:50141"))
+        breakers.failure("localhost:50141")
+        self.assertEquals(circuit.state,OPEN)
+        self.assertEquals(circuit.open_time,2.0)
+        circuit.retry_at = time.time()
+        self.assertTrue(breakers.allow("localhost:50141"))
+        breakers.success("localhost:50141")
+        self.assertFalse(breakers.is_open("localhost:50141"))
+        self.assertEquals(breakers._circuits,{})
+
+    def testPooledTimeout(self):
+        """ A pooled connection to a server that hangs counts as a try and
+            a failure, only a connection the server has closed doesn't
+        """
+        listener = socket()
+        listener.bind(("localhost",0))
+        listener.listen(16)
+        server = Server("localhost",listener.getsockname()[1])
+        client = MyDHTClient(timeout=0.2)
+        for i in range(client.pool.max_idle):
+            client.pool.put(server,create_connection(server.bindaddress()))
+        started = time.time()
+        self.assertEquals(client.request_server(server,DHTCommand(DHTCommand.GET,"key")),(None,None))
+        self.assertTrue(time.time() - started < 1.2)
+        self.assertTrue(client.breakers.is_open(server))
+        listener.close()
+
+if __name__ == '__main__':
+    unittest.main()
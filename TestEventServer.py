@@ -0,0 +1,140 @@
+import threading
+import unittest
+from dhtcommand import DHTCommand
+from eventserver import BufferedSocket, Connection, EventServer
+
+__author__ = 'Johan'
+
+class FakeSocket():
+    def __init__(self,data=""):
+        self.data = data
+
+    def fileno(self):
+        return 0
+
+    def recv(self,size,flags=0):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    def setblocking(self,flag):
+        pass
+
+class FakeServer():
+    stream_threshold = 1024
+
+    def handle_request(self,command,sock,lock=None):
+        return True
+
+class FailingServer(FakeServer):
+    """ Every command fails, the responses are kept in `responses`
+    """
+    def __init__(self):
+        self.client = self
+        self.responses = []
+
+    def handle_request(self,command,sock,lock=None):
+        raise ValueError("failed")
+
+    def send_response(self,data,command,sock):
+        self.responses.append((data,command.request_id))
+
+class TestEventServer(unittest.TestCase):
+
+    def parse(self,data,stream_threshold=1024):
+        connection = Connection(FakeSocket())
+        connection.buffer = data
+        return connection.next_command(stream_threshold)
+
+    def testBinaryCommand(self):
+        """ A binary command is complete when the key and the value have been received
+        """
+        command = DHTCommand(DHTCommand.PUT,"key","value")
+        data = command.pack() + "value" + "next"
+        for end in range(len(data) - 4):
+            self.assertEquals(self.parse(data[:end]),(None,None))
+        parsed, prefix = self.parse(data)
+        self.assertEquals(parsed.action,DHTCommand.PUT)
+        self.assertEquals(parsed.key,"key")
+        self.assertEquals(prefix,"valuenext")
+
+    def testLargeValueIsNotWaitedFor(self):
+        """ A value of at least stream_threshold bytes is read by the worker
+        """
+        command = DHTCommand(DHTCommand.PUT,"key","x" * 2000)
+        parsed, prefix = self.parse(command.pack() + "xx")
+        self.assertEquals(parsed.size,2000)
+        self.assertEquals(prefix,"xx")
+
+    def testPaddedCommand(self):
+        """ The padded protocol and a web browser are parsed too
+        """
+        command = DHTCommand(DHTCommand.GET,"key")
+        message = command.getmessage()
+        self.assertEquals(self.parse(message[:100]),(None,None))
+        self.assertEquals(self.parse(message)[0].key,"key")
+        self.assertEquals(self.parse("GET /key HTTP/1.1\r\n"),(None,None))
+        self.assertEquals(self.parse("GET /key HTTP/1.1\r\n\r\n")[0].action,DHTCommand.HTTPGETKEY)
+
+    def testBufferedSocket(self):
+        """ The received prefix is read before the socket
+        """
+        sock = BufferedSocket(FakeSocket("socket"),"prefix")
+        self.assertEquals(sock.recv(4),"pref")
+        self.assertEquals(sock.recv(100),"ix")
+        self.assertEquals(sock.recv(100),"socket")
+
+    def testInternalCommands(self):
+        """ Commands from other nodes are given to the internal workers
+            and client commands to the other workers
+        """
+        events = EventServer(FakeServer())
+        events.remove = lambda connection: None
+        forwarded = DHTCommand(DHTCommand.PUT,"key","value")
+        forwarded.forwarded = True
+        for command in [forwarded,DHTCommand(DHTCommand.PING,"node","states"),DHTCommand(DHTCommand.GET,"key")]:
+            connection = Connection(FakeSocket())
+            connection.buffer = command.pack() + (command.value or "")
+            self.assertTrue(events.dispatch(connection))
+        self.assertEquals(events.internal_tasks.qsize(),2)
+        self.assertEquals(events.tasks.qsize(),1)
+        self.assertEquals(events.tasks.tasks.get()[1][1].action,DHTCommand.GET)
+
+
+    def testPipelined(self):
+        """ Pipelined commands are performed while the connection is read,
+            it is not read while `max_in_flight` commands are in flight
+        """
+        events = EventServer(FakeServer(),max_in_flight=2)
+        removed = []
+        events.remove = removed.append
+        connection = Connection(FakeSocket())
+        for i in range(3):
+            command = DHTCommand(DHTCommand.GET,"key %d" % i)
+            command.request_id = i
+            connection.buffer += command.pack(True)
+        self.assertEquals(events.dispatch(connection),2)
+        self.assertEquals(events.pipelined_tasks.qsize(),2)
+        self.assertEquals(removed,[connection])
+        self.assertTrue(connection.paused)
+        function, args = events.pipelined_tasks.tasks.get()
+        function(*args)
+        self.assertFalse(connection.paused)
+        self.assertEquals(connection.in_flight,1)
+        self.assertEquals(events.returned.get_nowait(),connection)
+
+    def testPipelinedFailed(self):
+        """ A pipelined command that fails is answered with its request id
+        """
+        server = FailingServer()
+        events = EventServer(server)
+        connection = Connection(FakeSocket())
+        connection.in_flight = 1
+        connection.send_lock = threading.Lock()
+        command = DHTCommand(DHTCommand.GET,"key")
+        command.request_id = 7
+        events.handle_pipelined(connection,command,connection.sock,False)
+        self.assertEquals(server.responses,[("ERR_COMMAND_FAILED",7)])
+        self.assertEquals(connection.in_flight,0)
+
+if __name__ == '__main__':
+    unittest.main()
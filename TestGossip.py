@@ -0,0 +1,47 @@
+import unittest
+from HashRing import HashRing, Server
+from gossip import Gossip, ALIVE, SUSPECT, DEAD
+
+__author__ = 'Johan'
+
+class FakeServer():
+    def __init__(self,port):
+        self.this_server = Server("localhost",port)
+        self.hash_ring = HashRing([Server("localhost",50140 + i) for i in range(3)])
+
+    def ring_mismatch(self,server,epoch,digest):
+        pass
+
+class TestGossip(unittest.TestCase):
+
+    def setUp(self):
+        self.gossips = [Gossip(FakeServer(50140 + i)) for i in range(3)]
+
+    def testSpread(self):
+        """ A state spreads with the pings and the worse state
+            wins in the same incarnation
+        """
+        first, second, third = self.gossips
+        first.update("localhost:50142",SUSPECT,0)
+        second.merge(first.pack())
+        self.assertEquals(second.members["localhost:50142"].state,SUSPECT)
+        second.update("localhost:50142",ALIVE,0)
+        self.assertEquals(second.members["localhost:50142"].state,SUSPECT)
+        first.members["localhost:50142"].changed = 0
+        first.expire()
+        self.assertFalse(first.is_alive(Server("localhost",50142)))
+        self.assertTrue(second.is_alive(Server("localhost",50142)))
+
+    def testRefute(self):
+        """ A node that hears that it is dead refutes it with a higher incarnation
+        """
+        first, second, third = self.gossips
+        first.update("localhost:50142",DEAD,0)
+        third.merge(first.pack())
+        self.assertEquals(third.incarnation,1)
+        first.merge(third.pack())
+        self.assertTrue(first.is_alive(Server("localhost",50142)))
+        self.assertEquals(first.members["localhost:50142"].incarnation,1)
+
+if __name__ == '__main__':
+    unittest.main()
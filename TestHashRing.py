@@ -0,0 +1,107 @@
+import unittest
+from HashRing import HashRing, RingDiff, Server
+from benchmark import linear_get_replicas
+
+__author__ = 'Johan'
+
+class TestHashRing(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [Server("localhost",port) for port in range(50140,50150)]
+        self.hash_ring = HashRing(self.servers)
+
+    def testReplicasMatchRingWalk(self):
+        """ The lookup table must return the same replicas
+            as walking the ring from the key position
+        """
+        for i in range(1000):
+            key = "key %d" % i
+            self.assertEquals(self.hash_ring.get_replicas(key),linear_get_replicas(self.hash_ring,key))
+
+    def testReplicasAfterRemove(self):
+        """ Removing a node must invalidate the lookup table
+        """
+        self.hash_ring.get_replicas("a key")
+        self.hash_ring.remove_node(self.servers[0])
+        for i in range(1000):
+            self.assertTrue(self.servers[0] not in self.hash_ring.get_replicas("key %d" % i))
+
+    def testExcludeServer(self):
+        """ `exclude_server` is removed from the replicas
+        """
+        replicas = self.hash_ring.get_replicas("a key")
+        self.assertEquals(len(replicas),3)
+        self.assertEquals(self.hash_ring.get_replicas("a key",replicas[0]),replicas[1:])
+
+    def testSmallRing(self):
+        """ A ring with fewer servers than replicas returns all servers
+        """
+        hash_ring = HashRing(self.servers[:2])
+        self.assertEquals(sorted(hash_ring.get_replicas("a key")),self.servers[:2])
+        self.assertEquals(HashRing().get_replicas("a key"),[])
+
+    def testWeight(self):
+        """ A server with weight 2 gets twice the points and is removed
+            completely even when removed by its host:port string
+        """
+        heavy = Server.fromstring("localhost:50150:2")
+        self.assertEquals(heavy.tostring(),"localhost:50150:2")
+        self.hash_ring.add_node(heavy)
+        self.assertEquals(len(self.hash_ring.ring),12 * self.hash_ring.distribution_points)
+        self.hash_ring.remove_node("localhost:50150")
+        self.assertEquals(len(self.hash_ring.ring),10 * self.hash_ring.distribution_points)
+        self.assertEquals(self.hash_ring.get_nodelist(),self.servers)
+
+    def testRingDiff(self):
+        """ The diff between a copy and the ring after a join must contain
+            exactly the keys that got other replicas
+        """
+        old_ring = self.hash_ring.copy()
+        self.hash_ring.add_node(Server("localhost",50150))
+        diff = RingDiff(old_ring,self.hash_ring)
+        self.assertTrue(len(diff) > 0)
+        for i in range(1000):
+            key = "key %d" % i
+            old_replicas = tuple(old_ring.get_replicas(key))
+            new_replicas = tuple(self.hash_ring.get_replicas(key))
+            if old_replicas == new_replicas:
+                self.assertEquals(diff.get_change(key),None)
+            else:
+                self.assertEquals(diff.get_change(key),(old_replicas,new_replicas))
+        self.assertEquals(len(RingDiff(self.hash_ring,self.hash_ring.copy())),0)
+
+    def testToString(self):
+        """ A ring created from the string of another ring
+            has the same replicas for every key
+        """
+        self.hash_ring.add_node(Server.fromstring("localhost:50150:2"))
+        ring = HashRing.fromstring(self.hash_ring.tostring())
+        self.assertEquals(ring.get_nodelist(),self.hash_ring.get_nodelist())
+        for i in range(1000):
+            self.assertEquals(ring.get_replicas("key %d" % i),self.hash_ring.get_replicas("key %d" % i))
+        self.assertEquals(HashRing.fromstring("localhost:50140,3").distribution_points,3)
+
+    def testEvents(self):
+        """ Rings that apply the same events in any order end up
+            with the same nodes, epoch and digest
+        """
+        first = Server("localhost",50140)
+        rings = [HashRing([first]) for i in range(2)]
+        events = [rings[0].change(first,True,first)]
+        events.append(rings[0].change(Server("localhost",50141),True,first))
+        # Two servers change the ring in the same epoch
+        events.append(rings[0].change(Server("localhost",50142),True,first))
+        events.append((events[-1][0],"localhost:50141",Server("localhost",50142),False))
+        events.append(rings[0].change(Server("localhost",50143),True,first))
+        for event in reversed(events):
+            rings[1].apply(event)
+        rings[0].apply(events[3])
+        self.assertEquals(rings[0].get_nodelist(),rings[1].get_nodelist())
+        self.assertEquals(rings[0].epoch,rings[1].epoch)
+        self.assertEquals(rings[0].digest(),rings[1].digest())
+        self.assertFalse(rings[1].has_node(Server("localhost",50142)))
+        self.assertEquals(HashRing.unpack_events(HashRing.pack_events(rings[0].get_events(3))),
+                          rings[0].get_events(3))
+
+if __name__ == '__main__':
+    unittest.main()
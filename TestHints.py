@@ -0,0 +1,100 @@
+import shutil
+import tempfile
+import unittest
+from socket import socketpair
+from HashRing import HashRing, Server
+from MyDHTTable import MyDHTTable
+from dhtcommand import DHTCommand
+from hints import HintStore, REFERENCE, VALUE, DELETE
+from mydhtserver import MyDHTServer
+from storage import LogStorage, MemoryStorage
+
+__author__ = 'Johan'
+
+class FakeTable():
+    def __init__(self):
+        self.storage = MemoryStorage()
+
+class FakeServer():
+    def __init__(self):
+        self.dht_table = FakeTable()
+
+class BatchClient():
+    """ Sends batches to the batch handler of `target`
+    """
+    def __init__(self,target):
+        self.target = target
+
+    def sendcommand(self,server,command):
+        sock, other = socketpair()
+        try:
+            other.sendall(command.value)
+            return self.target.handle_batch_command(command,sock)
+        finally:
+            sock.close()
+            other.close()
+
+class TestHints(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.server = FakeServer()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testLatestWriteWins(self):
+        """ Only the latest write of a key is kept for a target and a
+            value that is in the table is only referred to
+        """
+        hints = HintStore(self.server)
+        hints.add("localhost:50141",DHTCommand.PUT,"key","value",1.0)
+        hints.add("localhost:50141",DHTCommand.DEL,"key",None,2.0)
+        hints.add("localhost:50141",DHTCommand.PUT,"key","old value",0.5)
+        self.server.dht_table.storage.put("other","value",3.0)
+        hints.add("localhost:50141",DHTCommand.PUT,"other","value",3.0)
+        hints.add("localhost:50142",DHTCommand.PUT,"key","value",4.0)
+        self.assertEquals(len(hints),3)
+        self.assertEquals(hints._hints["localhost:50141"],{"key": (DELETE,2.0),"other": (REFERENCE,3.0)})
+        self.assertEquals(len(hints.storage),3)
+        hints.remove("localhost:50141","key",1.0)
+        self.assertEquals(len(hints),3)
+        hints.remove("localhost:50141","key",2.0)
+        self.assertEquals(len(hints),2)
+
+    def testReload(self):
+        """ Hints in a log storage are there after a restart
+        """
+        hints = HintStore(self.server,LogStorage(self.path))
+        hints.add("localhost:50141",DHTCommand.PUT,"key","value",1.0)
+        hints.add("localhost:50141",DHTCommand.PUT,"empty","",2.0)
+        hints.storage.close()
+        hints = HintStore(self.server,LogStorage(self.path))
+        self.assertEquals(hints._hints,{"localhost:50141": {"key": (VALUE,1.0),"empty": (VALUE,2.0)}})
+        self.assertEquals(hints.storage.get("localhost:50141" + chr(30) + VALUE + chr(30) + "key"),"value")
+        hints.storage.close()
+
+    def testReplayOlder(self):
+        """ Replayed hints don't replace or delete newer values on the
+            target, but replace older values
+        """
+        target = MyDHTServer()
+        target.this_server = Server("localhost",50141)
+        target.hash_ring = HashRing([target.this_server])
+        target.dht_table = MyDHTTable(target.this_server,target.hash_ring)
+        for key, timestamp in [("key",5.0),("deleted",5.0),("old",0.5)]:
+            target.dht_table.perform(DHTCommand(DHTCommand.PUT,key,"value on target",timestamp))
+        self.server.client = BatchClient(target)
+
+        hints = HintStore(self.server)
+        hints.add("localhost:50141",DHTCommand.PUT,"key","hinted value",1.0)
+        hints.add("localhost:50141",DHTCommand.DEL,"deleted",None,2.0)
+        hints.add("localhost:50141",DHTCommand.PUT,"old","hinted value",3.0)
+        hints.replay("localhost:50141",target.this_server)
+        self.assertEquals(len(hints),0)
+        self.assertEquals(target.dht_table.get("key",1024),("value on target",5.0))
+        self.assertEquals(target.dht_table.get("deleted",1024),("value on target",5.0))
+        self.assertEquals(target.dht_table.get("old",1024),("hinted value",3.0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from HashRing import Server
+from latency import Latencies
+
+__author__ = 'Johan'
+
+class TestLatency(unittest.TestCase):
+
+    def testAverage(self):
+        """ The average moves towards the new times by alpha
+        """
+        latencies = Latencies(alpha=0.5)
+        server = Server("localhost",50140)
+        self.assertEquals(latencies.average(server),0.0)
+        latencies.add(server,1.0)
+        self.assertEquals(latencies.average(server),1.0)
+        latencies.add(server,3.0)
+        self.assertEquals(latencies.average("localhost:50140"),2.0)
+
+    def testPercentile(self):
+        """ Only the last `window` times are used for the percentile
+        """
+        latencies = Latencies(window=10)
+        server = Server("localhost",50140)
+        self.assertEquals(latencies.percentile(server),None)
+        for i in range(20):
+            latencies.add(server,float(i))
+        self.assertEquals(latencies.percentile(server),19.0)
+        self.assertEquals(latencies.percentile(server,0.5),15.0)
+
+    def testOrder(self):
+        """ The fastest server is first and unknown servers are tried
+        """
+        latencies = Latencies()
+        slow, fast, unknown = [Server("localhost",50140 + i) for i in range(3)]
+        latencies.add(slow,0.5)
+        latencies.add(fast,0.1)
+        self.assertEquals(latencies.order([slow,fast,unknown]),[unknown,fast,slow])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from merkletree import MerkleTree
+
+__author__ = 'Johan'
+
+class TestMerkleTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = MerkleTree()
+        self.other = MerkleTree()
+        for i in range(1000):
+            self.tree.update("key %d" % i, float(i))
+            self.other.update("key %d" % (999 - i), float(999 - i))
+
+    def testSameKeysSameRoot(self):
+        """ Trees with the same keys have the same root
+            no matter in which order the keys were added
+        """
+        self.assertEquals(self.tree.hash(),self.other.hash())
+        self.assertEquals(len(self.tree),1000)
+
+    def testChangedKey(self):
+        """ A changed timestamp is found by descending
+            into the nodes that differ
+        """
+        self.other.update("key 10", 1000.0)
+        self.assertNotEquals(self.tree.hash(),self.other.hash())
+        nodes = [0]
+        leaves = []
+        while nodes:
+            differs = [node for node in nodes if self.tree.hash(node) != self.other.hash(node)]
+            leaves += filter(self.tree.is_leaf,differs)
+            nodes = [child for node in differs if not self.tree.is_leaf(node) for child in self.tree.children(node)]
+        self.assertEquals(leaves,[self.tree.leaf("key 10")])
+        self.assertTrue(("key 10",1000.0) in self.other.items(leaves[0]))
+
+    def testRemove(self):
+        """ Removing a key and adding it again gives the same root
+        """
+        root = self.tree.hash()
+        self.tree.remove("key 10")
+        self.assertNotEquals(self.tree.hash(),root)
+        self.tree.update("key 10", 10.0)
+        self.assertEquals(self.tree.hash(),root)
+        self.assertEquals(MerkleTree().hash(),MerkleTree().hash())
+
+if __name__ == '__main__':
+    unittest.main()
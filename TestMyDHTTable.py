@@ -0,0 +1,85 @@
+import threading
+import unittest
+from HashRing import HashRing, Server
+from MyDHTTable import MyDHTTable
+from dhtcommand import DHTCommand
+
+__author__ = 'Johan'
+
+class TestMyDHTTable(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [Server("localhost",port) for port in range(50140,50144)]
+        self.hash_ring = HashRing(self.servers)
+        self.table = MyDHTTable(self.servers[0],self.hash_ring)
+
+    def put(self,key,value,timestamp=None):
+        return self.table.perform(DHTCommand(DHTCommand.PUT,key,value,timestamp))
+
+    def testCommands(self):
+        """ PUT, GET, HASKEY and DEL of a single key
+        """
+        self.assertEquals(self.put("key","value",10.0),"PUT OK key")
+        self.assertEquals(self.table.perform(DHTCommand(DHTCommand.GET,"key")),"value")
+        self.assertEquals(self.table.perform(DHTCommand(DHTCommand.HASKEY,"key")),"10.0")
+        self.assertEquals(self.table.get("key",1024),("value",10.0))
+        self.assertEquals(self.table.perform(DHTCommand(DHTCommand.DEL,"key")),"DEL OK key")
+        self.assertEquals(self.table.perform(DHTCommand(DHTCommand.GET,"key")),"ERR_VALUE_NOT_FOUND")
+        self.assertEquals(self.table.perform(DHTCommand(DHTCommand.HASKEY,"key")),"0.0")
+        self.assertEquals(self.table.perform(DHTCommand(DHTCommand.DEL,"key")),"ERR_VALUE_NOT_FOUND")
+
+    def testForwardedOlder(self):
+        """ A forwarded PUT or DEL that is older than the stored value
+            doesn't replace or delete it
+        """
+        self.put("key","new value",20.0)
+        for action, value in [(DHTCommand.PUT,"old value"),(DHTCommand.DEL,None)]:
+            command = DHTCommand(action,"key",value,10.0)
+            command.forwarded = True
+            self.table.perform(command)
+            self.assertEquals(self.table.get("key",1024),("new value",20.0))
+        command = DHTCommand(DHTCommand.DEL,"key",None,30.0)
+        command.forwarded = True
+        self.assertEquals(self.table.perform(command),"DEL OK key")
+        self.assertEquals(self.table.perform(DHTCommand(DHTCommand.GET,"key")),"ERR_VALUE_NOT_FOUND")
+
+    def testPurge(self):
+        """ PURGE removes the keys this server is not a replica for
+        """
+        for i in range(200):
+            self.put("key %d" % i,"value")
+        self.table.perform(DHTCommand(DHTCommand.PURGE))
+        for key in self.table.get_keys():
+            self.assertTrue(self.servers[0] in self.hash_ring.get_replicas(key))
+        self.assertTrue(0 < len(self.table.get_keys()) < 200)
+
+    def testTreesWithConcurrentWrites(self):
+        """ Trees that are rebuilt while other threads write
+            are the same as trees built after the writes
+        """
+        for i in range(2000):
+            self.put("key %d" % i,"value",float(i))
+
+        def writer(first):
+            for i in range(first,2000,4):
+                if i % 3:
+                    self.put("key %d" % i,"new value",float(i + 1))
+                else:
+                    self.table.perform(DHTCommand(DHTCommand.DEL,"key %d" % i))
+
+        threads = [threading.Thread(target=writer,args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        # The ring has changed, the trees are rebuilt during the writes
+        self.hash_ring.remove_node(self.servers[3])
+        self.table.get_tree(self.servers[1])
+        self.table.perform(DHTCommand(DHTCommand.HTTPGET))
+        for thread in threads:
+            thread.join()
+
+        rebuilt = MyDHTTable(self.servers[0],self.hash_ring,self.table.storage)
+        for server in self.servers[1:3]:
+            self.assertEquals(self.table.get_tree(server).hash(),rebuilt.get_tree(server).hash())
+
+if __name__ == '__main__':
+    unittest.main()
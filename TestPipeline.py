@@ -0,0 +1,131 @@
+import threading
+import time
+import unittest
+from socket import socketpair
+from dhtcommand import DHTCommand, HEADER
+from mydhtclient import MyDHTClient
+from eventserver import WorkerPool
+from pipeline import Pipeline, PipelineHandler
+
+__author__ = 'Johan'
+
+class PairClient(MyDHTClient):
+    """ A client that connects to one end of a socket pair
+    """
+    def __init__(self,sock):
+        MyDHTClient.__init__(self)
+        self.sock = sock
+
+    def connect(self,server):
+        return self.sock, False
+
+class SlowServer():
+    """ Answers GET with the key after sleeping the number of
+        hundredths of a second in the key
+    """
+    keepalive_timeout = 1.0
+    stream_threshold = 1024 * 1024
+
+    def __init__(self):
+        self.client = MyDHTClient()
+
+    def handle_request(self,command,sock,lock=None):
+        time.sleep(int(command.key) / 100.0)
+        lock.acquire()
+        try:
+            self.client.send_response("value of %s" % command.key,command,sock)
+        finally:
+            lock.release()
+        return command.keepalive
+
+class TestPipeline(unittest.TestCase):
+
+    def testTagged(self):
+        """ A tagged command has its request id after the epoch and a
+            command that isn't tagged has none
+        """
+        command = DHTCommand(DHTCommand.PUT,"key","value")
+        command.request_id = 4711
+        data = command.pack(True)
+        parsed = DHTCommand()
+        self.assertEqual(parsed.unpack(data[:HEADER.size]),len(data) - HEADER.size)
+        self.assertEqual(parsed.unpack_epoch(data[HEADER.size:]),"key")
+        self.assertEqual(parsed.request_id,4711)
+
+        data = command.pack()
+        parsed = DHTCommand()
+        parsed.unpack(data[:HEADER.size])
+        self.assertEqual(parsed.unpack_epoch(data[HEADER.size:]),"key")
+        self.assertEqual(parsed.request_id,None)
+
+    def testOutOfOrder(self):
+        """ Commands are performed at the same time and answered as they
+            are done, each future gets the response of its own command
+        """
+        client_sock, server_sock = socketpair()
+        server = SlowServer()
+        workers = WorkerPool(4)
+        workers.start()
+        handler = PipelineHandler(server,server_sock,workers)
+        serving = threading.Thread(target=lambda: handler.serve(server.client.read_command(server_sock)))
+        serving.start()
+        pipeline = Pipeline(PairClient(client_sock),"localhost:50140")
+        started = time.time()
+        futures = [pipeline.submit(DHTCommand(DHTCommand.GET,delay)) for delay in ["30","20","10","0"]]
+        self.assertEqual(futures[0].result(5.0),"value of 30")
+        self.assertTrue(time.time() - started < 0.5)
+        for future in futures:
+            self.assertTrue(future.done())
+            self.assertEqual(future.result(),"value of %s" % future.command.key)
+        pipeline.close()
+        serving.join(5.0)
+        self.assertFalse(serving.is_alive())
+
+    def testFailed(self):
+        """ The commands in flight get None when the connection is closed
+        """
+        client_sock, server_sock = socketpair()
+        pipeline = Pipeline(PairClient(client_sock),"localhost:50140")
+        future = pipeline.submit(DHTCommand(DHTCommand.GET,"key"))
+        server_sock.close()
+        self.assertEqual(future.result(5.0),None)
+        self.assertTrue(future.done())
+
+    def testCommandFailed(self):
+        """ A command that fails is answered with ERR_COMMAND_FAILED
+            and the other commands are answered as usual
+        """
+        client_sock, server_sock = socketpair()
+        server = SlowServer()
+        workers = WorkerPool(2)
+        workers.start()
+        handler = PipelineHandler(server,server_sock,workers)
+        serving = threading.Thread(target=lambda: handler.serve(server.client.read_command(server_sock)))
+        serving.start()
+        pipeline = Pipeline(PairClient(client_sock),"localhost:50140")
+        failed = pipeline.submit(DHTCommand(DHTCommand.GET,"no delay"))
+        future = pipeline.submit(DHTCommand(DHTCommand.GET,"0"))
+        self.assertEqual(failed.result(5.0),"ERR_COMMAND_FAILED")
+        self.assertEqual(future.result(5.0),"value of 0")
+        pipeline.close()
+        serving.join(5.0)
+        self.assertFalse(serving.is_alive())
+
+    def testExpired(self):
+        """ A command that isn't answered in time gets None and
+            gives its place in the pipeline to the next command
+        """
+        client_sock, server_sock = socketpair()
+        pipeline = Pipeline(PairClient(client_sock),"localhost:50140",max_in_flight=1)
+        future = pipeline.submit(DHTCommand(DHTCommand.GET,"key"))
+        self.assertEqual(future.result(0.1),None)
+        self.assertTrue(future.done())
+        submitting = threading.Thread(target=pipeline.submit,args=(DHTCommand(DHTCommand.GET,"key"),))
+        submitting.start()
+        submitting.join(5.0)
+        self.assertFalse(submitting.is_alive())
+        pipeline.close()
+        server_sock.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+from storage import LogStorage, MemoryStorage, TieredStorage
+
+__author__ = 'Johan'
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage = LogStorage(self.path)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.path)
+
+    def fill(self,storage):
+        for i in range(100):
+            storage.commit(storage.put("key %d" % i,"value %d" % i,float(i)))
+        storage.put("stream",StringIO("x" * 100000),100.0)
+        storage.delete("key 0")
+        storage.put("key 1","new value",101.0)
+
+    def check(self,storage):
+        self.assertEquals(len(storage),100)
+        self.assertEquals(storage.get("key 0"),None)
+        self.assertEquals(storage.get("key 1"),"new value")
+        self.assertEquals(storage.get_timestamp("key 1"),101.0)
+        self.assertEquals(storage.get("key 99"),"value 99")
+        self.assertEquals(storage.get_size("stream"),100000)
+
+    def reopen(self):
+        self.storage.close()
+        self.storage = LogStorage(self.path)
+
+    def testSameAsMemory(self):
+        """ The log storage returns the same as the memory storage
+        """
+        memory = MemoryStorage()
+        self.fill(memory)
+        self.check(memory)
+        self.fill(self.storage)
+        self.check(self.storage)
+        self.assertEquals(self.storage.open("stream").read(),"x" * 100000)
+
+    def testReopenWithHints(self):
+        """ The index is read from the hint file when the log is reopened
+            and records written after it are read from the log
+        """
+        self.fill(self.storage)
+        self.reopen()
+        self.check(self.storage)
+        self.storage.put("key 100","value 100",100.0)
+        # Die without closing after the hint file has been written
+        self.storage.write_hints()
+        self.storage.put("key 101","value 101",101.0)
+        self.storage._closed = True
+        self.storage = LogStorage(self.path)
+        self.assertEquals(self.storage.get("key 100"),"value 100")
+        self.assertEquals(self.storage.get("key 101"),"value 101")
+
+    def testBrokenRecordIsCutOff(self):
+        """ A half written record at the end of the log is removed
+        """
+        self.fill(self.storage)
+        self.storage.close()
+        os.remove(self.storage.hint_path)
+        with open(self.storage.log_path,"ab") as log:
+            log.write("half a record")
+        self.storage = LogStorage(self.path)
+        self.check(self.storage)
+        self.storage.put("key 100","value 100",100.0)
+        self.reopen()
+        self.assertEquals(self.storage.get("key 100"),"value 100")
+
+    def testCompaction(self):
+        """ Compaction removes old values and keeps the live values
+        """
+        self.fill(self.storage)
+        for i in range(10):
+            self.storage.put("stream",StringIO("x" * 100000),100.0)
+        size = os.path.getsize(self.storage.log_path)
+        self.storage.compact()
+        self.assertTrue(os.path.getsize(self.storage.log_path) < size / 5)
+        self.check(self.storage)
+        self.reopen()
+        self.check(self.storage)
+    def testTieredStorage(self):
+        """ Values over the memory limit are evicted but can still be read
+        """
+        tiered = TieredStorage(self.storage,500)
+        self.fill(tiered)
+        self.check(tiered)
+        stats = dict(tiered.get_stats())
+        self.assertTrue(stats["memory used"] <= 500)
+        self.assertTrue(stats["evictions"] > 0)
+        self.assertTrue(stats["misses"] > 0)
+        hits = stats["hits"]
+        tiered.get("key 99")
+        self.assertEquals(tiered.hits,hits + 1)
+        self.assertEquals(tiered.open("stream").read(),"x" * 100000)
+
+    def testMemoryArenas(self):
+        """ Overwritten values are removed when the arenas are compacted
+            and the slots of deleted keys are reused
+        """
+        memory = MemoryStorage(arena_size=1024)
+        for i in range(1000):
+            memory.put("key %d" % (i % 10),"value %d" % i,float(i))
+        memory.put("large","x" * 1000,1.0)
+        self.assertEquals(len(memory._arenas),1)
+        for i in range(10):
+            self.assertEquals(memory.get("key %d" % i),"value %d" % (990 + i))
+            self.assertEquals(memory.get_timestamp("key %d" % i),990.0 + i)
+        self.assertEquals(memory.get("large"),"x" * 1000)
+        memory.delete("key 0")
+        memory.put("key 10","value 10",10.0)
+        self.assertEquals(len(memory._entries._timestamps),11)
+        self.assertEquals(memory.get("key 0"),None)
+        self.assertEquals(memory.get("key 10"),"value 10")
+        empty = MemoryStorage()
+        empty.put("empty","",1.0)
+        self.assertEquals(empty.get("empty"),"")
+
+if __name__ == '__main__':
+    unittest.main()
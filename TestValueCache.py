@@ -0,0 +1,28 @@
+import unittest
+from valuecache import ValueCache
+
+__author__ = 'Johan'
+
+class TestValueCache(unittest.TestCase):
+
+    def testEviction(self):
+        """ The least recently used values are evicted when the
+            values don't fit and too large values are not kept
+        """
+        cache = ValueCache(10)
+        cache.put("a","1234",1.0)
+        cache.put("b","1234",2.0)
+        self.assertEquals(cache.get("a"),("1234",1.0))
+        cache.put("c","1234",3.0)
+        self.assertEquals(cache.get("b"),(None,0.0))
+        self.assertEquals(cache.get("a"),("1234",1.0))
+        cache.put("d","12345678901",4.0)
+        self.assertEquals(len(cache),2)
+        cache.put("a","1234567",5.0)
+        self.assertEquals(cache.get("c"),(None,0.0))
+        cache.remove("a")
+        self.assertEquals(len(cache),0)
+        self.assertEquals(cache._cached_bytes,0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+from merkletree import MerkleTree
+from workers import Partitioning
+
+__author__ = 'Johan'
+
+class TestWorkers(unittest.TestCase):
+
+    def testRoots(self):
+        """ The roots of all workers cover every leaf once
+        """
+        for workers in [1,3,4,16,24]:
+            partitioning = Partitioning(workers)
+            tree = partitioning.tree
+            leaves = []
+            for worker in range(workers):
+                for root in partitioning.roots(worker):
+                    first, last = tree.leaf_range(root)
+                    leaves.extend(range(first,last + 1))
+                    self.assertEquals(partitioning.worker_for_node(root),worker)
+            self.assertEquals(sorted(leaves),range(tree.first_leaf,tree.first_leaf + tree.leaves))
+
+    def testSplitTrees(self):
+        """ The hashes of the trees of the workers can be combined
+            into the hashes of the tree of all keys
+        """
+        partitioning = Partitioning(3)
+        whole = MerkleTree()
+        trees = [MerkleTree() for worker in range(3)]
+        for i in range(1000):
+            key = "key %d" % i
+            whole.update(key,float(i))
+            trees[partitioning.worker_for(key)].update(key,float(i))
+
+        hashes = {}
+        nodes = [0] + whole.children(0)
+        for worker, subtrees in partitioning.split(nodes).iteritems():
+            for node in subtrees:
+                hashes[node] = trees[worker].hash(node)
+        def node_hash(node):
+            if node not in hashes:
+                hashes[node] = whole.combine(map(node_hash,whole.children(node)))
+            return hashes[node]
+        self.assertEquals(map(node_hash,nodes),map(whole.hash,nodes))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,290 @@
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from HashRing import HashRing, Server
+from cmdapp import CmdApp
+from dhtcommand import DHTCommand, EPOCH, RESPONSE, _block
+from mydhtclient import MyDHTClient
+from storage import EntryTable, MemoryStorage
+
+__author__ = 'Johan'
+
+def linear_get_replicas(hash_ring, string_key):
+    """ The original ring lookup, walks `_sorted_keys` from the start
+        until the key position is found and then collects replicas
+        from the ring. Kept here as a baseline for the ring benchmark.
+    """
+    key = hash_ring.gen_key(string_key)
+    tokens = hash_ring._sorted_keys
+    pos = 0
+    for i in xrange(0, len(tokens)):
+        if key <= tokens[i]:
+            pos = i
+            break
+
+    active_replicas = min(hash_ring.replicas, hash_ring.number_of_nodes())
+    nodelist = []
+    while len(nodelist) < active_replicas:
+        node = hash_ring.ring[tokens[pos % len(tokens)]]
+        if node not in nodelist:
+            nodelist.append(node)
+        pos += 1
+    return nodelist
+
+def dict_storage(entries):
+    """ The original storage of `MyDHTTable`, one dict with the values
+        and one with the timestamps. Kept here as a baseline for the
+        memory benchmark.
+    """
+    values = {}
+    timestamps = {}
+    for key, value, timestamp in entries:
+        values[key] = value
+        timestamps[key] = timestamp
+    return values, timestamps
+
+def memory_storage(entries):
+    storage = MemoryStorage()
+    for key, value, timestamp in entries:
+        storage.put(key,value,timestamp)
+    return storage
+
+def tuple_index(entries):
+    """ The first index of `LogStorage`, a dict of tuples
+    """
+    index = {}
+    for i, (key, value, timestamp) in enumerate(entries):
+        index[key] = (i * 64,len(value),timestamp)
+    return index
+
+def entry_index(entries):
+    index = EntryTable()
+    for i, (key, value, timestamp) in enumerate(entries):
+        index.set(key,i * 64,len(value),timestamp)
+    return index
+
+def resident_memory():
+    """ Returns the resident memory of this process in bytes (Linux only)
+    """
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+class Benchmark(CmdApp):
+    def __init__(self):
+        """ Microbenchmarks for the parts of MyDHT that are run on every request
+        """
+        CmdApp.__init__(self)
+        self.usage = \
+        """
+           -b, --benchmark
+             benchmark to run: ring, membership, distribution, framing, memory,
+             routing (default: ring)
+           -n, --lookups
+             number of lookups (or keys for distribution and memory) per measurement (default: 10000)
+           -s, --server
+             server used by the framing benchmark, a server on port 50199
+             is started if not specified
+        """
+
+    def create_ring(self,number_of_servers,distribution_points=160,weights=None):
+        """ Returns a `HashRing` with `number_of_servers` servers
+            `weights` is an optional list with one weight per server.
+        """
+        weights = weights or [1] * number_of_servers
+        servers = [Server("10.0.%d.%d" % (i / 256, i % 256),50140,weights[i]) for i in xrange(number_of_servers)]
+        return HashRing(servers,distribution_points=distribution_points)
+
+    def timeit(self,function,hash_ring,keys):
+        """ Returns lookups per second of `function` over all `keys`
+        """
+        start = time.time()
+        for key in keys:
+            function(hash_ring,key)
+        elapsed = time.time() - start
+        return len(keys) / max(elapsed,1e-9)
+
+    def bench_ring(self,lookups):
+        """ Compare the linear ring scan with the bisecting lookup table
+            for a few ring sizes.
+        """
+        keys = ["key-%d" % random.randint(0,1 << 30) for i in xrange(lookups)]
+        print "%8s %8s %14s %14s %8s" % ("servers","tokens","linear/s","bisect/s","speedup")
+        for number_of_servers in (10,100,1000):
+            hash_ring = self.create_ring(number_of_servers)
+            # Build the lookup table outside the measurement
+            hash_ring.get_lookup_table()
+            for key in keys[:100]:
+                assert linear_get_replicas(hash_ring,key) == hash_ring.get_replicas(key)
+            linear = self.timeit(linear_get_replicas,hash_ring,keys)
+            bisect = self.timeit(lambda ring,key: ring.get_replicas(key),hash_ring,keys)
+            print "%8d %8d %14.0f %14.0f %7.1fx" % (number_of_servers,len(hash_ring.ring),linear,bisect,bisect/linear)
+
+    def bench_membership(self,number_of_servers=500):
+        """ Time a JOIN storm followed by a LEAVE storm, every change
+            is followed by a get_nodelist and a lookup like on a server.
+        """
+        servers = self.create_ring(number_of_servers).get_nodelist()
+        hash_ring = HashRing()
+        start = time.time()
+        for server in servers:
+            hash_ring.add_node(server)
+            hash_ring.get_nodelist()
+            hash_ring.get_node("a key")
+        joined = time.time() - start
+        start = time.time()
+        for server in servers:
+            hash_ring.remove_node(server)
+            hash_ring.get_nodelist()
+            hash_ring.get_node("a key")
+        left = time.time() - start
+        print "%d joins: %.3fs, %d leaves: %.3fs" % (number_of_servers,joined,number_of_servers,left)
+
+    def bench_distribution(self,keys,number_of_servers=10):
+        """ Report how evenly `keys` keys are spread over the primary
+            node of each key, with the old 3 points per server and with
+            the current default. The weighted ring gives every fourth
+            server weight 2, its load is divided by the weight before the
+            deviation is calculated.
+        """
+        weights = [i % 4 == 0 and 2 or 1 for i in xrange(number_of_servers)]
+        print "%-22s %8s %10s %8s %8s" % ("ring","points","stddev","min","max")
+        for name, distribution_points, ring_weights in (("3 points",3,None),
+                                                         ("160 points",160,None),
+                                                         ("160 points, weighted",160,weights)):
+            hash_ring = self.create_ring(number_of_servers,distribution_points,ring_weights)
+            load = dict((str(server),0) for server in hash_ring.get_nodelist())
+            for i in xrange(keys):
+                load[str(hash_ring.get_replicas("key-%d" % i)[0])] += 1
+            per_weight = [load[str(server)] / server.weight for server in hash_ring.get_nodelist()]
+            mean = float(keys) / sum(server.weight for server in hash_ring.get_nodelist())
+            stddev = math.sqrt(sum((value - mean) ** 2 for value in per_weight) / len(per_weight))
+            print "%-22s %8d %9.1f%% %7.0f%% %7.0f%%" % (name,len(hash_ring.ring),100 * stddev / mean,
+                                                      100 * min(per_weight) / mean,100 * max(per_weight) / mean)
+
+    def start_server(self,port=50199,remote_server=None):
+        """ Start a single server as a subprocess and return it
+            The server joins `remote_server` if it is not None.
+        """
+        arguments = [sys.executable,"mydhtserver.py","-p",str(port)]
+        if remote_server:
+            arguments += ["-s",remote_server]
+        process = subprocess.Popen(arguments)
+        time.sleep(1)
+        return process
+
+    def bench_routing(self,operations):
+        """ Compare operations per second for small PUT and GET commands
+            that are all sent to one server of a ring of 4 servers with 2
+            replicas, and commands that the client sends to a replica.
+        """
+        processes = [self.start_server()]
+        try:
+            for port in range(50200,50203):
+                processes.append(self.start_server(port,"localhost:50199"))
+            server = Server("localhost",50199)
+            ring = HashRing(map(lambda port: Server("localhost",port),range(50199,50203)),2)
+            print "%-8s %-6s %12s %12s" % ("client","action","on replica","ops/s")
+            for route in (False,True):
+                client = MyDHTClient(route=route)
+                for action in (DHTCommand.PUT,DHTCommand.GET):
+                    start = time.time()
+                    for i in xrange(operations):
+                        value = action == DHTCommand.PUT and "value %d" % i or None
+                        client.sendcommand(server,DHTCommand(action,"key %d" % i,value))
+                    elapsed = time.time() - start
+                    # Keys that the server that got the command has
+                    local = sum(1 for i in xrange(operations)
+                                if route or server in ring.get_replicas("key %d" % i))
+                    print "%-8s %-6s %11.0f%% %12.0f" % (route and "routing" or "plain",DHTCommand.allcommands[action],
+                                                         100.0 * local / operations,operations / elapsed)
+                client.pool.close()
+        finally:
+            for process in processes:
+                process.terminate()
+
+    def bench_framing(self,operations,server=None):
+        """ Compare bytes on the wire and operations per second for
+            small GET and PUT commands with the padded and the binary protocol.
+        """
+        process = None
+        if not server:
+            process = self.start_server()
+            server = Server("localhost",50199)
+        try:
+            print "%-8s %-6s %12s %12s" % ("protocol","action","bytes/op","ops/s")
+            for binary in (False,True):
+                client = MyDHTClient(binary=binary)
+                for action in (DHTCommand.PUT,DHTCommand.GET):
+                    start = time.time()
+                    for i in xrange(operations):
+                        value = action == DHTCommand.PUT and "value %d" % i or None
+                        command = DHTCommand(action,"key %d" % (i % 100),value)
+                        data = client.sendcommand(server,command)
+                    elapsed = time.time() - start
+                    if binary:
+                        wire = len(command.pack()) + RESPONSE.size + EPOCH.size
+                    else:
+                        wire = len(command.getmessage()) + _block
+                    wire += command.size + len(data)
+                    print "%-8s %-6s %12d %12.0f" % (binary and "binary" or "padded",DHTCommand.allcommands[action],
+                                                     wire,operations / elapsed)
+                client.pool.close()
+        finally:
+            if process:
+                process.terminate()
+
+    def bench_memory(self,keys):
+        """ Report the bytes per key of `keys` small entries in the old dicts
+            and in `MemoryStorage`, and in the old and new `LogStorage` index.
+            Every storage is built in a forked process and measured by how
+            much its resident memory grows, the keys are included.
+        """
+        print "%-24s %10s %12s" % ("storage","keys","bytes/key")
+        for name, build in (("dicts (before)",dict_storage),("MemoryStorage",memory_storage),
+                            ("log index (before)",tuple_index),("log index EntryTable",entry_index)):
+            read, write = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read)
+                before = resident_memory()
+                start = time.time()
+                entries = (("key-%d" % i,"value-%d" % i,start + i) for i in xrange(keys))
+                storage = build(entries)
+                os.write(write,str(resident_memory() - before))
+                os._exit(0)
+            os.close(write)
+            used = int(os.read(read,64))
+            os.close(read)
+            os.waitpid(pid,0)
+            print "%-24s %10d %12.1f" % (name,keys,float(used) / keys)
+
+    def cmdlinestart(self):
+        """ Parse command line parameters and run the benchmark
+        """
+        try:
+            benchmark = self.getarg("-b") or self.getarg("--benchmark","ring")
+            lookups = int(self.getarg("-n") or self.getarg("--lookups",10000))
+            server = self.getarg("-s") or self.getarg("--server")
+            if benchmark == "ring":
+                self.bench_ring(lookups)
+            elif benchmark == "membership":
+                self.bench_membership()
+            elif benchmark == "distribution":
+                self.bench_distribution(lookups)
+            elif benchmark == "memory":
+                self.bench_memory(lookups)
+            elif benchmark == "routing":
+                self.bench_routing(lookups)
+            elif benchmark == "framing":
+                self.bench_framing(lookups,server and Server.fromstring(server))
+            else:
+                self.help()
+        except ValueError:
+            self.help()
+
+if __name__ == "__main__":
+    Benchmark().cmdlinestart()
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import math
+import struct
+import threading
+import time
+import traceback
+from dhtcommand import DHTCommand
+from mydhtclient import MyDHTClient
+from workers import Partitioning
+
+__author__ = 'Johan'
+
+# A packed filter starts with the number of bits and hashes
+FILTER = struct.Struct("!II")
+
+class BloomFilter():
+    """ A Bloom filter of keys, a key that isn't in the filter has
+        definitely not been added but a key that is in it may not have
+        been added. The filter has room for `capacity` keys with a
+        false positive rate of `error_rate`.
+    """
+    def __init__(self,capacity=1024,error_rate=0.01,bits=None,hashes=None):
+        if bits is None:
+            bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+            hashes = int(round(float(bits) / capacity * math.log(2)))
+        self.bits = max(bits,8)
+        self.hashes = max(hashes,1)
+        self.array = bytearray((self.bits + 7) / 8)
+
+    def positions(self,key):
+        """ Returns the bits of `key`, they are derived from two 64 bit
+            hashes (double hashing)
+        """
+        first, second = struct.unpack("!QQ",hashlib.md5(key).digest())
+        return [(first + i * second) % self.bits for i in xrange(self.hashes)]
+
+    def add(self,key):
+        for position in self.positions(key):
+            self.array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self,key):
+        for position in self.positions(key):
+            if not self.array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def tostring(self):
+        return FILTER.pack(self.bits,self.hashes) + str(self.array)
+
+    @staticmethod
+    def fromstring(data):
+        """ Returns the filter in a string created by `tostring`
+        """
+        bits, hashes = FILTER.unpack_from(data)
+        bloom = BloomFilter(bits=bits,hashes=hashes)
+        bloom.array = bytearray(data[FILTER.size:])
+        return bloom
+
+class KeyFilters():
+    """ Bloom filters of the keys of the other nodes, so that a GET that
+        misses locally doesn't ask more replicas than it needs when the
+        others definitely don't have the key. Every `interval` seconds
+        this node builds a filter of its keys and sends it to the other
+        nodes in a `DHTCommand.BLOOM` command, the key is this node, the
+        worker and the number of worker processes (each worker has a
+        filter of its partition of the keys).
+        A filter only misses keys that were written after it was built,
+        so filters are stale and not used when they are older than
+        `max_age` intervals, when they were received in an older epoch
+        of the ring (keys are transferred when the ring changes) and when
+        they were received before this node refuted that it was suspect
+        or dead (see `Gossip`), it may have missed writes that the other
+        nodes didn't.
+    """
+    def __init__(self,server,interval=10.0,max_age=3,error_rate=0.01):
+        self.server = server
+        self.interval = interval
+        self.max_age = max_age
+        self.error_rate = error_rate
+        # str(node) -> {worker: (filter, processes, received, epoch)}
+        self.filters = {}
+        # processes -> Partitioning of the workers of the other nodes
+        self.partitionings = {}
+        self.lock = threading.Lock()
+        self.client = MyDHTClient(timeout=interval)
+        self.client.ring = server.hash_ring
+        self.client.ring_mismatch = server.ring_mismatch
+
+    def start(self):
+        """ Start sending the filter of this node in the background
+        """
+        exchange = threading.Thread(target=self.exchange_thread)
+        exchange.daemon = True
+        exchange.start()
+
+    def exchange_thread(self):
+        while 1:
+            time.sleep(self.interval)
+            try:
+                self.send()
+            except Exception:
+                logging.error("Sending the key filter failed: %s", traceback.format_exc())
+
+    def build(self):
+        """ Returns a filter of the keys of this node (or worker)
+        """
+        keys = self.server.dht_table.storage.keys()
+        bloom = BloomFilter(max(len(keys),1024),self.error_rate)
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    def send(self):
+        """ Send the filter of this node to the other nodes that are alive
+        """
+        this_server = str(self.server.this_server)
+        peers = [node for node in self.server.hash_ring.get_nodelist()
+                 if str(node) != this_server and self.server.is_alive(node)]
+        if not peers:
+            return
+        data = self.build().tostring()
+        key = "%s %d %d" % (this_server,self.server.worker,self.server.processes)
+        for node in peers:
+            command = DHTCommand(DHTCommand.BLOOM,key,data)
+            command.forwarded = True
+            if self.client.sendcommand(node,command) is None:
+                logging.debug("Could not send the key filter to %s", str(node))
+
+    def receive(self,key,data,epoch):
+        """ Keep the filter in `data` from the sender in `key`, it was
+            sent in `epoch` of the ring
+        """
+        name, worker, processes = key.split(" ")
+        bloom = BloomFilter.fromstring(data)
+        self.lock.acquire()
+        try:
+            workers = self.filters.setdefault(name,{})
+            workers[int(worker)] = (bloom,int(processes),time.time(),epoch)
+        finally:
+            self.lock.release()
+
+    def may_have(self,node,key):
+        """ Returns False if `node` definitely doesn't have `key`, True if
+            it may have it or the filter of `node` is missing or stale
+        """
+        workers = self.filters.get(str(node))
+        if not workers:
+            return True
+        processes = workers.values()[0][1]
+        worker = 0
+        if processes > 1:
+            partitioning = self.partitionings.get(processes)
+            if partitioning is None:
+                partitioning = self.partitionings[processes] = Partitioning(processes)
+            worker = partitioning.worker_for(key)
+        entry = workers.get(worker)
+        if entry is None:
+            return True
+        bloom, processes, received, epoch = entry
+        if received < time.time() - self.max_age * self.interval:
+            return True
+        if epoch != self.server.hash_ring.epoch:
+            return True
+        if self.server.gossip and received < self.server.gossip.refuted:
+            return True
+        return key in bloom
+
+    def select(self,servers,key,needed):
+        """ Returns the `servers` that may have `key`, and if they are fewer
+            than `needed` the first of the others until there are `needed`.
+            This node may have missed a write of the key that the filters
+            were built before, so the replicas are never all skipped.
+        """
+        selected = [server for server in servers if self.may_have(server,key)]
+        others = [server for server in servers if server not in selected]
+        return selected + others[:max(needed - len(selected),0)]
+
@@ -0,0 +1,95 @@
+import logging
+import random
+import threading
+import time
+
+__author__ = 'Johan'
+
+# States of the circuit to a server
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half open"
+
+class Circuit():
+    """ The health of the connection to one server
+    """
+    def __init__(self):
+        self.state = CLOSED
+        # Failures in a row
+        self.failures = 0
+        # Seconds the circuit stays open the next time it opens
+        self.open_time = 0.0
+        # When the circuit may be tried again
+        self.retry_at = 0.0
+
+class CircuitBreakers():
+    """ A circuit breaker per server, so that commands to a server that
+        is known to be down fail at once instead of waiting for it.
+        After `threshold` failures in a row the circuit opens and commands
+        fail without trying the server. When it has been open for a while
+        one command is let through (half open), if it succeeds the circuit
+        closes or else it opens again for twice as long. The time is
+        `min_open` seconds the first time, at most `max_open` seconds and
+        randomised by half of it so that all clients don't try at once.
+    """
+    def __init__(self,threshold=3,min_open=1.0,max_open=30.0):
+        self.threshold = threshold
+        self.min_open = min_open
+        self.max_open = max_open
+        # str(server) -> Circuit of the servers that have failed
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def allow(self,server):
+        """ Returns True if a command may be sent to `server`, only one
+            command at a time is let through a half open circuit
+        """
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.get(str(server))
+            if circuit is None or circuit.state == CLOSED:
+                return True
+            if time.time() >= circuit.retry_at:
+                # Another try is let through if this one is never answered
+                logging.debug("Trying %s again", str(server))
+                circuit.state = HALF_OPEN
+                circuit.retry_at = time.time() + circuit.open_time
+                return True
+            return False
+        finally:
+            self._lock.release()
+
+    def is_open(self,server):
+        """ Returns True if commands to `server` fail at once
+        """
+        circuit = self._circuits.get(str(server))
+        return circuit is not None and circuit.state != CLOSED and time.time() < circuit.retry_at
+
+    def success(self,server):
+        """ `server` has answered, close its circuit
+        """
+        if str(server) not in self._circuits:
+            return
+        self._lock.acquire()
+        circuit = self._circuits.pop(str(server),None)
+        self._lock.release()
+        if circuit is not None and circuit.state != CLOSED:
+            logging.info("%s answers again", str(server))
+
+    def failure(self,server):
+        """ A command to `server` has failed, open its circuit after
+            `threshold` failures in a row or if it was a half open try
+        """
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.setdefault(str(server),Circuit())
+            circuit.failures += 1
+            if circuit.state == HALF_OPEN or (circuit.state == CLOSED and circuit.failures >= self.threshold):
+                circuit.open_time = min(max(circuit.open_time * 2,self.min_open),self.max_open)
+                circuit.retry_at = time.time() + circuit.open_time * random.uniform(0.5,1.0)
+                if circuit.state == CLOSED:
+                    logging.error("%s has failed %d times, failing fast for %.1f seconds",
+                                  str(server), circuit.failures, circuit.open_time)
+                circuit.state = OPEN
+        finally:
+            self._lock.release()
@@ -0,0 +1,94 @@
+import logging
+import select
+import threading
+import time
+
+__author__ = 'Johan'
+
+class ConnectionPool():
+    """ Keeps idle keep-alive connections to other servers so that
+        a command doesn't have to pay for a new TCP connection.
+        At most `max_idle` connections are kept per server and
+        connections that have been idle for more than `idle_timeout`
+        seconds are closed.
+    """
+    def __init__(self,max_idle=4,idle_timeout=30):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        # str(server) -> list of (socket, time it was returned to the pool)
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self,server):
+        """ Returns an idle healthy connection to `server` or None
+            if there is none. The most recently used connection is
+            returned first.
+        """
+        self._lock.acquire()
+        try:
+            connections = self._idle.get(str(server), [])
+            while connections:
+                sock, returned = connections.pop()
+                if time.time() - returned > self.idle_timeout or not self.is_healthy(sock):
+                    logging.debug("Closing stale connection to %s", str(server))
+                    sock.close()
+                    continue
+                return sock
+            return None
+        finally:
+            self._lock.release()
+
+    def put(self,server,sock):
+        """ Return `sock` to the pool, it is closed if the pool
+            for `server` is full.
+        """
+        self._lock.acquire()
+        try:
+            self.evict()
+            connections = self._idle.setdefault(str(server), [])
+            if len(connections) < self.max_idle:
+                connections.append((sock, time.time()))
+                sock = None
+        finally:
+            self._lock.release()
+        if sock:
+            sock.close()
+
+    def evict(self):
+        """ Close all connections that have been idle for too long
+            Must be called with the lock held.
+        """
+        now = time.time()
+        for server, connections in self._idle.items():
+            while connections and now - connections[0][1] > self.idle_timeout:
+                connections.pop(0)[0].close()
+            if not connections:
+                del self._idle[server]
+
+    def is_healthy(self,sock):
+        """ An idle connection should never be readable, if it is
+            the other end has closed it or sent something unexpected.
+        """
+        try:
+            if hasattr(select,"poll"):
+                # select can't handle file descriptors above FD_SETSIZE
+                poller = select.poll()
+                poller.register(sock,select.POLLIN | select.POLLERR | select.POLLHUP)
+                readable = poller.poll(0)
+            else:
+                readable = select.select([sock],[],[],0)[0]
+        except (select.error, ValueError):
+            return False
+        return not readable
+
+    def close(self):
+        """ Close all idle connections
+        """
+        self._lock.acquire()
+        try:
+            for connections in self._idle.values():
+                for sock, returned in connections:
+                    sock.close()
+            self._idle = {}
+        finally:
+            self._lock.release()
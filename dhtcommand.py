@@ -1,9 +1,60 @@
+import os
+import struct
 from time import time
 import urllib
 
 __author__ = 'Johan'
 _block = 4096
 
+# Binary protocol, a command is HEADER followed by the key and the value,
+# a response is RESPONSE followed by the data.
+# From version 2 both are followed by EPOCH before the key or the data,
+# and a command with the TAGGED flag and its response by REQUEST_ID after it.
+# HEADER is magic, version, action, flags, key length, value length, timestamp
+HEADER = struct.Struct("!BBBBHQd")
+# RESPONSE is magic, data length, timestamp (of the value for GET)
+RESPONSE = struct.Struct("!BQd")
+# EPOCH is the epoch and the digest of the ring of the sender
+EPOCH = struct.Struct("!QI")
+# REQUEST_ID is chosen by the client, a pipelined response is matched
+# to its command by it
+REQUEST_ID = struct.Struct("!I")
+MAGIC = 0xD7
+VERSION = 2
+# Versions that are accepted from clients, version 1 has no EPOCH
+VERSIONS = [1,2]
+# Every entry in a batch is ENTRY followed by the key and the value
+# ENTRY is key length, value length, timestamp
+ENTRY = struct.Struct("!HQd")
+
+def pack_batch(entries):
+    """ Pack a list of (`key`, `value`, `timestamp`) tuples into a string,
+        this is the value of MGET, MPUT and MDEL commands and their responses.
+    """
+    data = []
+    for key, value, timestamp in entries:
+        value = value or ""
+        data.append(ENTRY.pack(len(key),len(value),timestamp or 0.0))
+        data.append(key)
+        data.append(value)
+    return "".join(data)
+
+def unpack_batch(data):
+    """ Unpack a string created by `pack_batch` into a list of
+        (`key`, `value`, `timestamp`) tuples
+    """
+    entries = []
+    offset = 0
+    while offset < len(data):
+        keylength, valuelength, timestamp = ENTRY.unpack_from(data,offset)
+        offset += ENTRY.size
+        key = data[offset:offset+keylength]
+        offset += keylength
+        value = data[offset:offset+valuelength]
+        offset += valuelength
+        entries.append((key,value,timestamp))
+    return entries
+
 class DHTCommand():
     PUT = 1
     GET = 2
@@ -18,6 +69,17 @@ class DHTCommand():
     BALANCE = 11
     HTTPGET = 12
     HTTPGETKEY = 13
+    MGET = 14
+    MPUT = 15
+    MDEL = 16
+    MERKLE = 17
+    MERKLEKEYS = 18
+    RING = 19
+    RINGDELTA = 20
+    PING = 21
+    PINGREQ = 22
+    BLOOM = 23
+    GETIFNEWER = 24
     UNKNOWN = 99
     allcommands = \
     {1: "PUT",
@@ -33,13 +95,34 @@ class DHTCommand():
      11: "BALANCE",
      12: "HTTPGET",
      13: "HTTPGETKEY",
+     14: "MGET",
+     15: "MPUT",
+     16: "MDEL",
+     17: "MERKLE",
+     18: "MERKLEKEYS",
+     19: "RING",
+     20: "RINGDELTA",
+     21: "PING",
+     22: "PINGREQ",
+     23: "BLOOM",
+     24: "GETIFNEWER",
      99: "UNKNOWN"}
+    # Commands that are followed by a value the server must read
+    VALUE_COMMANDS = [PUT,MGET,MPUT,MDEL,MERKLE,MERKLEKEYS,RINGDELTA,PING,PINGREQ,BLOOM]
+    # Batch commands and the command that is performed for each key
+    BATCH_COMMANDS = {MGET: GET, MPUT: PUT, MDEL: DEL}
+    # Commands that a client can send directly to a replica of the key
+    ROUTED_COMMANDS = [PUT,GET,DEL,GETIFNEWER]
     SEPARATOR=chr(30) # This is the ASCII 30-character aka record delimiter
+    # Flags in the binary header
+    FORWARDED = 1
+    KEEPALIVE = 2
+    TAGGED = 4
 
     def __init__(self,action=None,key=None,value=None,timestamp=None):
         """ Initialize a command with `key`, `action` and `value`
-            if value is a file object read through it to get the size
-            and then rewind it.
+            if value is a file object the size is taken from the file
+            system, other streams are measured by seeking to the end.
             `timestamp` is seconds since epoch and it will be set
             to current time if None.
         """
@@ -49,9 +132,26 @@ class DHTCommand():
         self.key = str(key)
         self.value = value
         self.forwarded = False
+        # If True the connection is kept open for more commands
+        self.keepalive = False
+        # If True the command was received with the binary protocol
+        self.binary = False
+        # If True the command came from another process of the same node
+        self.sibling = False
+        # Version of the binary protocol, the epoch and digest
+        # of the ring of the sender are sent from version 2
+        self.version = VERSION
+        self.epoch = 0
+        self.digest = 0
+        # Set by a client that pipelines commands on a connection, the
+        # server may answer the commands with ids in any order
+        self.request_id = None
         self.timestamp = timestamp or time()
         if isinstance(value,file):
-            self.size = len(value.read())
+            self.size = os.fstat(value.fileno()).st_size
+        elif hasattr(value,"seek"):
+            value.seek(0,os.SEEK_END)
+            self.size = value.tell()
             value.seek(0)
         else:
             self.size = len(value or [])
@@ -69,6 +169,8 @@ class DHTCommand():
             self.key = commands[2]
             self.forwarded = (commands[3] == "True")
             self.timestamp = float(commands[4])
+            # Older clients don't send keepalive, the padding ends up here
+            self.keepalive = (len(commands) > 6 and commands[5] == "True")
         elif command.startswith("GET /"):
             # Unquote the urlencoded key and remove the leading /
             self.action = self.HTTPGETKEY
@@ -77,6 +179,57 @@ class DHTCommand():
             self.action = self.UNKNOWN
         return self
 
+    def unpack(self,header):
+        """ Parse a binary `header` on the server side and return
+            the length of the data that follows it before the value,
+            `epoch_size` bytes of it are read with `unpack_epoch`.
+            The action is UNKNOWN if the header has another version.
+        """
+        magic, self.version, action, flags, keylength, self.size, self.timestamp = HEADER.unpack(header)
+        self.binary = True
+        self.action = self.UNKNOWN
+        if self.version in VERSIONS and action in self.allcommands:
+            self.action = action
+        self.forwarded = bool(flags & self.FORWARDED)
+        self.keepalive = bool(flags & self.KEEPALIVE)
+        if self.version >= 2 and flags & self.TAGGED:
+            self.request_id = 0
+        return self.epoch_size() + keylength
+
+    def epoch_size(self):
+        """ Returns the size of the epoch and request id that follow the header
+        """
+        if self.version < 2:
+            return 0
+        return EPOCH.size + (self.request_id is not None and REQUEST_ID.size or 0)
+
+    def unpack_epoch(self,data):
+        """ Parse the epoch, digest and request id at the start of `data` if
+            the command has them and return the rest, which is the key.
+        """
+        if self.version >= 2:
+            self.epoch, self.digest = EPOCH.unpack_from(data)
+            if self.request_id is not None:
+                self.request_id, = REQUEST_ID.unpack_from(data,EPOCH.size)
+        return data[self.epoch_size():]
+
+    def pack(self,tagged=False):
+        """ Returns the binary header followed by the epoch and the key,
+            and the request id before the key if `tagged` is True
+        """
+        key = self.key or ""
+        if len(key) > 0xFFFF:
+            raise Exception("Key too long:",len(key))
+        flags = (self.forwarded and self.FORWARDED) | (self.keepalive and self.KEEPALIVE)
+        extension = ""
+        if self.version >= 2:
+            extension = EPOCH.pack(self.epoch,self.digest)
+            if tagged:
+                flags |= self.TAGGED
+                extension += REQUEST_ID.pack(self.request_id)
+        return HEADER.pack(MAGIC,self.version,self.action,flags,len(key),self.size,self.timestamp) + \
+               extension + key
+
     def getmessage(self):
         """ Returns a padded message consisting of `size`:`command`:`value`:0...
         """
@@ -84,7 +237,8 @@ class DHTCommand():
                   str(self.action) + self.SEPARATOR + \
                   (self.key or "") + self.SEPARATOR + \
                   str(self.forwarded) + self.SEPARATOR + \
-                  str(self.timestamp) + self.SEPARATOR
+                  str(self.timestamp) + self.SEPARATOR + \
+                  str(self.keepalive) + self.SEPARATOR
 
         # Add padding up to _block
         message = message + ("0"*(_block-len(message)))
@@ -0,0 +1,496 @@
+import errno
+import fcntl
+import logging
+import os
+import Queue
+import select
+import threading
+import time
+import traceback
+from socket import *
+from socket import error as socket_error
+from dhtcommand import DHTCommand, HEADER, MAGIC
+
+__author__ = 'Johan'
+_block = 4096
+# Size of the reads from client connections
+_chunk = 65536
+
+class Poller():
+    """ Waits for sockets to become readable with epoll if the
+        platform has it, or else with poll. Unlike select there is
+        no limit on the file descriptor numbers.
+    """
+    def __init__(self):
+        if hasattr(select,"epoll"):
+            self._poll = select.epoll()
+            self._events = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+            self._scale = 1.0
+        else:
+            self._poll = select.poll()
+            self._events = select.POLLIN | select.POLLERR | select.POLLHUP
+            # poll takes milliseconds
+            self._scale = 1000.0
+
+    def register(self,fd):
+        self._poll.register(fd,self._events)
+
+    def unregister(self,fd):
+        self._poll.unregister(fd)
+
+    def poll(self,timeout):
+        """ Returns the registered file descriptors that are readable
+            (or closed) within `timeout` seconds.
+        """
+        try:
+            return [fd for fd, event in self._poll.poll(timeout * self._scale)]
+        except (IOError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+    def close(self):
+        if hasattr(self._poll,"close"):
+            self._poll.close()
+
+class BufferedSocket():
+    """ A socket where `prefix` has already been received by the event
+        loop, it is returned by recv before any data from the socket.
+        All other methods are those of the socket.
+    """
+    def __init__(self,sock,prefix=""):
+        self._sock = sock
+        self.prefix = prefix
+
+    def recv(self,size,flags=0):
+        if self.prefix:
+            data = self.prefix[:size]
+            if not flags & MSG_PEEK:
+                self.prefix = self.prefix[size:]
+            return data
+        return self._sock.recv(size,flags)
+
+    def __getattr__(self,name):
+        return getattr(self._sock,name)
+
+class Connection():
+    """ A connection in the event loop, either a client connection
+        that the next command is read from, or a connection to
+        `server` that the response of a replica is read from.
+    """
+    def __init__(self,sock,server=None,command=None):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.server = server
+        # The command that was sent to `server`
+        self.command = command
+        self.buffer = ""
+        self.last_active = time.time()
+        # Set when the client pipelines its commands (see `DHTCommand.TAGGED`),
+        # the responses of the commands in flight are sent one at a time
+        self.send_lock = None
+        self.in_flight = 0
+        # The last command in flight closes the connection
+        self.closing = False
+        # Out of the loop until fewer commands are in flight
+        self.paused = False
+
+    def next_command(self,stream_threshold):
+        """ Parse the buffer and return (command, prefix) if a whole command
+            has been received, prefix is the data that follows the command.
+            The value is received too unless it is at least `stream_threshold`
+            bytes, then the worker reads it from the socket.
+            Returns (None, None) if more data is needed.
+        """
+        data = self.buffer
+        if not data:
+            return None, None
+        if ord(data[0]) == MAGIC:
+            if len(data) < HEADER.size:
+                return None, None
+            command = DHTCommand()
+            end = HEADER.size + command.unpack(data[:HEADER.size])
+            if len(data) < end:
+                return None, None
+            if command.size < stream_threshold and len(data) < end + command.size:
+                return None, None
+            command.key = command.unpack_epoch(data[HEADER.size:end])
+            return command, data[end:]
+        if data.startswith("GET /"):
+            # A web browser, the request ends with an empty line
+            if data.find("\r\n\r\n") < 0 and len(data) < _block:
+                return None, None
+            return DHTCommand().parse(data[:_block]), ""
+        if len(data) < _block:
+            return None, None
+        command = DHTCommand().parse(data[:_block])
+        rest = data[_block:]
+        if command.action != DHTCommand.UNKNOWN and command.size < stream_threshold \
+                and len(rest) < command.size:
+            return None, None
+        return command, rest
+
+class WorkerPool():
+    """ `workers` threads that perform the tasks given to the pool in
+        the order they are given, the threads are started by `start`
+    """
+    def __init__(self,workers):
+        self.workers = workers
+        # (function, arguments) for the workers
+        self.tasks = Queue.Queue()
+
+    def start(self):
+        for i in range(self.workers):
+            worker = threading.Thread(target=self.worker_thread)
+            worker.daemon = True
+            worker.start()
+
+    def put(self,function,args):
+        """ Give `function` with `args` to a worker
+        """
+        self.tasks.put((function,args))
+
+    def qsize(self):
+        return self.tasks.qsize()
+
+    def worker_thread(self):
+        while 1:
+            function, args = self.tasks.get()
+            try:
+                function(*args)
+            except Exception:
+                logging.error("Worker failed: %s", traceback.format_exc())
+
+class EventServer():
+    """ Serves the clients of `server` (a MyDHTServer) from one event
+        loop thread instead of a thread per connection.
+        The loop accepts connections and reads commands, a whole command
+        is performed by one of `workers` worker threads with
+        `server.handle_request`. While a command is performed the
+        connection is not in the loop, a keepalive connection is given
+        back to the loop when the response has been sent.
+        Commands that other nodes send to this one (forwarded commands
+        and gossip) are performed by `internal_workers` threads of their
+        own (as many as `workers` by default). A client command waits for
+        the replicas while it holds a worker, so if the replicas' commands
+        waited for the same workers the nodes could wait for each other.
+        A client that pipelines its commands (see `DHTCommand.TAGGED`)
+        stays in the loop while its commands are performed by
+        `pipeline_workers` threads (as many as `workers` by default),
+        until `max_in_flight` of its commands are in flight.
+        New connections are not accepted while `max_pending` commands
+        wait for a worker, they wait in the listen backlog instead.
+    """
+    def __init__(self,server,workers=16,max_pending=1024,internal_workers=None,
+                 pipeline_workers=None,max_in_flight=128):
+        self.server = server
+        self.max_pending = max_pending
+        self.max_in_flight = max_in_flight
+        # Client commands
+        self.tasks = WorkerPool(workers)
+        # Commands from other nodes
+        self.internal_tasks = WorkerPool(internal_workers or workers)
+        # Pipelined client commands
+        self.pipelined_tasks = WorkerPool(pipeline_workers or workers)
+        # Protects the pipelining state of the connections
+        self.pipeline_lock = threading.Lock()
+        # Connections that workers give back to the loop
+        self.returned = Queue.Queue()
+        # fd -> Connection of all connections in the loop
+        self.connections = {}
+        self.poller = Poller()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        for fd in (self._wakeup_read, self._wakeup_write):
+            fcntl_nonblock(fd)
+
+    def serve(self,server_sock):
+        """ Run the event loop on the listening `server_sock`, never returns
+        """
+        for pool in (self.tasks,self.internal_tasks,self.pipelined_tasks):
+            pool.start()
+
+        server_sock.setblocking(0)
+        listen_fd = server_sock.fileno()
+        self.poller.register(listen_fd)
+        self.poller.register(self._wakeup_read)
+        accepting = True
+        last_cleanup = time.time()
+        while 1:
+            for fd in self.poller.poll(1.0):
+                if fd == listen_fd:
+                    self.accept(server_sock)
+                elif fd == self._wakeup_read:
+                    try:
+                        os.read(self._wakeup_read,_block)
+                    except OSError:
+                        pass
+                elif fd in self.connections:
+                    self.read(self.connections[fd])
+            self.resume_returned()
+
+            # Let the listen backlog hold new clients while the workers are busy
+            pending = self.tasks.qsize() + self.pipelined_tasks.qsize()
+            if accepting and pending >= self.max_pending:
+                logging.debug("%d commands are waiting, not accepting connections", pending)
+                self.poller.unregister(listen_fd)
+                accepting = False
+            elif not accepting and pending < self.max_pending / 2:
+                self.poller.register(listen_fd)
+                accepting = True
+
+            if time.time() - last_cleanup > 1.0:
+                self.close_idle()
+                last_cleanup = time.time()
+
+    def accept(self,server_sock):
+        """ Accept all waiting clients
+        """
+        while 1:
+            try:
+                client_sock, client_addr = server_sock.accept()
+            except socket_error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    logging.error("Accept failed: %s", e)
+                return
+            client_sock.setsockopt(IPPROTO_TCP,TCP_NODELAY,1)
+            self.add(Connection(client_sock))
+
+    def add(self,connection):
+        # The workers send the responses of pipelined commands while the
+        # connection is in the loop, it is only read when it is readable
+        connection.sock.setblocking(connection.send_lock is not None)
+        connection.last_active = time.time()
+        self.connections[connection.fd] = connection
+        self.poller.register(connection.fd)
+
+    def remove(self,connection):
+        """ Take `connection` out of the loop and make its socket blocking
+            again for a worker
+        """
+        del self.connections[connection.fd]
+        self.poller.unregister(connection.fd)
+        connection.sock.setblocking(1)
+
+    def close(self,connection):
+        self.remove(connection)
+        self.release(connection)
+
+    def release(self,connection):
+        """ Close `connection` that is out of the loop, or if pipelined
+            commands are in flight let the last of them close it
+        """
+        self.pipeline_lock.acquire()
+        connection.closing = connection.in_flight > 0
+        self.pipeline_lock.release()
+        if not connection.closing:
+            close_socket(connection.sock)
+
+    def read(self,connection):
+        """ `connection` is readable, a response from a replica is read
+            by a worker, for a client the data is added to its buffer
+            and the command is given to a worker when it is complete.
+        """
+        if connection.server is not None:
+            self.remove(connection)
+            self.internal_tasks.put(self.drain_response,(connection,))
+            return
+        try:
+            data = connection.sock.recv(_chunk)
+        except socket_error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ""
+        if not data:
+            self.close(connection)
+            return
+        connection.buffer += data
+        connection.last_active = time.time()
+        self.dispatch(connection)
+
+    def dispatch(self,connection):
+        """ Give the commands that have been received in the buffer of
+            `connection` to the workers. A command takes the connection
+            out of the loop until its response has been sent, unless it is
+            pipelined. Returns the number of commands.
+        """
+        dispatched = 0
+        while 1:
+            command, prefix = connection.next_command(self.server.stream_threshold)
+            if command is None:
+                return dispatched
+            connection.buffer = ""
+            dispatched += 1
+            if command.request_id is not None and command.action != DHTCommand.UNKNOWN:
+                if self.dispatch_pipelined(connection,command,prefix):
+                    continue
+                return dispatched
+            self.remove(connection)
+            if command.forwarded or command.action in (DHTCommand.PING,DHTCommand.PINGREQ):
+                self.internal_tasks.put(self.handle_connection,(connection,command,prefix))
+            else:
+                self.tasks.put(self.handle_connection,(connection,command,prefix))
+            return dispatched
+
+    def dispatch_pipelined(self,connection,command,prefix):
+        """ Give the pipelined `command` to a pipeline worker, returns True
+            if the connection stays in the loop for the next command.
+            A value of at least `stream_threshold` bytes is read by the
+            worker before the connection is read again.
+        """
+        if connection.send_lock is None:
+            connection.send_lock = threading.Lock()
+            connection.sock.setblocking(1)
+        inline = command.size >= self.server.stream_threshold
+        self.pipeline_lock.acquire()
+        connection.in_flight += 1
+        connection.paused = not inline and connection.in_flight >= self.max_in_flight
+        self.pipeline_lock.release()
+        if inline:
+            self.remove(connection)
+            self.pipelined_tasks.put(self.handle_pipelined,
+                                     (connection,command,BufferedSocket(connection.sock,prefix),True))
+            return False
+        connection.buffer = prefix[command.size:]
+        self.pipelined_tasks.put(self.handle_pipelined,
+                                 (connection,command,BufferedSocket(connection.sock,prefix[:command.size]),False))
+        if connection.paused:
+            logging.debug("%d commands in flight, not reading the connection", connection.in_flight)
+            self.remove(connection)
+            return False
+        return True
+
+    def resume_returned(self):
+        """ Put the connections that workers have given back in the loop,
+            a connection that already has the next command is dispatched
+        """
+        while 1:
+            try:
+                connection = self.returned.get_nowait()
+            except Queue.Empty:
+                return
+            self.add(connection)
+            if connection.server is None:
+                self.dispatch(connection)
+
+    def close_idle(self):
+        """ Close client connections that have been idle for `keepalive_timeout`
+            and replica connections that have not answered in `request_timeout`
+        """
+        now = time.time()
+        for connection in self.connections.values():
+            if connection.in_flight:
+                continue
+            if connection.server is None:
+                timeout = self.server.keepalive_timeout
+            else:
+                timeout = self.server.request_timeout
+            if now - connection.last_active > timeout:
+                if connection.server is not None:
+                    logging.error("No response from %s", str(connection.server))
+                    self.server.replica_failed(connection.server,connection.command)
+                self.close(connection)
+
+    def give_back(self,connection):
+        """ Called by a worker to put `connection` back in the loop
+        """
+        self.returned.put(connection)
+        try:
+            os.write(self._wakeup_write,"x")
+        except OSError:
+            # The pipe is full, the loop will wake up anyway
+            pass
+
+    def drain(self,server,sock,command=None):
+        """ Read the response from `server` on `sock` in the background,
+            `command` has been sent but the response is not needed.
+            The connection is returned to the pool when it answers.
+        """
+        self.give_back(Connection(sock,server,command))
+
+    def handle_connection(self,connection,command,prefix):
+        """ Perform `command` from `connection`, the connection is
+            given back to the loop if it is kept alive
+        """
+        client_sock = BufferedSocket(connection.sock,prefix)
+        keep = False
+        try:
+            keep = self.server.handle_request(command,client_sock,connection.send_lock)
+        except socket_error:
+            logging.debug("Client connection failed: %s", str(command))
+        except Exception:
+            logging.error("Command %s failed: %s", str(command), traceback.format_exc())
+        if keep:
+            connection.buffer = client_sock.prefix
+            self.give_back(connection)
+        else:
+            self.release(connection)
+
+    def handle_pipelined(self,connection,command,client_sock,inline):
+        """ Perform the pipelined `command` from `connection`. If the value
+            is read from the socket (`inline`) the connection is out of the
+            loop and is given back when the response has been sent.
+        """
+        keep = False
+        try:
+            keep = self.server.handle_request(command,client_sock,connection.send_lock)
+        except socket_error:
+            logging.debug("Client connection failed: %s", str(command))
+        except Exception:
+            logging.error("Command %s failed: %s", str(command), traceback.format_exc())
+            send_failure(self.server,command,client_sock,connection.send_lock)
+        if inline:
+            if keep:
+                connection.buffer = client_sock.prefix
+                self.give_back(connection)
+            else:
+                self.release(connection)
+        self.pipeline_lock.acquire()
+        connection.in_flight -= 1
+        close = connection.closing and not connection.in_flight
+        resume = connection.paused and not connection.closing
+        connection.paused = False
+        self.pipeline_lock.release()
+        if close:
+            close_socket(connection.sock)
+        elif resume:
+            self.give_back(connection)
+
+    def drain_response(self,connection):
+        """ Read the response of a replica that the command no longer waits for
+        """
+        try:
+            connection.sock.settimeout(self.server.request_timeout)
+            self.server.client.read_response(connection.server,connection.sock)
+        except socket_error:
+            logging.error("No response from %s", str(connection.server))
+            connection.sock.close()
+            self.server.replica_failed(connection.server,connection.command)
+
+def fcntl_nonblock(fd):
+    """ Make the file descriptor `fd` non-blocking
+    """
+    flags = fcntl.fcntl(fd,fcntl.F_GETFL)
+    fcntl.fcntl(fd,fcntl.F_SETFL,flags | os.O_NONBLOCK)
+
+def send_failure(server,command,sock,lock):
+    """ Answer the pipelined `command` that failed with ERR_COMMAND_FAILED,
+        or else the client waits for it until the connection is closed
+    """
+    if command.request_id is None:
+        return
+    lock.acquire()
+    try:
+        server.client.send_response("ERR_COMMAND_FAILED",command,sock)
+    except socket_error:
+        logging.debug("Client connection failed: %s", str(command))
+    finally:
+        lock.release()
+
+def close_socket(sock):
+    """ Shutdown the write end of `sock` and close it
+    """
+    try:
+        sock.shutdown(SHUT_WR)
+    except socket_error:
+        pass
+    sock.close()
@@ -0,0 +1,199 @@
+import logging
+import random
+from socket import error as socket_error
+import threading
+import time
+import traceback
+from dhtcommand import DHTCommand
+from mydhtclient import MyDHTClient
+
+__author__ = 'Johan'
+
+# States of the other nodes, a worse state wins in the same incarnation
+ALIVE = "alive"
+SUSPECT = "suspect"
+DEAD = "dead"
+_rank = {ALIVE: 0, SUSPECT: 1, DEAD: 2}
+
+class Member():
+    """ What this node knows about another node
+    """
+    def __init__(self,state,incarnation):
+        self.state = state
+        self.incarnation = incarnation
+        # When the state changed
+        self.changed = time.time()
+
+class Gossip():
+    """ Failure detection between the nodes in the style of SWIM.
+        Every `interval` seconds the next node (in a random order) is
+        pinged. If it doesn't answer in `interval` seconds `indirect`
+        other nodes are asked to ping it, if none of them can it becomes
+        suspect and after `suspect_timeout` seconds dead.
+        Every ping and answer carries the states this node knows, so the
+        states spread to all nodes by the random pings. A node that hears
+        that it is suspect or dead refutes it with a higher incarnation.
+        The pings also carry the epoch of the ring (see `MyDHTClient`), so
+        a node that missed a change of the ring catches up within a round.
+    """
+    def __init__(self,server,interval=1.0,suspect_timeout=5.0,indirect=2):
+        self.server = server
+        self.interval = interval
+        self.suspect_timeout = suspect_timeout
+        self.indirect = indirect
+        self.incarnation = 0
+        # When this node last refuted that it was suspect or dead
+        self.refuted = 0.0
+        # str(node) -> Member of the other nodes that have been heard of
+        self.members = {}
+        self.lock = threading.Lock()
+        # Nodes left to ping in this round
+        self.probes = []
+        self.client = MyDHTClient(timeout=interval)
+        self.client.ring = server.hash_ring
+        self.client.ring_mismatch = server.ring_mismatch
+
+    def start(self):
+        """ Start pinging the other nodes in the background
+        """
+        gossip = threading.Thread(target=self.gossip_thread)
+        gossip.daemon = True
+        gossip.start()
+
+    def gossip_thread(self):
+        while 1:
+            time.sleep(self.interval)
+            try:
+                self.expire()
+                self.probe_next()
+            except Exception:
+                logging.error("Gossip failed: %s", traceback.format_exc())
+
+    def peers(self):
+        """ Returns the other nodes in the ring
+        """
+        this_server = str(self.server.this_server)
+        return [node for node in self.server.hash_ring.get_nodelist() if str(node) != this_server]
+
+    def probe_next(self):
+        """ Ping the next node of this round, every node in the ring
+            is pinged once per round
+        """
+        if not self.probes:
+            self.probes = self.peers()
+            random.shuffle(self.probes)
+        if not self.probes:
+            return
+        target = self.probes.pop()
+        if not self.server.hash_ring.has_node(target) or self.ping(target):
+            return
+        # Only the path from this node may be broken, ask others to ping it
+        helpers = [node for node in self.peers() if str(node) != str(target) and self.is_alive(node)]
+        random.shuffle(helpers)
+        for helper in helpers[:self.indirect]:
+            command = DHTCommand(DHTCommand.PINGREQ,target,self.pack())
+            if self.request(helper,command) == "PING ok":
+                logging.debug("%s answered %s but not this node", str(target), str(helper))
+                return
+        self.update(str(target),SUSPECT,self.get_incarnation(target))
+
+    def ping(self,target):
+        """ Send the known states to `target` and merge the states it
+            answers with. Returns False if it didn't answer.
+        """
+        command = DHTCommand(DHTCommand.PING,self.server.this_server,self.pack())
+        response = self.request(target,command)
+        if response is None:
+            return False
+        self.merge(response)
+        # The commands of the server don't have to wait for its circuit breaker
+        self.server.client.breakers.success(target)
+        return True
+
+    def request(self,server,command):
+        """ Send `command` to `server` and return the response, None if it
+            didn't answer within `interval` seconds. Nodes that don't answer
+            are expected here, so it is only logged in debug.
+        """
+        while True:
+            sock = None
+            pooled = False
+            try:
+                sock, pooled = self.client.connect(server)
+                if not self.client.send_header(command,sock):
+                    self.client.send_value(command,sock)
+                return self.client.read_response(server,sock)[0]
+            except socket_error, e:
+                if sock:
+                    sock.close()
+                if not pooled:
+                    logging.debug("No answer from %s: %s", str(server), e)
+                    return None
+
+    def receive(self,data):
+        """ Merge the states in a ping and return the states of this node
+        """
+        self.merge(data)
+        return self.pack()
+
+    def expire(self):
+        """ Suspect nodes that haven't refuted it in `suspect_timeout` are dead
+        """
+        now = time.time()
+        self.lock.acquire()
+        for name, member in self.members.iteritems():
+            if member.state == SUSPECT and now - member.changed > self.suspect_timeout:
+                logging.error("%s is dead", name)
+                member.state = DEAD
+                member.changed = now
+        self.lock.release()
+
+    def get_incarnation(self,node):
+        member = self.members.get(str(node))
+        return member and member.incarnation or 0
+
+    def update(self,name,state,incarnation):
+        """ Set the state of node `name` if it is newer than the known state,
+            a higher incarnation or a worse state in the same incarnation.
+        """
+        if name == str(self.server.this_server):
+            if state != ALIVE and incarnation >= self.incarnation:
+                logging.info("Refuting that this node is %s", state)
+                self.incarnation = incarnation + 1
+                self.refuted = time.time()
+            return
+        self.lock.acquire()
+        member = self.members.get(name)
+        if member is None or (incarnation,_rank[state]) > (member.incarnation,_rank[member.state]):
+            if (member and member.state or ALIVE) != state:
+                log = state == ALIVE and logging.info or logging.error
+                log("%s is %s", name, state)
+            self.members[name] = Member(state,incarnation)
+        self.lock.release()
+
+    def is_alive(self,node):
+        """ Returns False if `node` is known to be dead, suspect nodes are
+            still asked
+        """
+        member = self.members.get(str(node))
+        return member is None or member.state != DEAD
+
+    def pack(self):
+        """ Returns the states of this and the other nodes in the ring
+            as lines of node, state and incarnation
+        """
+        lines = ["%s %s %d" % (self.server.this_server,ALIVE,self.incarnation)]
+        self.lock.acquire()
+        for name, member in self.members.iteritems():
+            if self.server.hash_ring.has_node(name):
+                lines.append("%s %s %d" % (name,member.state,member.incarnation))
+        self.lock.release()
+        return "\n".join(lines)
+
+    def merge(self,data):
+        """ Merge the states in a string created by `pack`
+        """
+        for line in filter(None,data.split("\n")):
+            name, state, incarnation = line.split(" ")
+            if state in _rank:
+                self.update(name,state,int(incarnation))
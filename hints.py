@@ -0,0 +1,156 @@
+import logging
+import threading
+import time
+import traceback
+from HashRing import Server
+from dhtcommand import DHTCommand, pack_batch
+from storage import MemoryStorage
+
+__author__ = 'Johan'
+
+# A hint is stored at target SEPARATOR type SEPARATOR key
+SEPARATOR = chr(30)
+# Types of hints, a PUT with the value in the hint, a PUT of the
+# value in the table of this node and a DEL
+VALUE = "V"
+REFERENCE = "R"
+DELETE = "D"
+
+class HintStore():
+    """ Writes that could not be sent to a replica (hinted handoff), they
+        are sent to the replica when it answers again so that it only gets
+        the keys it missed instead of waiting for a BALANCE.
+        A hint is the target, the key and the timestamp of the write and
+        the value of a PUT, kept in `storage` which is a `LogStorage` if
+        the hints should survive a restart. If this node has the value
+        in its table the hint only refers to it.
+        There is only one hint per target and key, the latest write.
+        Every `interval` seconds the hints for the targets that are not
+        known to be dead are sent as forwarded batches of `chunk` keys.
+    """
+    def __init__(self,server,storage=None,interval=2.0,chunk=100):
+        if storage is None:
+            storage = MemoryStorage()
+        self.server = server
+        self.storage = storage
+        self.interval = interval
+        self.chunk = chunk
+        # target -> {key: (type, timestamp)}
+        self._hints = {}
+        self._lock = threading.Lock()
+        for name in self.storage.keys():
+            target, type, key = name.split(SEPARATOR,2)
+            self._hints.setdefault(target,{})[key] = (type,self.storage.get_timestamp(name))
+
+    def __len__(self):
+        return sum(map(len,self._hints.values()))
+
+    def start(self):
+        """ Start replaying the hints in the background
+        """
+        replay = threading.Thread(target=self.replay_thread)
+        replay.daemon = True
+        replay.start()
+
+    def add(self,target,action,key,value,timestamp):
+        """ Keep a hint that the PUT or DEL `action` of `key` with `value`
+            and `timestamp` could not be sent to `target`
+        """
+        if action == DHTCommand.DEL:
+            type, value = DELETE, ""
+        elif self.server.dht_table.storage.get_timestamp(key) == timestamp:
+            type, value = REFERENCE, ""
+        else:
+            type = VALUE
+        target = str(target)
+        self._lock.acquire()
+        try:
+            hints = self._hints.setdefault(target,{})
+            if key in hints:
+                if hints[key][1] > timestamp:
+                    # There is already a hint for a later write
+                    return
+                self.storage.delete(SEPARATOR.join([target,hints[key][0],key]))
+            self.storage.commit(self.storage.put(SEPARATOR.join([target,type,key]),value or "",timestamp))
+            hints[key] = (type,timestamp)
+        finally:
+            self._lock.release()
+        logging.debug("Hint for %s: %s %s", target, DHTCommand.allcommands[action], key)
+
+    def remove(self,target,key,timestamp):
+        """ Remove the hint for `key` to `target` unless a later
+            write has replaced it
+        """
+        self._lock.acquire()
+        try:
+            hints = self._hints.get(target,{})
+            if key in hints and hints[key][1] == timestamp:
+                self.storage.delete(SEPARATOR.join([target,hints[key][0],key]))
+                del hints[key]
+                if not hints:
+                    del self._hints[target]
+        finally:
+            self._lock.release()
+
+    def discard(self,target):
+        """ Remove all hints for `target`
+        """
+        self._lock.acquire()
+        try:
+            for key, (type, timestamp) in self._hints.pop(target,{}).iteritems():
+                self.storage.delete(SEPARATOR.join([target,type,key]))
+        finally:
+            self._lock.release()
+        logging.info("Discarded the hints for %s, it has left the ring", target)
+
+    def replay_thread(self):
+        while 1:
+            time.sleep(self.interval)
+            for target in self._hints.keys():
+                server = Server.fromstring(target)
+                if not self.server.hash_ring.has_node(server):
+                    # The keys of a node that has left are sent to the new replicas
+                    self.discard(target)
+                    continue
+                if not self.server.is_alive(server):
+                    continue
+                try:
+                    self.replay(target,server)
+                except Exception:
+                    logging.error("Replaying hints to %s failed: %s", target, traceback.format_exc())
+
+    def replay(self,target,server):
+        """ Send the hints for `target` in the order they were written,
+            stops at the first batch that `server` doesn't answer
+        """
+        self._lock.acquire()
+        hints = sorted(self._hints.get(target,{}).items(),key=lambda hint: hint[1][1])
+        self._lock.release()
+        sent = 0
+        for start in xrange(0,len(hints),self.chunk):
+            chunk = hints[start:start + self.chunk]
+            puts = []
+            deletes = []
+            for key, (type, timestamp) in chunk:
+                if type == DELETE:
+                    deletes.append((key,None,timestamp))
+                    continue
+                if type == REFERENCE:
+                    value = self.server.dht_table.storage.get(key)
+                    timestamp = self.server.dht_table.storage.get_timestamp(key)
+                else:
+                    value = self.storage.get(SEPARATOR.join([target,type,key]))
+                if value is not None:
+                    puts.append((key,value,timestamp))
+            for action, entries in ((DHTCommand.MPUT,puts),(DHTCommand.MDEL,deletes)):
+                if not entries:
+                    continue
+                command = DHTCommand(action,"",pack_batch(entries))
+                command.forwarded = True
+                if self.server.client.sendcommand(server,command) is None:
+                    logging.error("Could not replay hints to %s, %d left", target, len(hints) - sent)
+                    return
+            for key, (type, timestamp) in chunk:
+                self.remove(target,key,timestamp)
+            sent += len(chunk)
+        logging.info("Replayed %d hints to %s", sent, target)
@@ -0,0 +1,58 @@
+import collections
+import threading
+
+__author__ = 'Johan'
+
+class Latencies():
+    """ Response times of the other servers in seconds. An exponentially
+        weighted moving average with weight `alpha` for the newest time
+        is used to choose the fastest replica, and the last `window` times
+        are kept for percentiles.
+    """
+    def __init__(self,alpha=0.2,window=100):
+        self.alpha = alpha
+        self.window = window
+        # str(server) -> average
+        self._averages = {}
+        # str(server) -> the last response times
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self,server,seconds):
+        """ Add a response time of `server`
+        """
+        name = str(server)
+        self._lock.acquire()
+        try:
+            average = self._averages.get(name)
+            if average is None:
+                self._averages[name] = seconds
+            else:
+                self._averages[name] = average + self.alpha * (seconds - average)
+            self._samples.setdefault(name,collections.deque(maxlen=self.window)).append(seconds)
+        finally:
+            self._lock.release()
+
+    def average(self,server):
+        """ Returns the average response time of `server`, 0.0 if it
+            hasn't been measured so that it is tried
+        """
+        return self._averages.get(str(server),0.0)
+
+    def percentile(self,server,fraction=0.95):
+        """ Returns the response time that `fraction` of the responses of
+            `server` were faster than, None if it hasn't been measured
+        """
+        self._lock.acquire()
+        try:
+            samples = sorted(self._samples.get(str(server),[]))
+        finally:
+            self._lock.release()
+        if not samples:
+            return None
+        return samples[min(int(len(samples) * fraction),len(samples) - 1)]
+
+    def order(self,servers):
+        """ Returns `servers` sorted by their average response time
+        """
+        return sorted(servers,key=self.average)
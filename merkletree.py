@@ -0,0 +1,112 @@
+import hashlib
+
+__author__ = 'Johan'
+
+class MerkleTree():
+    """ A hash tree of key/timestamp pairs.
+
+        Keys are placed in a leaf by the first bits of their md5, so two
+        servers holding the same keys put them in the same leaves.
+        The tree has `fanout` ** `depth` leaves, node 0 is the root and
+        the children of node n are n * `fanout` + 1 ... n * `fanout` + `fanout`.
+
+        A leaf hash is the xor of the md5 of all its key/timestamp pairs,
+        so it can be updated without looking at the other keys. Inner
+        hashes are recalculated when they are asked for after a change.
+        `fanout` must be a power of 2.
+    """
+    def __init__(self,fanout=16,depth=3):
+        self.fanout = fanout
+        self.depth = depth
+        self.leaves = fanout ** depth
+        # Index of the first leaf
+        self.first_leaf = (self.leaves - 1) / (fanout - 1)
+        # Bits of the md5 (128 bits) that are used to find the leaf
+        self._shift = 128 - (self.leaves.bit_length() - 1)
+        # leaf -> {key: timestamp}
+        self._items = [dict() for i in xrange(self.leaves)]
+        # leaf -> xor of the entry hashes
+        self._leaf_hashes = [0L] * self.leaves
+        # node -> hash, None if it must be recalculated
+        self._hashes = [None] * (self.first_leaf + self.leaves)
+
+    def __len__(self):
+        return sum(len(items) for items in self._items)
+
+    def leaf(self,key):
+        """ Returns the leaf node that `key` belongs to
+        """
+        token = long(hashlib.md5(key).hexdigest(), 16)
+        return self.first_leaf + (token >> self._shift)
+
+    def entry_hash(self,key,timestamp):
+        """ Returns the hash of a key/timestamp pair as a long
+        """
+        return long(hashlib.md5(key + "\0" + repr(timestamp)).hexdigest(), 16)
+
+    def update(self,key,timestamp):
+        """ Add `key` with `timestamp` or update its timestamp
+        """
+        self.remove(key)
+        node = self.leaf(key)
+        self._items[node - self.first_leaf][key] = timestamp
+        self._leaf_hashes[node - self.first_leaf] ^= self.entry_hash(key,timestamp)
+        self.invalidate(node)
+
+    def remove(self,key):
+        """ Remove `key` if it is in the tree
+        """
+        node = self.leaf(key)
+        items = self._items[node - self.first_leaf]
+        if key in items:
+            self._leaf_hashes[node - self.first_leaf] ^= self.entry_hash(key,items.pop(key))
+            self.invalidate(node)
+
+    def invalidate(self,node):
+        """ Mark `node` and all nodes above it as changed
+        """
+        while True:
+            self._hashes[node] = None
+            if node == 0:
+                break
+            node = (node - 1) / self.fanout
+
+    def hash(self,node=0):
+        """ Returns the hash of `node` as a hex string
+        """
+        value = self._hashes[node]
+        if value is None:
+            if self.is_leaf(node):
+                value = "%032x" % self._leaf_hashes[node - self.first_leaf]
+            else:
+                value = self.combine(map(self.hash,self.children(node)))
+            self._hashes[node] = value
+        return value
+
+    def combine(self,hashes):
+        """ Returns the hash of an inner node from the `hashes` of its children
+        """
+        return hashlib.md5("".join(hashes)).hexdigest()
+
+    def leaf_range(self,node):
+        """ Returns the first and the last leaf below `node`
+        """
+        first = last = node
+        while not self.is_leaf(first):
+            first = self.children(first)[0]
+            last = self.children(last)[-1]
+        return first, last
+
+    def is_leaf(self,node):
+        return node >= self.first_leaf
+
+    def children(self,node):
+        """ Returns the child nodes of `node`
+        """
+        first = node * self.fanout + 1
+        return range(first, first + self.fanout)
+
+    def items(self,node):
+        """ Returns a list of (key, timestamp) in leaf `node`
+        """
+        return self._items[node - self.first_leaf].items()
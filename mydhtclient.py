@@ -1,21 +1,66 @@
 from _socket import *
+from errno import ECONNRESET, EPIPE
 import logging
+import random
 from socket import error as socket_error
+from socket import timeout
 import sys
+import time
 import traceback
-from HashRing import Server
+from HashRing import HashRing, Server
+from breaker import CircuitBreakers
 from cmdapp import CmdApp
-from StringIO import StringIO
-from dhtcommand import DHTCommand
+from connectionpool import ConnectionPool
+from dhtcommand import DHTCommand, EPOCH, HEADER, REQUEST_ID, RESPONSE, MAGIC, VERSION, pack_batch, unpack_batch
+from pipeline import Pipeline
+from valuecache import ValueCache
 
 __author__ = 'Johan'
 _block = 4096
+# Size of the chunks when a stream is sent
+_chunk = 65536
 
 class MyDHTClient(CmdApp):
-    def __init__(self,verbose=False,logfile=None):
+    def __init__(self,verbose=False,logfile=None,keepalive=True,binary=True,timeout=None,route=False,
+                 cache=0):
         """A MyDHT client for interacting with MyDHT servers
+           If `keepalive` is True connections are kept open and
+           reused for later commands to the same server.
+           If `binary` is False the old padded protocol is used.
+           `timeout` is the socket timeout in seconds, None means no timeout,
+           a connection is given at most `connect_timeout` seconds.
+           A server that fails is not tried again for a while, see
+           `CircuitBreakers`.
+           If `route` is True the ring is fetched from the server and
+           commands for a key are sent directly to a replica of the key.
+           If `cache` is more than 0 the values that are read are kept in a
+           cache of at most that many bytes, a cached value is only sent
+           again by the server if it has a newer value (see `cached_request`).
         """
         CmdApp.__init__(self,verbose=verbose,logfile=logfile)
+        self.keepalive = keepalive
+        self.binary = binary
+        self.timeout = timeout
+        self.connect_timeout = 5.0
+        # Seconds to wait before the second try of a command, it is
+        # doubled for every try up to `max_backoff`
+        self.backoff = 0.05
+        self.max_backoff = 1.0
+        self.breakers = CircuitBreakers()
+        self.pool = ConnectionPool()
+        self.route = route
+        # The ring of the servers when `route` is True, None until it is fetched.
+        # Its epoch is sent with every command.
+        self.ring = None
+        self.ring_time = 0
+        # Seconds before the ring is fetched again
+        self.ring_ttl = 30
+        # The values of the recently read keys
+        self.cache = None
+        if cache > 0:
+            self.cache = ValueCache(cache)
+        # str(server) -> Pipeline of the connections that `submit` uses
+        self.pipelines = {}
         self.usage = \
         """
            -h, --hostname
@@ -23,37 +68,46 @@ class MyDHTClient(CmdApp):
            -p, --port
              specify port (default: 50140)
            -c, --command
-             put, get, del, haskey, purge, remove, whereis, balance
+             put, get, del, haskey, purge, remove, whereis, balance,
+             mget, mput, mdel (batch commands, see -K)
            -k, --key
              specify key
            -val, --value
              specify a (string) value
            -f, --file
              specify a file value
+           -K, --keyfile
+             file with one key per line for mget, mput and mdel,
+             for mput every line is a key, a tab and a value
+           -r, --route
+             fetch the ring from the server and send the command
+             directly to a server that has the key
+           --legacy
+             use the old padded protocol
         """
 
     def send_to_socket(self,data,size,socket):
         """ Send `size` amount of `data` to `socket`
-            If data is a str it will be converted to
-            StringIO. If it is not an str it is assumed
+            If data is a str it is sent as it is.
+            If it is not an str it is assumed
             to be some kind of stream object (ie file).
         """
         if isinstance(data,str):
-            # Copy string contents to StringIO object
-            data = StringIO(data)
+            if size < len(data):
+                data = data[:size]
+            socket.sendall(data)
+            return
         totalsent = 0
         while totalsent < size:
-            chunk = data.read(_block)
+            chunk = data.read(min(_chunk,size - totalsent))
             if not chunk: break
-            sent = socket.send(chunk)
-            if not sent:
-                raise RuntimeError("socket connection broken")
-            totalsent += sent
+            socket.sendall(chunk)
+            totalsent += len(chunk)
 
     def read_from_socket(self,size,socket,outstream=None):
         """  Read `size` data from `socket` and save it
-             to either outstream (if it is an open file)
-             or return it as a string.
+             to either outstream (if it is an open file or
+             another stream) or return it as a string.
 
              To be able to handle web request there it is possible
              to break the loop prior to size has been received.
@@ -61,17 +115,17 @@ class MyDHTClient(CmdApp):
              and \r\n\r\n in the end.
         """
         received = 0
-        data = StringIO()
+        data = []
         webbrowser = False
         while received < size:
             incoming = socket.recv(size - received)
             if not incoming: break
             received += len(incoming)
-            if isinstance(outstream,file):
+            if outstream is not None:
                 # If outstream is a file, write to it
                 outstream.write(incoming)
             else:
-                data.write(incoming)
+                data.append(incoming)
 
             # Check if incoming starts with HTTP GET
             if incoming[0:5] == "GET /":
@@ -81,7 +135,89 @@ class MyDHTClient(CmdApp):
                 logging.debug("Request was a browser, breaking")
                 break;
 
-        return data.getvalue()
+        return "".join(data)
+
+    def read_command(self,socket):
+        """ Read a command from `socket` on the server side.
+            The first byte tells if the client uses the binary protocol,
+            if not the old padded message (or a HTTP GET) is read.
+            Returns None if the client has closed the connection.
+        """
+        first = socket.recv(1,MSG_PEEK)
+        if not first:
+            return None
+        if ord(first) == MAGIC:
+            header = self.read_from_socket(HEADER.size,socket)
+            if len(header) < HEADER.size:
+                return None
+            command = DHTCommand()
+            length = command.unpack(header)
+            command.key = command.unpack_epoch(self.read_from_socket(length,socket))
+            return command
+        rawcommand = self.read_from_socket(_block,socket)
+        if not rawcommand:
+            return None
+        return DHTCommand().parse(rawcommand)
+
+    def send_response(self,data,command,socket):
+        """ Send `data` as the response to `command` using the
+            same protocol as the command.
+            The binary protocol also sends the timestamp of `command`,
+            for a GET the server sets it to the timestamp of the value,
+            and from version 2 the epoch and digest of `ring`, followed
+            by the request id if the command has one.
+        """
+        if command.binary:
+            header = RESPONSE.pack(MAGIC,len(data),command.timestamp)
+            if command.version >= 2:
+                header += EPOCH.pack(*self.ring_epoch())
+                if command.request_id is not None:
+                    header += REQUEST_ID.pack(command.request_id)
+            if len(data) < _block:
+                # Small responses are sent in a single packet
+                socket.sendall(header + data)
+                return
+            socket.sendall(header)
+        # Send length to all clients except a web browser (it will end up in the HTML)
+        elif command.action != DHTCommand.HTTPGET and command.action != DHTCommand.HTTPGETKEY:
+            self.send_length_to_socket(len(data),socket)
+        self.send_to_socket(data,len(data),socket)
+
+    def read_response_header(self,server,socket):
+        """ Read the binary response header and return the length
+            of the data that follows and the timestamp.
+            `ring_mismatch` is called if the ring of `server`
+            is not the same as `ring`.
+        """
+        size = RESPONSE.size + EPOCH.size
+        header = self.read_from_socket(size,socket)
+        if len(header) < size:
+            raise socket_error("connection closed by server")
+        magic, length, timestamp = RESPONSE.unpack_from(header)
+        if magic != MAGIC:
+            raise socket_error("bad response from server")
+        epoch, digest = EPOCH.unpack_from(header,RESPONSE.size)
+        if (epoch, digest) != self.ring_epoch():
+            self.ring_mismatch(server,epoch,digest)
+        return length, timestamp
+
+    def ring_epoch(self):
+        """ Returns the epoch and digest of `ring`, (0, 0) if there is none
+        """
+        ring = self.ring
+        if ring is None:
+            return 0, 0
+        return ring.epoch, ring.digest()
+
+    def ring_mismatch(self,server,epoch,digest):
+        """ Called when `server` answers with another `epoch` or `digest`
+            of its ring than `ring` has. The ring is fetched again if
+            `server` has a newer one.
+        """
+        ring = self.ring
+        if ring is not None and (epoch > ring.epoch or epoch == ring.epoch and digest != ring.digest()):
+            logging.debug("%s has ring epoch %d, fetching the ring", str(server), epoch)
+            self.ring = None
 
     def send_length_to_socket(self,length,socket):
         """ Create a new length packet and send it to `socket`
@@ -96,6 +232,8 @@ class MyDHTClient(CmdApp):
             return it as an int.
         """
         length = self.read_from_socket(_block,socket)
+        if not length:
+            raise socket_error("connection closed by server")
         length = int(length.split("|")[0])
         return length
 
@@ -104,35 +242,293 @@ class MyDHTClient(CmdApp):
             `outstream` is used when the client wants the output
             value written to an output stream.
         """
+        return self.request(server,command,outstream)[0]
 
-        # If command isn't already a DHTCommand, create one
+    def request(self,server,command,outstream=None):
+        """ Sends a `command` to a `server` like `sendcommand` but
+            returns a tuple of the response and its timestamp.
+            The timestamp is 0.0 with the old padded protocol.
+            (None, None) is returned if the server did not respond.
+            If `route` is True a command for a key is sent to a
+            replica of the key instead, see `route_request`.
+        """
+        # Another thread may turn off the cache
+        cache = self.cache
+        if cache is not None:
+            if command.action == DHTCommand.GET and outstream is None:
+                return self.cached_request(server,command,cache)
+            if command.action in [DHTCommand.PUT,DHTCommand.DEL]:
+                cache.remove(command.key)
+        if self.route and command.action in DHTCommand.ROUTED_COMMANDS:
+            return self.route_request(server,command,outstream)
+        return self.request_server(server,command,outstream)
 
-        for retry in range(3):
-            logging.debug("sending command to: %s %s try number: %d", str(server), str(command), retry)
-            sock = socket(AF_INET, SOCK_STREAM)
+    def submit(self,server,command):
+        """ Send `command` to `server` without waiting for the response and
+            return a `Future` of it. The commands are pipelined on one
+            connection per server, see `Pipeline`.
+            If `route` is True a command for a key is sent to the first
+            replica of the key that isn't failing.
+        """
+        if self.route and command.action in DHTCommand.ROUTED_COMMANDS:
+            ring = self.get_ring(server)
+            if ring is not None:
+                replicas = [replica for replica in ring.get_replicas(command.key)
+                            if not self.breakers.is_open(replica)]
+                server = replicas and replicas[0] or server
+        pipeline = self.pipelines.get(str(server))
+        if pipeline is None:
+            pipeline = self.pipelines.setdefault(str(server),Pipeline(self,server))
+        return pipeline.submit(command)
 
-            try:
-                sock.connect((server.bindaddress()))
-                # If value send the command and the size of value
-                sock.send(command.getmessage())
+    def cached_request(self,server,command,cache):
+        """ Send the GET `command` as a GETIFNEWER with the timestamp of the
+            value of the key in `cache`, the server only sends the value if
+            it is newer. Returns (value, timestamp) like `request`.
+            Values that are written to an output stream are not cached.
+        """
+        value, timestamp = cache.get(command.key)
+        conditional = DHTCommand(DHTCommand.GETIFNEWER,command.key)
+        conditional.timestamp = timestamp
+        response = self.request(server,conditional)
+        if response[0] == "NOT_MODIFIED" and value is not None:
+            logging.debug("Cached value of %s is the newest", command.key)
+            return value, response[1]
+        if response[0] == "UNKNOWN_COMMAND" or str(response[0]).startswith("BAD_COMMAND"):
+            # A server without GETIFNEWER
+            logging.error("%s can't validate cached values, turning off the cache", str(server))
+            self.cache = None
+            return self.request(server,command)
+        if response[0] == "ERR_VALUE_NOT_FOUND":
+            cache.remove(command.key)
+        elif response[0] is not None:
+            cache.put(command.key,response[0],response[1])
+        return response
 
-                # Send value to another server
-                if command.value:
-                    self.send_to_socket(command.value,command.size,sock)
+    def route_request(self,server,command,outstream=None):
+        """ Send `command` to the first replica of its key that answers,
+            the ring is fetched from `server` when it is needed.
+            A replica that doesn't answer makes the ring be fetched
+            again, `server` gets the command if no replica answers.
+        """
+        ring = self.get_ring(server)
+        if ring is not None:
+            for replica in ring.get_replicas(command.key):
+                if self.breakers.is_open(replica):
+                    continue
+                response = self.request_server(replica,command,outstream,1)
+                if response[0] is not None:
+                    return response
+                logging.debug("Replica %s did not answer, fetching the ring again", str(replica))
+                self.ring = None
+        return self.request_server(server,command,outstream)
 
-                length = self.read_length_from_socket(sock)
-                data = self.read_from_socket(length,sock,outstream)
+    def get_ring(self,server):
+        """ Returns the cached ring, it is fetched from `server` if it is
+            older than `ring_ttl` seconds. None is returned if the ring
+            could not be fetched.
+        """
+        if self.ring is not None and time.time() - self.ring_time < self.ring_ttl:
+            return self.ring
+        data = self.request_server(server,DHTCommand(DHTCommand.RING))[0]
+        try:
+            self.ring = HashRing.fromstring(data)
+        except (AttributeError, IndexError, ValueError):
+            # No answer or a server that doesn't know RING
+            logging.error("Could not get the ring from %s", str(server))
+            self.ring = None
+        self.ring_time = time.time()
+        return self.ring
 
-                sock.close()
-                return data
+    def request_server(self,server,command,outstream=None,tries=3):
+        """ Send `command` to `server` and return (response, timestamp)
+            The command is sent at most `tries` times, with a random
+            backoff between the tries. It isn't sent at all while the
+            circuit breaker of `server` is open.
+        """
+        retry = 0
+        while retry < tries:
+            if not self.breakers.allow(server):
+                logging.debug("Not sending %s to %s, it is failing", str(command), str(server))
+                return None, None
+            if retry:
+                time.sleep(min(self.backoff * 2 ** (retry - 1),self.max_backoff) * random.uniform(0.5,1.0))
+            logging.debug("sending command to: %s %s try number: %d", str(server), str(command), retry)
+            sock = None
+            pooled = False
+            try:
+                sock, pooled = self.connect(server)
+                if not self.send_header(command,sock):
+                    self.send_value(command,sock)
+                return self.read_response(server,sock,outstream)
             except socket_error:
                 errno, errstr = sys.exc_info()[:2]
+                if sock:
+                    sock.close()
+                if pooled and self.closed_by_server(errstr):
+                    # The server has closed the pooled connection, this is not a real try
+                    logging.debug("Pooled connection to %s failed: %s", str(server), errstr)
+                    continue
                 logging.error("Error connecting to server: %s", errstr)
+                self.breakers.failure(server)
+                retry += 1
 
-        logging.error("Server (%s) did not respond during 3 tries, giving up", str(server))
-        return None
+        logging.error("Server (%s) did not respond during %d tries, giving up", str(server), tries)
+        return None, None
 
 
+    def closed_by_server(self,error):
+        """ Returns True if the socket `error` on a pooled connection means
+            that the server had closed the connection while it was idle (end
+            of file or reset), a timeout means that the server is hanging.
+        """
+        if isinstance(error,timeout):
+            return False
+        return error.errno in (None,ECONNRESET,EPIPE)
+
+    def send_request(self,server,command):
+        """ Send `command` to `server` without reading the response
+            Returns the socket to read the response from with
+            `read_response`, or None if the command could not be sent.
+        """
+        if not self.breakers.allow(server):
+            logging.debug("Not sending %s to %s, it is failing", str(command), str(server))
+            return None
+        while True:
+            sock = None
+            pooled = False
+            try:
+                sock, pooled = self.connect(server)
+                if not self.send_header(command,sock):
+                    self.send_value(command,sock)
+                return sock
+            except socket_error:
+                errno, errstr = sys.exc_info()[:2]
+                if sock:
+                    sock.close()
+                if not pooled or not self.closed_by_server(errstr):
+                    logging.error("Could not send %s to %s: %s", str(command), str(server), errstr)
+                    self.breakers.failure(server)
+                    return None
+                # The server has closed the pooled connection, try a new one
+                logging.debug("Pooled connection to %s failed: %s", str(server), errstr)
+
+    def connect(self,server):
+        """ Returns a (socket, pooled) tuple with a pooled connection
+            to `server` if there is one, or else a new connection.
+            `server` may have a `family`, AF_INET is used if it hasn't.
+        """
+        # Reuse a pooled connection if there is one
+        sock = self.pool.get(server)
+        if sock is not None:
+            sock.settimeout(self.timeout)
+            return sock, True
+        family = getattr(server,"family",AF_INET)
+        sock = socket(family, SOCK_STREAM)
+        if family == AF_INET:
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        sock.settimeout(self.timeout is None and self.connect_timeout or min(self.timeout,self.connect_timeout))
+        try:
+            sock.connect((server.bindaddress()))
+        except socket_error:
+            sock.close()
+            raise
+        sock.settimeout(self.timeout)
+        return sock, False
+
+    def send_header(self,command,sock,tagged=False):
+        """ Send `command` to `sock` without its value, the caller sends
+            the value. Small string values are sent in the same packet as
+            the command, True is returned if the value was sent.
+            The request id of `command` is only sent if `tagged` is True.
+        """
+        command.keepalive = self.keepalive
+        command.version = VERSION
+        command.epoch, command.digest = self.ring_epoch()
+        if not self.binary:
+            # If value send the command and the size of value
+            sock.sendall(command.getmessage())
+            return False
+        message = command.pack(tagged)
+        if isinstance(command.value,str) and command.size < _block:
+            # Send small values in the same packet as the command
+            sock.sendall(message + command.value)
+            return True
+        sock.sendall(message)
+        return False
+
+    def read_response(self,server,sock,outstream=None):
+        """ Read the response to a command sent to `server` on `sock`
+            and return (data, timestamp). The connection is returned to
+            the pool if keepalive is used.
+        """
+        timestamp = 0.0
+        if self.binary:
+            length, timestamp = self.read_response_header(server,sock)
+        else:
+            length = self.read_length_from_socket(sock)
+
+        data = self.read_from_socket(length,sock,outstream)
+        self.breakers.success(server)
+
+        if self.keepalive:
+            self.pool.put(server,sock)
+        else:
+            sock.close()
+        return data, timestamp
+
+    def sendbatch(self,server,action,entries):
+        """ Send all `entries` to `server` in one MGET, MPUT or MDEL command
+            `entries` is a list of keys or for MPUT (key, value) tuples.
+            Returns a list of (key, status) tuples in the same order as
+            `entries`, status is the value for MGET.
+            None is returned if the server did not respond.
+            If `route` is True the entries are sent as one batch to
+            the first replica of the keys in it.
+        """
+        timestamp = time.time()
+        batch = []
+        for entry in entries:
+            if isinstance(entry,tuple):
+                key, value = entry
+            else:
+                key, value = entry, None
+            batch.append((key,value,timestamp))
+
+        ring = self.route and self.get_ring(server)
+        if not ring:
+            data = self.sendcommand(server,DHTCommand(action,"",pack_batch(batch)))
+            if data is None:
+                return None
+            return map(lambda entry: entry[:2],unpack_batch(data))
+
+        # One batch to the first replica of every key
+        groups = {}
+        for entry in batch:
+            replica = ring.get_replicas(entry[0])[0]
+            groups.setdefault(str(replica),(replica,[]))[1].append(entry)
+        # key -> status
+        results = {}
+        for replica, group in groups.itervalues():
+            data = self.request_server(replica,DHTCommand(action,"",pack_batch(group)),None,1)[0]
+            if data is None:
+                # Let the server send the keys to their replicas
+                self.ring = None
+                data = self.sendcommand(server,DHTCommand(action,"",pack_batch(group)))
+                if data is None:
+                    return None
+            for key, status, timestamp in unpack_batch(data):
+                results[key] = status
+        return [(key,results[key]) for key, value, timestamp in batch]
+
+    def send_value(self,command,socket):
+        """ Send the value of `command` (if any) to `socket`
+        """
+        if command.value:
+            if hasattr(command.value,"seek"):
+                command.value.seek(0)
+            self.send_to_socket(command.value,command.size,socket)
+
     def get_command(self, string):
         for i,command in DHTCommand().allcommands.iteritems():
             if command == string.upper():
@@ -152,12 +548,28 @@ class MyDHTClient(CmdApp):
             value = self.getarg("-val") or self.getarg("--value")
             file = self.getarg("-f") or self.getarg("--file")
             outfile = self.getarg("-o") or self.getarg("--outfile")
+            keyfile = self.getarg("-K") or self.getarg("--keyfile")
+            self.binary = not self.getopt("--legacy")
+            self.route = self.getopt("-r") or self.getopt("--route")
 
             logging.debug("command: %s %s %s %s", str(server), command, key, value)
             if command is None or server is None or file and value:
                 self.help()
                 
             command = self.get_command(command)
+            if command in DHTCommand.BATCH_COMMANDS:
+                if not keyfile:
+                    self.help()
+                with open(keyfile, "rb") as keys:
+                    entries = [line.rstrip("\r\n") for line in keys if line.strip()]
+                if command == DHTCommand.MPUT:
+                    entries = [tuple((line.split("\t",1) + [""])[:2]) for line in entries]
+                for key, status in self.sendbatch(server,command,entries) or []:
+                    if len(status) >= 1024:
+                        status = "Return data is over 1K"
+                    print key + ": " + status
+                return
+
             if file:
                 f = open(file, "rb")
                 command = DHTCommand(command,key,f)
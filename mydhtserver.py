@@ -1,19 +1,31 @@
 import copy
 import logging
 import select
+import shutil
 import signal
 from socket import *
 from socket import error as socket_error
 import sys
 import os
+import Queue
+import tempfile
 import thread
 import threading
+import time
 import traceback
-from HashRing import HashRing, Server
+from HashRing import HashRing, RingDiff, Server
 from MyDHTTable import MyDHTTable
 from cmdapp import CmdApp
-from dhtcommand import DHTCommand
+from eventserver import EventServer, Poller, WorkerPool
+from bloom import KeyFilters
+from gossip import Gossip
+from hints import HintStore
+from latency import Latencies
+from dhtcommand import DHTCommand, pack_batch, unpack_batch
 from mydhtclient import MyDHTClient
+from pipeline import PipelineHandler
+from storage import LogStorage, LogValue, TieredStorage
+from workers import Partitioning, WorkerAddress, reuseport_socket
 
 _block = 4096
 
@@ -25,7 +37,66 @@ class MyDHTServer(CmdApp):
         self.remote_server = None
         self.dht_table = None
         self.client = MyDHTClient()
+        self.client.ring_mismatch = self.ring_mismatch
+        self.hash_ring = None
         self.ring_lock = threading.RLock()
+        # Servers that the ring is being exchanged with because of another
+        # epoch and the (this, their) epochs of the last exchange with a server
+        self.exchanges = set()
+        self.last_exchange = {}
+        self.exchange_lock = threading.Lock()
+        # Seconds a keepalive connection may be idle before it is closed
+        self.keepalive_timeout = 60
+        # Replicas that must answer a write, 0 means a majority
+        self.write_quorum = 0
+        # Replicas that must return the value of a GET
+        self.read_quorum = 1
+        # Seconds to wait for another server
+        self.request_timeout = 10
+        # str(server) -> keys that a range transfer still has to send to server
+        self.transfers = {}
+        self.transfer_lock = threading.Lock()
+        # Approximate number of bytes in every chunk of a range transfer
+        self.transfer_chunk_size = 1024 * 1024
+        # PUT values of at least this size are streamed to the replicas
+        # while they are received and spooled to disk instead of memory
+        self.stream_threshold = 1024 * 1024
+        # Connections that may wait in the listen queue
+        self.backlog = 128
+        # Serve the clients from an event loop with `event_workers` threads
+        # instead of a thread per connection
+        self.eventloop = False
+        self.event_workers = 16
+        self.event_server = None
+        # Performs the pipelined commands of the clients when there is
+        # a thread per connection, see `serve_pipeline`
+        self.pipeline_workers = None
+        # Number of worker processes that serve this node, each worker has
+        # the keys of one partition and a socket bound to the same port
+        self.processes = 1
+        # Index of this worker process and the addresses of all workers
+        self.worker = 0
+        self.siblings = []
+        self.partitioning = None
+        # The socket the other workers connect to, only set in a worker
+        self.sibling_sock = None
+        # pid -> worker of the worker processes, only set in the supervisor
+        self.pids = None
+        self.sibling_client = MyDHTClient()
+        self.sibling_client.ring_mismatch = self.ring_mismatch
+        # Seconds between the pings of the failure detection, 0 turns it off
+        self.gossip_interval = 1.0
+        self.gossip = None
+        # Writes that could not be sent to a replica, see `replica_failed`
+        self.hints = None
+        # Response times of the other servers, a GET asks the fastest replica
+        self.latencies = Latencies()
+        # Ask the next replica too when a GET is slower than usual
+        self.speculative = False
+        # Seconds between the filters of the keys that are sent to the
+        # other nodes, 0 turns them off
+        self.filter_interval = 10.0
+        self.key_filters = None
         self.usage = \
         """
            -p, --port
@@ -36,6 +107,49 @@ class MyDHTServer(CmdApp):
              specify server to join existing ring
            -r, --replicas
              specify the number of replicas (only first server may specify replicas, 3 is default)
+           -d, --distribution_points
+             specify the number of points per server on the ring
+             (only first server may specify distribution points, 160 is default)
+           -w, --weight
+             specify the capacity of this server relative to the others (default: 1)
+           -W, --write_quorum
+             number of replicas that must answer a write (default: a majority)
+           -R, --read_quorum
+             number of replicas that must return the value of a GET,
+             the newest value is returned (default: 1)
+           -t, --timeout
+             seconds to wait for other servers (default: 10)
+           -D, --datadir
+             keep the data in a log in this directory so that it survives
+             a restart (default: in memory)
+           -M, --memory
+             keep at most this many MB of values in memory, the rest is
+             read from the log in --datadir (or a temporary directory)
+           -e, --eventloop
+             serve the clients from an event loop and a fixed number of
+             worker threads instead of a thread per connection
+           --workers
+             number of worker threads of the event loop, the commands that
+             other nodes send and the pipelined commands of the clients have
+             as many threads of their own (default: 16)
+           -b, --backlog
+             number of connections that may wait to be accepted (default: 128)
+           -P, --processes
+             serve this node from this many worker processes that share
+             the port and split the keys between them (default: 1)
+           -S, --speculative
+             a GET that a replica answers slower than 95% of its answers
+             is also sent to the next replica
+           -F, --filter
+             seconds between the Bloom filters of the keys that are sent to
+             the other nodes, replicas that definitely don't have the key
+             of a GET are not asked (default: 10, 0 turns it off)
+           -g, --gossip
+             seconds between the pings that detect dead nodes, replicas
+             that are dead are not asked (default: 1, 0 turns it off)
+           --legacy
+             use the old padded protocol when talking to other servers,
+             needed while the ring has servers without the binary protocol
         """
 
     def cmdlinestart(self):
@@ -49,88 +163,224 @@ class MyDHTServer(CmdApp):
             remoteserver = self.getarg("-s") or self.getarg("-server")
             replicas = self.getarg("-r") or self.getarg("--replicas", 3)
             replicas = int(replicas)
+            distribution_points = self.getarg("-d") or self.getarg("--distribution_points", 160)
+            distribution_points = int(distribution_points)
+            weight = self.getarg("-w") or self.getarg("--weight", 1)
+            weight = float(weight)
+            self.client.binary = not self.getopt("--legacy")
+            self.write_quorum = int(self.getarg("-W") or self.getarg("--write_quorum", 0))
+            self.read_quorum = int(self.getarg("-R") or self.getarg("--read_quorum", 1))
+            self.request_timeout = float(self.getarg("-t") or self.getarg("--timeout", 10))
+            self.client.timeout = self.request_timeout
+            datadir = self.getarg("-D") or self.getarg("--datadir")
+            memory = self.getarg("-M") or self.getarg("--memory")
+            memory = memory and int(float(memory) * 1024 * 1024)
+            self.backlog = int(self.getarg("-b") or self.getarg("--backlog", 128))
+            self.event_workers = int(self.getarg("--workers", 16))
+            self.eventloop = self.getopt("-e") or self.getopt("--eventloop")
+            self.processes = int(self.getarg("-P") or self.getarg("--processes", 1))
+            self.speculative = self.getopt("-S") or self.getopt("--speculative")
+            self.gossip_interval = float(self.getarg("-g") or self.getarg("--gossip", 1.0))
+            self.filter_interval = float(self.getarg("-F") or self.getarg("--filter", 10.0))
             # Start the server
-            self.start(host=host,port=port,replicas=replicas,remote_server=remoteserver)
+            self.start(host=host,port=port,replicas=replicas,remote_server=remoteserver,
+                       distribution_points=distribution_points,weight=weight,datadir=datadir,
+                       memory_limit=memory)
         except ValueError:
             self.help()
 
-    def start(self,host,port,replicas,remote_server=None,is_process=False):
+    def start(self,host,port,replicas,remote_server=None,is_process=False,distribution_points=160,weight=1,
+              datadir=None,memory_limit=None):
         """ Starts the server with `hostname`, `port`
             If `remove_server` is not None it will be contacted to join an existing ring
             `is_process` is used when starting servers as processes, it is used to exit
             in a way pyunit likes if True.
+            `distribution_points` is only used by the first server in a ring,
+            joining servers use the value of the ring.
+            If `datadir` is not None the data is stored in a log in that directory.
+            If `memory_limit` is not None at most that many bytes of values
+            are kept in memory, the others are read from the log.
         """
-        self.this_server = Server(host,port)
+        self.this_server = Server(host,port,weight)
+        self.datadir = datadir
+        self.memory_limit = memory_limit
+        # Temporary directory for the log when there is a memory limit but no datadir
+        self.tempdir = None
         self.remote_server = remote_server
         self.replicas = replicas
+        self.distribution_points = distribution_points
         self.is_process = is_process
         self.serve()
 
     def add_new_node(self,new_node):
-        """ Adds a new server to all existing nodes and
-            returns a |-separated list of the current ring
-            ","  the number of replicas used.
-            Example:
-            localhost:50140|localhost:50141,3
+        """ Adds a new server to the ring in the next epoch and returns
+            the ring with the new server as a string, see `HashRing.tostring`.
+            The other nodes get the change in the background.
         """
-        self.ring_lock.acquire()
         logging.debug("adding: %s", new_node)
-        host, port = new_node.split(":")
-        newserver = Server(host,port)
-        self.hash_ring.remove_node(newserver)
-
-        # Add the new server to all existing nodes
-        command = DHTCommand(DHTCommand.ADDNODE,newserver)
-        self.forward_command(command)
-
-        # Convert to a string list
-        ring = map(lambda serv: str(serv),self.hash_ring.get_nodelist())
-        # Add new server to this ring
-        self.hash_ring.add_node(newserver)
-        # Return |-separated list of nodes
-        self.ring_lock.release()
-        return "|".join(ring)+","+str(self.hash_ring.replicas)
+        self.change_ring(Server.fromstring(new_node),True)
+        return self.hash_ring.tostring()
 
     def remove_node(self,node,forwarded):
         """ Remove `node` from ring
-            If not `forwarder` tell all other nodes
+            If not `forwarded` tell all other nodes
             This usually happens if a node dies without being
             able to do a decommission.
         """
+        self.change_ring(node,False,notify=not forwarded)
+        return "REMOVE ok"
+
+    def decommission(self,forward=True):
+        """ Remove self from hash_ring and move all existing data
+            to new nodes.
+            If `forward` is False the other nodes are not told, the
+            worker processes of a node leave at the same time and
+            only one of them tells the other nodes.
+        """
+        self.change_ring(self.this_server,False,notify=forward,relay=False,wait=True)
+        self.wait_for_transfers()
+
+    def change_ring(self,node,present,notify=True,relay=True,wait=False):
+        """ Add (if `present`) or remove `node` in the next epoch of the ring
+            and send the keys in the ranges that change owner to their new
+            replicas. The other workers of this node get the change if
+            `relay` is True and the other nodes if `notify` is True.
+            The nodes are told in parallel in the background, a node that
+            misses the change gets it when it sees the new epoch.
+            If `wait` is True this waits until the nodes have been told
+            and the keys have been queued for transfer.
+        """
         self.ring_lock.acquire()
-        self.hash_ring.remove_node(node)
+        try:
+            old_ring = self.hash_ring.copy()
+            if present:
+                # A node that joins again after a restart gets the keys of its ranges
+                old_ring.remove_node(node)
+            event = self.hash_ring.change(node,present,self.this_server)
+        finally:
+            self.ring_lock.release()
+        logging.info("Ring epoch %d: %s %s", event[0], present and "added" or "removed", str(node))
+        if relay:
+            self.relay_to_siblings(self.ring_delta_command([event]))
 
-        if not forwarded:
-            # Add the new server to all existing nodes
-            command = DHTCommand(DHTCommand.REMOVE,node)
-            self.forward_command(command)
+        notifications = []
+        if notify:
+            for server in self.hash_ring.get_nodelist():
+                if server != self.this_server and str(server) != str(node) and self.is_alive(server):
+                    notification = threading.Thread(target=self.exchange_ring,args=(server,event[0]))
+                    notification.start()
+                    notifications.append(notification)
+        if wait:
+            for notification in notifications:
+                notification.join()
+            self.transfer_ranges(old_ring)
+        else:
+            thread.start_new_thread(self.transfer_ranges,(old_ring,))
 
-            # Rebalance all nodes
-            self.load_balance(False)
+    def is_alive(self,server):
+        """ Returns False if the failure detection knows that `server` is dead
+        """
+        return self.gossip is None or self.gossip.is_alive(server)
 
-        self.ring_lock.release()
-        return "REMOVE ok"
+    def ring_delta_command(self,events,since=None):
+        """ Returns a RINGDELTA command with `events`, the receiver
+            answers with its events from epoch `since`, which is the
+            epoch of this ring if None.
+        """
+        if since is None:
+            since = self.hash_ring.epoch
+        return DHTCommand(DHTCommand.RINGDELTA,str(since),HashRing.pack_events(events))
 
-    def decommission(self):
-        """ Remove self from hash_ring and move all existing data
-            to new nodes.
+    def apply_ring_events(self,events,sibling=False):
+        """ Apply ring `events` from another node or worker and send the
+            keys in the ranges that change owner to their new replicas.
+            The events that were new are relayed to the other workers of
+            this node unless they came from one of them.
+            A node that removed itself (decommission) sends its keys itself.
         """
         self.ring_lock.acquire()
-        self.hash_ring.remove_node(self.this_server)
+        try:
+            old_ring = self.hash_ring.copy()
+            changed = False
+            new_events = []
+            for epoch, origin, node, present in events:
+                event = (epoch, origin, node, present)
+                if self.hash_ring.apply(event):
+                    changed = True
+                    if not present and origin == str(node):
+                        old_ring.remove_node(node)
+                if self.hash_ring.events.get(str(node)) is event:
+                    new_events.append(event)
+        finally:
+            self.ring_lock.release()
+        if new_events and not sibling:
+            self.relay_to_siblings(self.ring_delta_command(new_events))
+        if changed:
+            logging.info("Ring epoch %d: %d nodes", self.hash_ring.epoch, len(self.hash_ring.get_nodelist()))
+            thread.start_new_thread(self.transfer_ranges,(old_ring,))
 
-        # First remove this server from all other servers
-        command = DHTCommand(DHTCommand.LEAVE,self.this_server)
-        self.forward_command(command)
+    def exchange_ring(self,server,since=0):
+        """ Send the events of the ring from epoch `since` to `server` with
+            RINGDELTA and apply the events it answers with. If `since` is 0
+            the rings are compared in full, or else `server` only answers
+            with its events from the epoch of this ring.
+            Returns False if `server` did not answer.
+        """
+        client = isinstance(server,WorkerAddress) and self.sibling_client or self.client
+        command = self.ring_delta_command(self.hash_ring.get_events(since))
+        if not since:
+            command.key = "0"
+        response = client.sendcommand(server,command)
+        if response is None:
+            logging.error("Could not exchange the ring with %s", str(server))
+            return False
+        self.apply_ring_events(HashRing.unpack_events(response))
+        return True
+
+    def ring_mismatch(self,server,epoch,digest):
+        """ Called by the clients when `server` answers with another epoch
+            or digest of its ring. The rings are exchanged in the background,
+            only the events from the lower epoch unless the last exchange
+            with `server` was for the same epochs and didn't help, then
+            all events are exchanged.
+        """
+        if self.dht_table is None or epoch == 0:
+            # Still starting or a server without epochs
+            return
+        name = str(server)
+        self.exchange_lock.acquire()
+        try:
+            if name in self.exchanges:
+                return
+            epochs = (self.hash_ring.epoch,epoch)
+            since = min(epochs)
+            if self.last_exchange.get(name) == epochs:
+                since = 0
+            self.last_exchange[name] = epochs
+            self.exchanges.add(name)
+        finally:
+            self.exchange_lock.release()
+        logging.debug("%s has ring epoch %d and this node %d, exchanging %s",
+                      name, epoch, epochs[0], since and "changes" or "all events")
+        thread.start_new_thread(self.catch_up,(server,since))
 
-        # Load balance only on this node
-        self.load_balance(True)
-        self.ring_lock.release()
+    def catch_up(self,server,since):
+        """ Exchange the ring with `server` for `ring_mismatch`
+        """
+        try:
+            self.exchange_ring(server,since)
+        finally:
+            self.exchange_lock.acquire()
+            self.exchanges.discard(str(server))
+            self.exchange_lock.release()
 
     def load_balance(self,forwarded):
         """ Load balance this node and then all other.
             if `forwarded` is False BALANCE will be sent to
             all other nodes.
         """
+        # Continue range transfers that were interrupted
+        self.resume_transfers()
         status = self.internal_load_balance()
 
         if not forwarded:
@@ -141,38 +391,226 @@ class MyDHTServer(CmdApp):
         return status
     
     def internal_load_balance(self):
-        """ Go through all keys in map and check with all replica server
-            if they have an older version of the key, send the value.
-            if they have a newer version, get the value.
+        """ Compare the hash tree of the keys every other server is
+            a replica for with the tree on that server.
+            Only the leaves that differ are compared key by key and
+            only the keys that differ are copied.
+        """
+        for server in self.hash_ring.get_nodelist():
+            if server == self.this_server:
+                continue
+            if not self.is_alive(server):
+                logging.debug("Not synchronizing with %s, it is dead", str(server))
+                continue
+            self.synchronize(server)
+        return "BALANCE ok"
+
+    def synchronize(self,server):
+        """ Synchronize the keys that `server` is a replica for with `server`
+            The trees are compared level by level, one MERKLE command per
+            level, starting at the root. The keys and timestamps of the
+            leaves that differ are fetched with MERKLEKEYS.
+            If this server has a newer version of a key it is sent, if
+            `server` has a newer version it is fetched.
+        """
+        tree = self.dht_table.get_tree(server)
+        # A worker process only compares the subtrees of its own keys
+        nodes = self.partitioning and self.partitioning.roots(self.worker) or [0]
+        leaves = []
+        while nodes:
+            command = DHTCommand(DHTCommand.MERKLE,self.this_server," ".join(map(str,nodes)))
+            response = self.client.sendcommand(server,command)
+            if response is None or len(response.split()) != len(nodes):
+                # None was returned, servers is probably down
+                logging.error("Got no hashes from %s, could be dead", str(server))
+                return
+            local_hashes = self.dht_table.get_tree_hashes(server,nodes)
+            differs = [node for node, local, remote in zip(nodes,local_hashes,response.split()) if local != remote]
+            leaves += filter(tree.is_leaf,differs)
+            nodes = [child for node in differs if not tree.is_leaf(node) for child in tree.children(node)]
+
+        if not leaves:
+            logging.debug("In sync with %s", str(server))
+            return
+
+        command = DHTCommand(DHTCommand.MERKLEKEYS,self.this_server," ".join(map(str,leaves)))
+        response = self.client.sendcommand(server,command)
+        if response is None:
+            logging.error("Got no keys from %s, could be dead", str(server))
+            return
+        remote_items = dict((key,timestamp) for key, value, timestamp in unpack_batch(response))
+        local_items = dict(self.dht_table.get_tree_items(server,leaves))
+
+        # Key is missing or old on the other server
+        newer = [key for key, timestamp in local_items.iteritems() if timestamp > remote_items.get(key,0.0)]
+        # Remote object is newer, get it
+        older = [key for key, timestamp in remote_items.iteritems() if timestamp > local_items.get(key,0.0)]
+        logging.debug("Synchronizing with %s: %d leaves differ, copying %d keys to and %d keys from",
+                      str(server), len(leaves), len(newer), len(older))
+
+        for keys in self.chunks(newer):
+            entries = []
+            for key in keys:
+                value = self.dht_table.perform(DHTCommand(DHTCommand.GET,key))
+                timestamp = float(self.dht_table.perform(DHTCommand(DHTCommand.HASKEY,key)))
+                if value != "ERR_VALUE_NOT_FOUND":
+                    entries.append((key,value,timestamp))
+            command = DHTCommand(DHTCommand.MPUT,"",pack_batch(entries))
+            command.forwarded = True
+            self.client.sendcommand(server,command)
+
+        for keys in self.chunks(older):
+            command = DHTCommand(DHTCommand.MGET,"",pack_batch([(key,None,None) for key in keys]))
+            command.forwarded = True
+            response = self.client.sendcommand(server,command)
+            for key, value, timestamp in unpack_batch(response or ""):
+                if value != "ERR_VALUE_NOT_FOUND":
+                    self.dht_table.perform(DHTCommand(DHTCommand.PUT,key,value,timestamp))
+
+    def transfer_ranges(self,old_ring):
+        """ Send the keys in the ranges that have changed owner between
+            `old_ring` and the current ring to the servers that have become
+            replicas for them.
+            A key is sent by the first of its old replicas that is still in
+            the ring, or by this server if it is leaving, so that every key
+            is only sent once.
         """
-        
-        # For all keys in this map
+        diff = RingDiff(old_ring,self.hash_ring)
+        if not len(diff):
+            return
+        leaving = not self.hash_ring.has_node(self.this_server)
+
+        # str(server) -> (server, keys to send)
+        targets = {}
         for key in self.dht_table.get_keys():
-            key_is_at = self.hash_ring.get_replicas(key,self.this_server)
-            for server in key_is_at:
-                command = DHTCommand(DHTCommand.HASKEY,key)
-                status = self.client.sendcommand(server,command)
-                if not status:
-                    # None was returned, servers is probably down
-                    logging.error("Got no timestamp from %s, could be dead", str(server))
+            change = diff.get_change(key)
+            if change is None:
+                continue
+            old_replicas, new_replicas = change
+            if not leaving:
+                senders = [server for server in old_replicas if self.hash_ring.has_node(server)]
+                if not senders or senders[0] != self.this_server:
                     continue
-                remote_time = float(status)
-                local_timestamp = float(self.dht_table.perform(command))
-                if remote_time < local_timestamp:
-                    # Key is missing or old
-                    logging.debug("Copying: %s to %s", key, server)
-                    value = self.dht_table.perform(DHTCommand(DHTCommand.GET,key))
-                    command = DHTCommand(DHTCommand.PUT,key,value,local_timestamp)
-                    status = self.client.sendcommand(server,command)
-                    logging.debug("status: %s", status)
-                elif remote_time > local_timestamp:
-                    # Remote object is newer, get it
-                    logging.debug("Copying: %s from %s", key, server)
-                    command = DHTCommand(DHTCommand.GET,key)
-                    value = self.client.sendcommand(server,command)
-                    status = self.dht_table.perform(DHTCommand(DHTCommand.PUT,key,value,remote_time))
-                    logging.debug(status)
-        return "BALANCE ok"
+            for server in new_replicas:
+                if server not in old_replicas:
+                    targets.setdefault(str(server),(server,[]))[1].append(key)
+
+        logging.info("%d ranges changed owner, sending keys to %d servers", len(diff), len(targets))
+        for server, keys in targets.itervalues():
+            self.queue_transfer(server,keys)
+
+    def queue_transfer(self,server,keys):
+        """ Add `keys` to the keys that should be sent to `server` and
+            start a transfer thread unless one is already running.
+            The keys are sent in token order.
+        """
+        self.transfer_lock.acquire()
+        transfer = self.transfers.setdefault(str(server),{"server": server, "keys": [], "running": False})
+        queued = set(key for token, key in transfer["keys"])
+        transfer["keys"].extend((self.hash_ring.gen_key(key),key) for key in keys if key not in queued)
+        transfer["keys"].sort()
+        start = not transfer["running"]
+        transfer["running"] = True
+        self.transfer_lock.release()
+        if start:
+            thread.start_new_thread(self.transfer_keys,(server,))
+
+    def resume_transfers(self):
+        """ Restart the transfers that have given up, transfers
+            to servers that have left the ring are dropped.
+        """
+        self.transfer_lock.acquire()
+        transfers = []
+        for name, transfer in self.transfers.items():
+            if transfer["running"]:
+                continue
+            if self.hash_ring.has_node(transfer["server"]):
+                transfers.append(transfer["server"])
+            else:
+                del self.transfers[name]
+        self.transfer_lock.release()
+        for server in transfers:
+            logging.info("Resuming transfer to %s", str(server))
+            self.queue_transfer(server,[])
+
+    def wait_for_transfers(self):
+        """ Wait until no transfer thread is running
+        """
+        while True:
+            self.transfer_lock.acquire()
+            running = [transfer for transfer in self.transfers.itervalues() if transfer["running"]]
+            self.transfer_lock.release()
+            if not running:
+                return
+            time.sleep(0.1)
+
+    def transfer_keys(self,server):
+        """ Stream the queued keys for `server` as forwarded MPUT chunks of
+            about `transfer_chunk_size` bytes over a keepalive connection.
+            Keys are only removed from the queue when the chunk has been
+            acknowledged, so an interrupted transfer continues with the
+            first chunk that wasn't. After 3 failed retries the transfer
+            gives up and is resumed by the next BALANCE.
+        """
+        sent = 0
+        sent_bytes = 0
+        retry = 0
+        while True:
+            self.transfer_lock.acquire()
+            transfer = self.transfers[str(server)]
+            keys = transfer["keys"]
+            if not keys:
+                del self.transfers[str(server)]
+                self.transfer_lock.release()
+                break
+            next_keys = keys[:1000]
+            self.transfer_lock.release()
+
+            chunk = []
+            entries = []
+            size = 0
+            for token, key in next_keys:
+                if size >= self.transfer_chunk_size:
+                    break
+                chunk.append((token,key))
+                value = self.dht_table.perform(DHTCommand(DHTCommand.GET,key))
+                if value != "ERR_VALUE_NOT_FOUND":
+                    timestamp = float(self.dht_table.perform(DHTCommand(DHTCommand.HASKEY,key)))
+                    entries.append((key,value,timestamp))
+                    size += len(key) + len(value)
+            command = DHTCommand(DHTCommand.MPUT,"",pack_batch(entries))
+            command.forwarded = True
+            if entries and self.client.sendcommand(server,command) is None:
+                retry += 1
+                if retry > 3:
+                    logging.error("Transfer to %s interrupted with %d keys left, it is resumed by the next BALANCE",
+                                  str(server), len(keys))
+                    self.transfer_lock.acquire()
+                    transfer["running"] = False
+                    self.transfer_lock.release()
+                    return
+                time.sleep(2 ** retry)
+                continue
+            retry = 0
+
+            # The chunk has been acknowledged, remove it from the queue
+            self.transfer_lock.acquire()
+            if keys[:len(chunk)] == chunk:
+                del keys[:len(chunk)]
+            else:
+                # More keys have been queued in the meantime
+                done = set(chunk)
+                keys[:] = [entry for entry in keys if entry not in done]
+            sent += len(chunk)
+            sent_bytes += size
+            logging.info("Transferred %d keys (%d bytes) to %s, %d keys left",
+                         sent, sent_bytes, str(server), len(keys))
+            self.transfer_lock.release()
+
+    def chunks(self,keys,size=100):
+        """ Split `keys` into lists of at most `size` keys
+        """
+        return [keys[i:i+size] for i in xrange(0,len(keys),size)]
 
     def forward_command(self,command):
         """ Forwards `command` to all other servers except this
@@ -182,119 +620,851 @@ class MyDHTServer(CmdApp):
         if not command.forwarded:
             command.forwarded = True
             for server in self.hash_ring.get_nodelist():
-                if self.this_server != server:
-                    remote_status = self.client.sendcommand(server,copy.deepcopy(command))
+                if self.this_server != server and self.is_alive(server):
+                    remote_status = self.client.sendcommand(server,copy.copy(command))
                     logging.debug(remote_status)
         return command
 
     def handle_replica_command(self,command,client_sock):
         """ Handle `command` from `client_sock`
             If the key is found on this server it will be handled here
-            or else it will be forwarded to the first server that is
-            responding.
+            and the command is sent to the other replicas in parallel.
 
+            A write returns when `write_quorum` replicas (including this
+            server) have answered, the other replicas finish in the background.
+            A GET returns when `read_quorum` replicas have returned the
+            value, or all have answered, the newest value wins.
             If it is a `DHTCommand.GET` and the key is found locally
-            no other servers will be contacted.
+            (and the read quorum is 1) no other servers will be contacted,
+            or else the fastest replicas are asked, see `read_from_replicas`.
+            A PUT value of at least `stream_threshold` bytes is spooled to
+            a temporary file and sent to the replicas while it is received.
         """
         # Find out where the key is found
         key_is_at = self.hash_ring.get_replicas(command.key)
         replica_servers = " ".join(map(lambda msg: str(msg), key_is_at))
         logging.debug("%s is at [%s] according to [%s]", command.key, replica_servers, str(self.hash_ring))
+        if command.action == DHTCommand.GET:
+            quorum = min(self.read_quorum,len(key_is_at))
+        else:
+            quorum = min(self.write_quorum or len(key_is_at) / 2 + 1,len(key_is_at))
 
         # If key is local, remove this server from replicas
         local = (self.this_server in key_is_at)
         if local:
             key_is_at.remove(self.this_server)
+        # Replicas that are known to be dead are not asked
+        dead = [server for server in key_is_at if not self.is_alive(server)]
+        key_is_at = filter(self.is_alive,key_is_at)
 
+        # Connections to replicas that the value has been streamed to
+        sockets = None
         # If the command is PUT, download the data
         if command.action == DHTCommand.PUT:
-            command.value = self.client.read_from_socket(command.size,client_sock)
+            if command.size < self.stream_threshold:
+                command.value = self.client.read_from_socket(command.size,client_sock)
+                if len(command.value) < command.size:
+                    return "ERR_INCOMPLETE_VALUE"
+            elif command.forwarded:
+                command.value = self.spool_value(command.size,client_sock)
+            else:
+                command.value, sockets = self.stream_value(command,key_is_at,client_sock)
+            if command.value is None:
+                return "ERR_INCOMPLETE_VALUE"
+
+        # A forwarded command is only performed here, the sender
+        # thinks that this server is a replica
+        if command.forwarded:
+            if command.action == DHTCommand.GET:
+                # Answer with the timestamp of the value so that the newest wins
+                value, timestamp = self.dht_table.get(command.key,self.stream_threshold)
+                if value is None:
+                    return "ERR_VALUE_NOT_FOUND"
+                command.timestamp = timestamp
+                return value
+            return self.dht_table.perform(command)
 
-        # If key is on this server, perform the action, if it was a get return immediately
+        # (status, timestamp) for every replica that has answered
+        responses = []
         if local:
-            status = self.dht_table.perform(command)
-            if command.action == DHTCommand.GET and status != "ERR_VALUE_NOT_FOUND":
-                return status
+            if command.action != DHTCommand.GET:
+                status = self.dht_table.perform(command)
+                responses.append((status,command.timestamp))
+            else:
+                # Large values are streamed from the storage
+                value, timestamp = self.dht_table.get(command.key,self.stream_threshold)
+                if value is not None:
+                    responses.append((value,timestamp))
+        # The dead replicas get the write when they answer again
+        for server in dead:
+            self.replica_failed(server,command)
 
-        # Replicate data to other nodes if it was not a GET command and the command was not already forwarded
-        failures = 0
-        if not command.forwarded:
+        # Send to the other replicas, a GET only asks the
+        # other replicas if the read quorum isn't met
+        if key_is_at and command.action == DHTCommand.GET:
+            if local and self.key_filters:
+                # The replicas that definitely don't have the key are only
+                # asked if too few may have it, the fastest first
+                key_is_at = self.key_filters.select(self.latencies.order(key_is_at),command.key,
+                                                    quorum - len(responses))
+            if key_is_at and len(responses) < quorum:
+                command.forwarded = True
+                responses += self.read_from_replicas(command,key_is_at,quorum - len(responses),responses)
+        elif key_is_at:
             command.forwarded = True
-            for server in key_is_at:
-                response = self.client.sendcommand(server,copy.deepcopy(command))
-                if response:
-                    status = response
-                    
-                    if command.action != DHTCommand.GET:
-                        logging.debug("remote status: %s", status)
-
-                    # If this was a get and the response is valid, return
-                    if command.action == DHTCommand.GET  and status != "ERR_VALUE_NOT_FOUND":
-                        return status
-                else:
-                    failures += 1
-
-        logging.debug("Performed command %s (failures: %d)", command, failures)
+            responses += self.send_to_replicas(command,key_is_at,quorum - len(responses),sockets)
+
+        if command.action == DHTCommand.GET:
+            # Return the newest value
+            status = "ERR_VALUE_NOT_FOUND"
+            if responses:
+                status, command.timestamp = max(responses,key=lambda response: response[1])
+        elif len(responses) < quorum:
+            logging.error("Write quorum not met for %s: %d of %d", command, len(responses), quorum)
+            status = "ERR_QUORUM_NOT_MET"
+        else:
+            status = responses[0][0]
+
+        logging.debug("Performed command %s (answers: %d, quorum: %d)", command, len(responses), quorum)
         return status
 
-    def server_thread(self,client_sock):
+    def get_if_newer(self,command,client_sock):
+        """ Perform `command` as a GET but return NOT_MODIFIED if the value
+            isn't newer than the timestamp of `command`, the timestamp of
+            the copy that the client has
+        """
+        since = command.timestamp
+        command.action = DHTCommand.GET
+        status = self.handle_replica_command(command,client_sock)
+        if status != "ERR_VALUE_NOT_FOUND" and command.timestamp <= since:
+            if hasattr(status,"close"):
+                status.close()
+            status = "NOT_MODIFIED"
+        return status
+
+    def spool_value(self,size,client_sock):
+        """ Read a value of `size` bytes from `client_sock` into a
+            temporary file and return it, None if the client closed the
+            connection before the whole value was sent
+        """
+        spool = tempfile.SpooledTemporaryFile(self.stream_threshold)
+        self.client.read_from_socket(size,client_sock,spool)
+        if spool.tell() < size:
+            logging.error("Client closed the connection after %d of %d bytes", spool.tell(), size)
+            spool.close()
+            return None
+        return spool
+
+    def stream_value(self,command,servers,client_sock):
+        """ Read the value of a PUT `command` from `client_sock` into a
+            temporary file and send every chunk to all `servers` as it
+            arrives. Returns (file, sockets) where `sockets` is a dictionary
+            str(server) -> socket of the servers that got the whole value,
+            their responses have not been read.
+            (None, None) is returned if the client closed the connection
+            before the whole value was sent.
+        """
+        replica_command = copy.copy(command)
+        replica_command.forwarded = True
+        sockets = {}
+        for server in servers:
+            try:
+                sock = self.client.connect(server)[0]
+            except socket_error:
+                logging.error("Could not stream %s to %s", command, str(server))
+                continue
+            try:
+                self.client.send_header(replica_command,sock)
+                sockets[str(server)] = sock
+            except socket_error:
+                logging.error("Could not stream %s to %s", command, str(server))
+                sock.close()
+
+        spool = tempfile.SpooledTemporaryFile(self.stream_threshold)
+        received = 0
+        while received < command.size:
+            chunk = client_sock.recv(min(65536,command.size - received))
+            if not chunk:
+                break
+            received += len(chunk)
+            spool.write(chunk)
+            for server, sock in sockets.items():
+                try:
+                    sock.sendall(chunk)
+                except socket_error:
+                    logging.error("Streaming %s to %s failed", command, server)
+                    sock.close()
+                    del sockets[server]
+
+        if received < command.size:
+            logging.error("Client closed the connection after %d of %d bytes", received, command.size)
+            for sock in sockets.values():
+                sock.close()
+            spool.close()
+            return None, None
+        return spool, sockets
+
+    def send_to_replicas(self,command,servers,needed,sockets=None):
+        """ Send a copy of `command` to all `servers` in parallel and wait
+            until `needed` servers have answered, all have answered or
+            `request_timeout` has passed. A GET only counts as an answer
+            if the value was found.
+            If `sockets` is not None the command has already been sent
+            to the servers in it and only the response is read, the other
+            servers have failed.
+            Returns a list of (status, timestamp) of the answers so far,
+            the remaining servers are handled in the background.
+        """
+        if self.event_server:
+            return self.multiplex_to_replicas(command,servers,needed,sockets)
+        answers = Queue.Queue()
+        for server in servers:
+            if sockets is None:
+                thread.start_new_thread(self.replica_thread,(server,copy.copy(command),answers))
+            elif str(server) in sockets:
+                thread.start_new_thread(self.replica_response_thread,(server,command,sockets[str(server)],answers))
+            else:
+                self.replica_failed(server,command)
+                answers.put((None,None))
+
+        responses = []
+        finished = 0
+        deadline = time.time() + self.request_timeout
+        while len(responses) < needed and finished < len(servers):
+            try:
+                status, timestamp = answers.get(True,max(deadline - time.time(),0))
+            except Queue.Empty:
+                logging.error("Timeout waiting for replicas of %s", command)
+                break
+            finished += 1
+            if status is None:
+                continue
+            if command.action == DHTCommand.GET and status == "ERR_VALUE_NOT_FOUND":
+                continue
+            responses.append((status,timestamp))
+        return responses
+
+    def multiplex_to_replicas(self,command,servers,needed,sockets=None):
+        """ Same as `send_to_replicas` but without a thread per replica,
+            used with the event loop. The command is sent to all servers
+            and the responses are read as they arrive. The responses that
+            are not needed are read by the event loop.
+        """
+        if sockets is None:
+            sockets = {}
+            for server in servers:
+                sock = self.client.send_request(server,copy.copy(command))
+                if sock is not None:
+                    sockets[str(server)] = sock
+        for server in servers:
+            if str(server) not in sockets:
+                self.replica_failed(server,command)
+
+        # fd -> (server, socket) of the replicas that haven't answered
+        pending = {}
+        poller = Poller()
+        for server in servers:
+            if str(server) in sockets:
+                sock = sockets[str(server)]
+                pending[sock.fileno()] = (server,sock)
+                poller.register(sock.fileno())
+
+        responses = []
+        deadline = time.time() + self.request_timeout
+        try:
+            while pending and len(responses) < needed:
+                readable = poller.poll(max(deadline - time.time(),0))
+                if not readable:
+                    logging.error("Timeout waiting for replicas of %s", command)
+                    for server, sock in pending.values():
+                        self.client.breakers.failure(server)
+                    break
+                for fd in readable:
+                    server, sock = pending.pop(fd)
+                    poller.unregister(fd)
+                    try:
+                        status, timestamp = self.client.read_response(server,sock)
+                    except socket_error:
+                        errno, errstr = sys.exc_info()[:2]
+                        logging.error("No response from %s: %s", str(server), errstr)
+                        sock.close()
+                        self.client.breakers.failure(server)
+                        self.replica_failed(server,command)
+                        continue
+                    if command.action == DHTCommand.GET and status == "ERR_VALUE_NOT_FOUND":
+                        continue
+                    responses.append((status,timestamp))
+        finally:
+            poller.close()
+        for server, sock in pending.values():
+            self.event_server.drain(server,sock,command)
+        return responses
+
+    def read_from_replicas(self,command,servers,needed,local=[]):
+        """ Send a GET `command` to the `servers` with the lowest average
+            response time first and return (value, timestamp) of the first
+            `needed` that have the key. The next server is asked when one
+            doesn't have the key or doesn't answer, and with `speculative`
+            also when the asked servers haven't answered within the 95th
+            percentile of their response times.
+            Servers that answered with an older version than the newest
+            (or this server, `local` is its (value, timestamp) if it has
+            the key) are repaired in the background.
+        """
+        waiting = self.latencies.order(servers)
+        # fd -> (server, socket, time sent) of the servers that haven't answered
+        pending = {}
+        poller = Poller()
+        def ask_next():
+            while waiting:
+                server = waiting.pop(0)
+                sock = self.client.send_request(server,copy.copy(command))
+                if sock is not None:
+                    pending[sock.fileno()] = (server,sock,time.time())
+                    poller.register(sock.fileno())
+                    return
+                self.latencies.add(server,self.request_timeout)
+
+        responses = []
+        # (server, timestamp) of the versions that were returned
+        versions = []
+        deadline = time.time() + self.request_timeout
+        try:
+            for i in range(needed):
+                ask_next()
+            while pending and len(responses) < needed:
+                timeout = deadline - time.time()
+                if self.speculative and waiting:
+                    timeout = min(timeout,self.speculation_delay(pending.values()))
+                readable = poller.poll(max(timeout,0))
+                if not readable:
+                    if time.time() >= deadline:
+                        logging.error("Timeout waiting for replicas of %s", command)
+                        for server, sock, sent in pending.values():
+                            self.client.breakers.failure(server)
+                        break
+                    logging.debug("Speculative read of %s", command)
+                    ask_next()
+                    continue
+                for fd in readable:
+                    server, sock, sent = pending.pop(fd)
+                    poller.unregister(fd)
+                    try:
+                        status, timestamp = self.client.read_response(server,sock)
+                    except socket_error:
+                        errno, errstr = sys.exc_info()[:2]
+                        logging.error("No response from %s: %s", str(server), errstr)
+                        sock.close()
+                        self.client.breakers.failure(server)
+                        self.latencies.add(server,self.request_timeout)
+                        ask_next()
+                        continue
+                    self.latencies.add(server,time.time() - sent)
+                    if status == "ERR_VALUE_NOT_FOUND":
+                        ask_next()
+                        continue
+                    responses.append((status,timestamp))
+                    versions.append((server,timestamp))
+        finally:
+            poller.close()
+
+        for server, sock, sent in pending.values():
+            # At least this slow, the response is read in the background
+            self.latencies.add(server,time.time() - sent)
+            if self.event_server:
+                self.event_server.drain(server,sock,command)
+            else:
+                thread.start_new_thread(self.replica_response_thread,(server,command,sock,Queue.Queue()))
+
+        if local:
+            versions += [(self.this_server,timestamp) for value, timestamp in local]
+        if len(versions) > 1:
+            self.read_repair(command.key,max(responses + local,key=lambda response: response[1]),versions)
+        return responses
+
+    def speculation_delay(self,pending):
+        """ Returns the seconds until one of the `pending` (server, socket,
+            time sent) requests has waited longer than the 95th percentile
+            of the response times of its server
+        """
+        now = time.time()
+        delays = []
+        for server, sock, sent in pending:
+            percentile = self.latencies.percentile(server)
+            if percentile is not None:
+                delays.append(sent + percentile - now)
+        return delays and min(delays) or self.request_timeout
+
+    def read_repair(self,key,newest,versions):
+        """ Send the `newest` (value, timestamp) of `key` to the servers in
+            the (server, timestamp) `versions` that have an older version,
+            in the background. Values that are streamed are left to BALANCE.
+        """
+        value, timestamp = newest
+        stale = [server for server, version in versions if version < timestamp]
+        if stale and isinstance(value,str):
+            logging.debug("Repairing %s on %s", key, ", ".join(map(str,stale)))
+            thread.start_new_thread(self.repair,(key,value,timestamp,stale))
+
+    def repair(self,key,value,timestamp,servers):
+        """ Put `value` with `timestamp` at `key` on `servers`
+        """
+        for server in servers:
+            command = DHTCommand(DHTCommand.PUT,key,value,timestamp)
+            command.forwarded = True
+            if server == self.this_server:
+                self.dht_table.perform(command)
+            elif self.client.sendcommand(server,command) is None:
+                logging.error("Could not repair %s on %s", key, str(server))
+
+    def replica_thread(self,server,command,answers):
+        """ Send `command` to `server` and put (status, timestamp) in `answers`
+            status is None if the server did not respond.
+        """
+        status, timestamp = self.client.request(server,command)
+        if status is None:
+            self.replica_failed(server,command)
+        elif command.action != DHTCommand.GET:
+            logging.debug("remote status from %s: %s", str(server), status)
+        answers.put((status,timestamp))
+
+    def replica_response_thread(self,server,command,sock,answers):
+        """ Read the response of `server` to `command` on `sock` and put
+            (status, timestamp) in `answers`, status is None if the server
+            did not respond.
+        """
+        try:
+            answers.put(self.client.read_response(server,sock))
+        except socket_error:
+            errno, errstr = sys.exc_info()[:2]
+            logging.error("No response from %s: %s", str(server), errstr)
+            sock.close()
+            self.replica_failed(server,command)
+            answers.put((None,None))
+
+    def replica_failed(self,server,command):
+        """ A PUT or DEL `command` could not be sent to the replica `server`,
+            keep a hint so that it is sent when the replica answers again
+        """
+        if self.hints is not None and command is not None and command.action in [DHTCommand.PUT,DHTCommand.DEL]:
+            self.hints.add(server,command.action,command.key,command.value,command.timestamp)
+
+    def handle_batch_command(self,command,client_sock):
+        """ Handle a MGET, MPUT or MDEL `command` from `client_sock`
+            The keys are grouped by replica server so that every server
+            only gets one sub-batch. Keys that are local are performed here.
+            A MGET asks the next replica of every key that wasn't found
+            until all keys are found or there are no replicas left.
+            Returns a batch with the status (or value) of every key.
+        """
+        action = DHTCommand.BATCH_COMMANDS[command.action]
+        entries = unpack_batch(self.client.read_from_socket(command.size,client_sock))
+        # key -> (status, timestamp)
+        results = {}
+
+        # Forwarded batches are only performed locally
+        if command.forwarded:
+            results = self.perform_local_batch(command.action,entries,True)
+            return pack_batch([(key,) + results.get(key,("ERR_WORKER_FAILED",0.0)) for key, value, timestamp in entries])
+
+        replicas = {}
+        local = []
+        for key, value, timestamp in entries:
+            key_is_at = self.hash_ring.get_replicas(key)
+            if self.this_server in key_is_at:
+                key_is_at.remove(self.this_server)
+                local.append((key,value,timestamp))
+            replicas[key] = filter(self.is_alive,key_is_at)
+        results.update(self.perform_local_batch(command.action,local))
+
+        if action == DHTCommand.GET:
+            # Ask the next replica for every key that is still missing
+            missing = lambda entry: results.get(entry[0],("ERR_VALUE_NOT_FOUND",))[0] == "ERR_VALUE_NOT_FOUND"
+            pending = filter(missing,entries)
+            replica = 0
+            while pending:
+                groups = self.group_batch(pending,replicas,replica)
+                if not groups:
+                    break
+                for key, status, timestamp in self.send_batch_groups(command.action,groups):
+                    if status != "ERR_VALUE_NOT_FOUND" or key not in results:
+                        results[key] = (status,timestamp)
+                pending = filter(missing,pending)
+                replica += 1
+        else:
+            # Send every entry to all replicas
+            groups = {}
+            for replica in xrange(0,self.hash_ring.replicas):
+                for server, group in self.group_batch(entries,replicas,replica).iteritems():
+                    groups.setdefault(server,(group[0],[]))[1].extend(group[1])
+            for key, status, timestamp in self.send_batch_groups(command.action,groups):
+                # The local status wins over remote status
+                results.setdefault(key,(status,timestamp))
+
+        logging.debug("Performed batch %s with %d keys", command, len(entries))
+        # Keys where no replica answered
+        failed = action == DHTCommand.GET and "ERR_VALUE_NOT_FOUND" or "ERR_NO_REPLICA"
+        return pack_batch([(key,) + results.get(key,(failed,0.0)) for key, value, timestamp in entries])
+
+    def perform_local_batch(self,batch_action,entries,forwarded=False):
+        """ Perform the (key, value, timestamp) `entries` of a batch on this
+            node and return a dictionary with key -> (status, timestamp).
+            The entries of other worker processes are sent to them as
+            one forwarded batch per worker.
+            The entries of a `forwarded` batch (a transfer, a hint or a
+            replica's part of a batch) don't replace newer values.
+        """
+        action = DHTCommand.BATCH_COMMANDS[batch_action]
+        results = {}
+        # worker -> entries
+        groups = {}
+        for key, value, timestamp in entries:
+            worker = self.partitioning and self.partitioning.worker_for(key) or 0
+            if worker != self.worker:
+                groups.setdefault(worker,[]).append((key,value,timestamp))
+            else:
+                results[key] = self.perform_batch_entry(action,key,value,timestamp,forwarded)
+        for worker, group in groups.iteritems():
+            command = DHTCommand(batch_action,"",pack_batch(group))
+            command.forwarded = True
+            response = self.sibling_client.sendcommand(self.siblings[worker],command)
+            if response is None:
+                logging.error("Batch to worker %d failed", worker)
+                continue
+            for key, status, timestamp in unpack_batch(response):
+                results[key] = (status,timestamp)
+        return results
+
+    def perform_batch_entry(self,action,key,value,timestamp,forwarded=False):
+        """ Perform `action` for a single key in a batch on the local table
+            and return (status, timestamp).
+        """
+        command = DHTCommand(action,key,value,timestamp)
+        command.forwarded = forwarded
+        status = self.dht_table.perform(command)
+        if action == DHTCommand.GET and status != "ERR_VALUE_NOT_FOUND":
+            timestamp = float(self.dht_table.perform(DHTCommand(DHTCommand.HASKEY,key)))
+        return status, timestamp
+
+    def group_batch(self,entries,replicas,replica):
+        """ Group `entries` by the `replica`:th server in `replicas`
+            Returns a dictionary with str(server) -> (server, entries)
+        """
+        groups = {}
+        for entry in entries:
+            key_is_at = replicas[entry[0]]
+            if replica < len(key_is_at):
+                server = key_is_at[replica]
+                groups.setdefault(str(server),(server,[]))[1].append(entry)
+        return groups
+
+    def send_batch_groups(self,action,groups):
+        """ Send one forwarded batch per server in `groups`
+            and return all (key, status, timestamp) in the responses.
+        """
+        results = []
+        for server, entries in groups.itervalues():
+            command = DHTCommand(action,"",pack_batch(entries))
+            command.forwarded = True
+            response = self.client.sendcommand(server,command)
+            if response is None:
+                logging.error("Batch to %s failed", str(server))
+                if action != DHTCommand.MGET:
+                    for key, value, timestamp in entries:
+                        self.replica_failed(server,DHTCommand(DHTCommand.BATCH_COMMANDS[action],key,value,timestamp))
+                continue
+            results.extend(unpack_batch(response))
+        return results
+
+    def server_thread(self,client_sock,sibling=False):
         """ Thread that handles a client
             `client_sock` is the socket where the client is connected
             perform the operation and connect to another server if necessary
+            If the client asks for keepalive the thread keeps reading
+            commands from the socket until the client closes it or it has
+            been idle for `keepalive_timeout` seconds.
+            Both the binary and the old padded protocol are accepted,
+            the response is sent with the protocol of the command.
+            `sibling` is True for connections from the other worker
+            processes of this node.
         """
-        rawcommand = self.client.read_from_socket(_block,client_sock)
-        command = DHTCommand().parse(rawcommand)
+        command = self.client.read_command(client_sock)
+        while command:
+            if command.request_id is not None:
+                # The client pipelines its commands, they are performed
+                # at the same time and answered in any order
+                self.serve_pipeline(command,client_sock,sibling)
+                return
+            command.sibling = sibling
+            if not self.handle_request(command,client_sock):
+                break
 
+            # Wait for the next command on this connection
+            client_sock.settimeout(self.keepalive_timeout)
+            try:
+                command = self.client.read_command(client_sock)
+            except (socket_error, timeout):
+                command = None
+            client_sock.settimeout(None)
+
+        try:
+            # Shutdown write end of socket
+            client_sock.shutdown(SHUT_WR)
+        except socket_error:
+            pass
+        # Close socket
+        client_sock.close()
+
+    def handle_request(self,command,client_sock,lock=None):
+        """ Handle `command` from `client_sock` and send the response
+            Returns True if the connection should be kept for
+            the next command.
+            `lock` is held while the response is sent if the
+            connection is shared with other commands.
+        """
         logging.debug("received command: %s", str(command))
+        if command.action == DHTCommand.UNKNOWN:
+            # Just send error and close socket
+            if command.binary:
+                self.send_response("UNKNOWN_COMMAND",command,client_sock,lock)
+            else:
+                client_sock.send("UNKNOWN_COMMAND")
+            return False
+
+        # Only some commands use the value, skip it for other commands so that
+        # the next command on a keepalive connection is read correctly
+        if command.action not in DHTCommand.VALUE_COMMANDS and command.size:
+            self.client.read_from_socket(command.size,client_sock)
+            command.size = 0
+
+        status = self.handle_command(command,client_sock)
+
+        # Send response to client
+        self.send_response(status,command,client_sock,lock)
+        if hasattr(status,"close"):
+            # A value that was streamed from the storage
+            status.close()
+        return command.keepalive
+
+    def serve_pipeline(self,command,client_sock,sibling=False):
+        """ Serve a connection where the client sends commands with request
+            ids, starting with `command`, see `PipelineHandler`. The commands
+            of all such connections are performed by `pipeline_workers`.
+        """
+        PipelineHandler(self,client_sock,self.pipeline_workers,sibling).serve(command)
+
+    def send_response(self,status,command,client_sock,lock=None):
+        """ Send `status` as the response to `command`, holding `lock`
+        """
+        if lock is None:
+            self.client.send_response(status,command,client_sock)
+            return
+        lock.acquire()
+        try:
+            self.client.send_response(status,command,client_sock)
+        finally:
+            lock.release()
+
+    def handle_command(self,command,client_sock):
+        """ Perform `command` and return the status that
+            should be sent back to the client on `client_sock`
+            With worker processes a command for a key is performed by
+            the worker that has the key, and commands that change the
+            ring or work on all keys are sent to all workers.
+        """
+        if self.partitioning and command.action in [DHTCommand.PUT,DHTCommand.GET,DHTCommand.DEL,
+                                                    DHTCommand.HASKEY,DHTCommand.HTTPGETKEY,
+                                                    DHTCommand.GETIFNEWER]:
+            worker = self.partitioning.worker_for(command.key)
+            if worker != self.worker:
+                return self.proxy_command(command,client_sock,worker)
+        relays = []
+        if not command.sibling and command.action in [DHTCommand.BALANCE,DHTCommand.PURGE]:
+            relays = self.relay_to_siblings(command)
+
         if command.action in [DHTCommand.PUT,DHTCommand.GET,DHTCommand.DEL]:
             # Perform the command and any replication
             status = self.handle_replica_command(command,client_sock)
+        elif command.action == DHTCommand.GETIFNEWER:
+            # A client that has a copy of the value only wants a newer value
+            status = self.get_if_newer(command,client_sock)
+        elif command.action in DHTCommand.BATCH_COMMANDS:
+            # Perform all keys in the batch and any replication
+            status = self.handle_batch_command(command,client_sock)
         elif command.action == DHTCommand.JOIN:
             # A client wants to join the ring
             status = self.add_new_node(command.key)
         elif command.action == DHTCommand.ADDNODE:
             # A new client has joined and should be added to this servers ring
-            self.hash_ring.add_node(command.key)
+            self.change_ring(Server.fromstring(command.key),True,notify=False,relay=not command.sibling)
             status = "added by "+str(self.this_server)
+        elif command.action == DHTCommand.LEAVE and command.sibling and command.key == str(self.this_server):
+            # The supervisor stops this node, the first worker tells the other nodes
+            self.decommission(self.worker == 0)
+            status = "LEAVE ok"
         elif command.action == DHTCommand.LEAVE:
-            self.hash_ring.remove_node(command.key)
+            self.change_ring(Server.fromstring(command.key),False,notify=False,relay=not command.sibling)
             status = "removed: "+str(command.key)
         elif command.action == DHTCommand.REMOVE:
-            # A server has left the ring without decommission
-            status = self.remove_node(command.key,command.forwarded)
+            # A server has left the ring without decommission, the workers
+            # of this node get the change with the ring events
+            status = self.remove_node(command.key,command.forwarded or command.sibling)
         elif command.action == DHTCommand.WHEREIS:
             # Just return the hostnames that holds a key
             status = ", ".join(map(lambda s: str(s), self.hash_ring.get_replicas(command.key)))
+        elif command.action == DHTCommand.RING:
+            # Return the ring so that a client can send keys to their replicas
+            status = self.hash_ring.tostring()
+        elif command.action == DHTCommand.RINGDELTA:
+            # Another node or worker sends the ring events this node may lack
+            # and gets the events from the epoch in the key
+            events = self.client.read_from_socket(command.size,client_sock)
+            status = HashRing.pack_events(self.hash_ring.get_events(int(command.key or 0)))
+            self.apply_ring_events(HashRing.unpack_events(events),command.sibling)
+        elif command.action == DHTCommand.PING:
+            # Another node checks that this node is alive and sends the states it knows
+            states = self.client.read_from_socket(command.size,client_sock)
+            status = self.gossip and self.gossip.receive(states) or ""
+        elif command.action == DHTCommand.PINGREQ:
+            # Another node can't reach the node in the key, try from here
+            states = self.client.read_from_socket(command.size,client_sock)
+            status = "ERR_NO_RESPONSE"
+            if self.gossip:
+                self.gossip.merge(states)
+                if self.gossip.ping(Server.fromstring(command.key)):
+                    status = "PING ok"
+        elif command.action == DHTCommand.BLOOM:
+            # Another node sends the filter of its keys, all workers of this node use it
+            command.value = self.client.read_from_socket(command.size,client_sock)
+            if self.key_filters:
+                self.key_filters.receive(command.key,command.value,command.epoch)
+            if not command.sibling:
+                relays = self.relay_to_siblings(command)
+            status = "BLOOM ok"
         elif command.action == DHTCommand.BALANCE:
             # Load balance this node
-            status = self.load_balance(command.forwarded)
-        elif command.action == DHTCommand.UNKNOWN:
-            # Just send error and close socket
-            status = "UNKNOWN_COMMAND"
-            client_sock.send(status)
-            client_sock.close()
-            return
+            status = self.load_balance(command.forwarded or command.sibling)
+        elif command.action == DHTCommand.MERKLE:
+            # Return the hashes of the requested nodes in the tree for the sender
+            nodes = self.client.read_from_socket(command.size,client_sock).split()
+            hashes = self.get_tree_hashes(Server.fromstring(command.key),map(int,nodes),command.sibling)
+            status = hashes is None and "ERR_WORKER_FAILED" or " ".join(hashes)
+        elif command.action == DHTCommand.MERKLEKEYS:
+            # Return the keys and timestamps in the requested leaves of the tree for the sender
+            leaves = self.client.read_from_socket(command.size,client_sock).split()
+            items = self.get_tree_items(Server.fromstring(command.key),map(int,leaves),command.sibling)
+            status = pack_batch([(key,None,timestamp) for key, timestamp in items])
         else:
             # All other commands ends up in the table
             status = self.dht_table.perform(command)
 
-        # Send length to all clients except a web browser (it will end up in the HTML)
-        if command.action != DHTCommand.HTTPGET and command.action != DHTCommand.HTTPGETKEY:
-            self.client.send_length_to_socket(len(status),client_sock)
+        for relay in relays:
+            relay.join()
+        return status
 
-        # Send response to client
-        self.client.send_to_socket(status,len(status),client_sock)
+    def proxy_command(self,command,client_sock,worker):
+        """ Send a `command` for a key to the worker process `worker` that
+            has the key and return its response, the timestamp of the
+            response is set in `command`. Large responses are returned
+            as a stream of a temporary file.
+        """
+        proxied = copy.copy(command)
+        if command.action == DHTCommand.PUT:
+            if command.size < self.stream_threshold:
+                proxied.value = self.client.read_from_socket(command.size,client_sock)
+                if len(proxied.value) < command.size:
+                    return "ERR_INCOMPLETE_VALUE"
+            else:
+                proxied.value = self.spool_value(command.size,client_sock)
+                if proxied.value is None:
+                    return "ERR_INCOMPLETE_VALUE"
+        spool = tempfile.SpooledTemporaryFile(self.stream_threshold)
+        status, timestamp = self.sibling_client.request(self.siblings[worker],proxied,spool)
+        if hasattr(proxied.value,"close"):
+            proxied.value.close()
+        if status is None:
+            spool.close()
+            return "ERR_WORKER_FAILED"
+        command.timestamp = timestamp
+        size = spool.tell()
+        spool.seek(0)
+        if size < self.stream_threshold:
+            status = spool.read()
+            spool.close()
+            return status
+        return LogValue(spool,0,size)
 
-        # Shutdown write end of socket
-        client_sock.shutdown(SHUT_WR)
-        # Close socket
-        client_sock.close()
+    def relay_to_siblings(self,command):
+        """ Send `command` to the other worker processes of this node in
+            parallel, returns the threads that wait for the answers.
+        """
+        relays = []
+        for worker, address in enumerate(self.siblings):
+            if worker != self.worker:
+                relay = threading.Thread(target=self.sibling_client.sendcommand,args=(address,copy.copy(command)))
+                relay.start()
+                relays.append(relay)
+        return relays
+
+    def get_tree_hashes(self,server,nodes,local=False):
+        """ Returns the hashes of `nodes` in the hash tree of this node for
+            `server`. With worker processes the hashes of subtrees are
+            asked from the worker that has their keys unless `local` is
+            True. Returns None if a worker didn't answer.
+        """
+        if local or not self.partitioning:
+            return self.dht_table.get_tree_hashes(server,nodes)
+        # node -> hash of the subtrees of one worker
+        hashes = {}
+        for worker, subtrees in self.partitioning.split(nodes).iteritems():
+            if worker == self.worker:
+                hashes.update(zip(subtrees,self.dht_table.get_tree_hashes(server,subtrees)))
+                continue
+            command = DHTCommand(DHTCommand.MERKLE,server," ".join(map(str,subtrees)))
+            response = self.sibling_client.sendcommand(self.siblings[worker],command)
+            if response is None or len(response.split()) != len(subtrees):
+                logging.error("Got no hashes from worker %d", worker)
+                return None
+            hashes.update(zip(subtrees,response.split()))
+
+        tree = self.partitioning.tree
+        def node_hash(node):
+            if node not in hashes:
+                hashes[node] = tree.combine(map(node_hash,tree.children(node)))
+            return hashes[node]
+        return map(node_hash,nodes)
+
+    def get_tree_items(self,server,leaves,local=False):
+        """ Returns a list of (key, timestamp) in `leaves` of the hash tree
+            of this node for `server`. With worker processes the keys are
+            asked from the worker that has the leaf unless `local` is True.
+        """
+        if local or not self.partitioning:
+            return self.dht_table.get_tree_items(server,leaves)
+        items = []
+        for worker, worker_leaves in self.partitioning.split(leaves).iteritems():
+            if worker == self.worker:
+                items.extend(self.dht_table.get_tree_items(server,worker_leaves))
+                continue
+            command = DHTCommand(DHTCommand.MERKLEKEYS,server," ".join(map(str,worker_leaves)))
+            response = self.sibling_client.sendcommand(self.siblings[worker],command)
+            if response is None:
+                logging.error("Got no keys from worker %d", worker)
+                continue
+            items.extend((key,timestamp) for key, value, timestamp in unpack_batch(response))
+        return items
 
     def signal_handler(self,signal,frame):
         """ Handle SIGINT by doing decommission.
+            With worker processes the supervisor lets every worker
+            send its keys to their new replicas and then stops them.
         """
         logging.debug("Exiting from SIGINT")
-        self.decommission()
+        if self.pids is not None:
+            self.stop_workers()
+        else:
+            self.decommission()
+            self.close()
         if self.is_process:
             # Exit softly if this is a subprocess
             os._exit(0)
@@ -302,38 +1472,163 @@ class MyDHTServer(CmdApp):
             # Exit hard if standalone
             sys.exit(0)
 
+    def close(self):
+        """ Close the storage and remove the temporary directory
+        """
+        self.dht_table.close()
+        self.hints.storage.close()
+        if self.tempdir:
+            shutil.rmtree(self.tempdir,True)
+
+    def worker_signal_handler(self,signal,frame):
+        """ Handle SIGTERM from the supervisor in a worker process
+        """
+        logging.debug("Worker %d exiting", self.worker)
+        self.close()
+        os._exit(0)
+
+    def start_workers(self,server_socks):
+        """ Fork one worker process for every socket in `server_socks`,
+            they are all bound to the port of this node with SO_REUSEPORT.
+            The workers talk to each other on unix sockets that are
+            bound before the fork so that no command is lost at start.
+            Returns the socket of the worker in a worker process, in the
+            supervisor it only returns when all workers have exited.
+            The worker serves its siblings once its storage is ready,
+            until then their connections wait in the backlog.
+        """
+        self.rundir = tempfile.mkdtemp(prefix="mydht")
+        self.siblings = [WorkerAddress(os.path.join(self.rundir,"worker-%d.sock" % worker))
+                         for worker in range(len(server_socks))]
+        self.partitioning = Partitioning(len(server_socks))
+        sibling_socks = []
+        for address in self.siblings:
+            sibling_sock = socket(AF_UNIX,SOCK_STREAM)
+            sibling_sock.bind(address.bindaddress())
+            sibling_sock.listen(self.backlog)
+            sibling_socks.append(sibling_sock)
+
+        self.pids = {}
+        for worker in range(len(server_socks)):
+            pid = os.fork()
+            if pid == 0:
+                self.pids = None
+                self.worker = worker
+                # Only the supervisor handles SIGINT
+                signal.signal(signal.SIGINT,signal.SIG_IGN)
+                signal.signal(signal.SIGTERM,self.worker_signal_handler)
+                # Connections made by the supervisor must not be shared
+                self.client.pool.close()
+                for other in range(len(server_socks)):
+                    if other != worker:
+                        server_socks[other].close()
+                        sibling_socks[other].close()
+                self.sibling_sock = sibling_socks[worker]
+                return server_socks[worker]
+            self.pids[pid] = worker
+
+        for sock in server_socks + sibling_socks:
+            sock.close()
+        logging.info("Started %d worker processes", len(self.pids))
+        while self.pids:
+            try:
+                pid, status = os.wait()
+            except OSError:
+                # Interrupted by a signal
+                continue
+            worker = self.pids.pop(pid,None)
+            logging.error("Worker %s exited with status %d", worker, status)
+        shutil.rmtree(self.rundir,True)
+        raise RuntimeError("All worker processes have exited")
+
+    def serve_siblings(self,sibling_sock):
+        """ Accept connections from the other processes of this node
+        """
+        while 1:
+            client_sock, client_addr = sibling_sock.accept()
+            thread.start_new_thread(self.server_thread,(client_sock,True))
+
+    def stop_workers(self):
+        """ Decommission this node from the supervisor, every worker sends
+            its keys to their new replicas and then the workers are stopped
+        """
+        pids = self.pids
+        self.pids = {}
+        relays = []
+        for address in self.siblings:
+            command = DHTCommand(DHTCommand.LEAVE,self.this_server)
+            relay = threading.Thread(target=self.sibling_client.sendcommand,args=(address,command))
+            relay.start()
+            relays.append(relay)
+        for relay in relays:
+            relay.join()
+        for pid in pids:
+            try:
+                os.kill(pid,signal.SIGTERM)
+                os.waitpid(pid,0)
+            except OSError:
+                pass
+        shutil.rmtree(self.rundir,True)
+
     def initialise_hashring(self):
         """ Initialize the hash ring.
             If `self.remote_server` is not note, get it from remote_server
             or else just create a new one.
-            Also set the hash_ring in `self.dht_table`
         """
         if self.remote_server:
             remote_host, remote_port = self.remote_server.split(":")
             remote_server = Server(remote_host,remote_port)
             # Send a join command to the existing server
-            command = DHTCommand(DHTCommand.JOIN,self.this_server)
+            command = DHTCommand(DHTCommand.JOIN,self.this_server.tostring())
             ring = self.client.sendcommand(remote_server,command)
             logging.debug("got ring from server: %s", str(ring))
             # Get replicas
             if not ring:
                 raise RuntimeError(("Could not reach server: %s" % str(remote_server)))
-            nodes,replicas = ring.split(",")
-            # Convert |-separated list to Server-instances
-            nodes =  map(lambda server_string: Server(server_string.split(":")[0],server_string.split(":")[1]) ,nodes.split("|"))
-            # Initialize local hash ring
-            self.hash_ring = HashRing(nodes,int(replicas))
-            self.hash_ring.add_node(self.this_server)
+            # Initialize local hash ring, it has this server
+            self.hash_ring = HashRing.fromstring(ring)
+            # Get all events of the ring so that later changes are compared right
+            events = self.client.sendcommand(remote_server,DHTCommand(DHTCommand.RINGDELTA,"0"))
+            for event in HashRing.unpack_events(events or ""):
+                self.hash_ring.apply(event)
         else:
             # First server so this server is added
-            self.hash_ring = HashRing([self.this_server],self.replicas)
+            self.hash_ring = HashRing([self.this_server],self.replicas,self.distribution_points)
+            self.hash_ring.change(self.this_server,True,self.this_server)
+        # The epoch of the ring is sent with every command and response
+        self.client.ring = self.sibling_client.ring = self.hash_ring
 
-        # Initialize the hash map
-        self.dht_table =  MyDHTTable(self.this_server,self.hash_ring)
+    def initialise_storage(self):
+        """ Initialize the storage and `self.dht_table`
+            Every worker process has its own log in a subdirectory
+            of `self.datadir` and its part of the memory limit.
+            The hints for replicas are kept in hints in the same directory.
+        """
+        datadir = self.datadir
+        memory_limit = self.memory_limit
+        if self.siblings:
+            datadir = datadir and os.path.join(datadir,"worker-%d" % self.worker)
+            memory_limit = memory_limit and memory_limit / len(self.siblings)
+        storage = None
+        if datadir:
+            storage = LogStorage(datadir)
+        if memory_limit:
+            if storage is None:
+                # Values only have to be on disk while the server runs
+                self.tempdir = tempfile.mkdtemp(prefix="mydht")
+                storage = LogStorage(self.tempdir,sync=False)
+            storage = TieredStorage(storage,memory_limit)
+        self.dht_table =  MyDHTTable(self.this_server,self.hash_ring,storage)
+        # Hints are kept in the datadir so that they are replayed after a restart
+        self.hints = HintStore(self,datadir and LogStorage(os.path.join(datadir,"hints")))
+        self.hints.start()
 
     def serve(self):
         """ Main server process
-            Starts a new `server_thread` for new clients
+            Starts a new `server_thread` for new clients, or
+            runs the event loop if `eventloop` is set.
+            If `processes` is more than 1 this is done by worker
+            processes and this process supervises them.
         """
         if not self.this_server:
             self.help()
@@ -342,17 +1637,41 @@ class MyDHTServer(CmdApp):
         signal.signal(signal.SIGINT, self.signal_handler)
 
         logging.info("Starting server at %s", str(self.this_server))
-        server_sock = socket(AF_INET,SOCK_STREAM)
         try:
-            server_sock.bind((self.this_server.bindaddress()))
-            server_sock.listen(5)
+            if self.processes > 1:
+                # Every worker process gets its own socket on the port
+                server_socks = [reuseport_socket() for worker in range(self.processes)]
+            else:
+                server_socks = [socket(AF_INET,SOCK_STREAM)]
+            for server_sock in server_socks:
+                server_sock.bind((self.this_server.bindaddress()))
+                server_sock.listen(self.backlog)
 
             # Get hash ring, we want to do this after we know that
             # the socket was free
             self.initialise_hashring()
+            if self.processes > 1:
+                server_sock = self.start_workers(server_socks)
+            self.initialise_storage()
+            if self.sibling_sock:
+                thread.start_new_thread(self.serve_siblings,(self.sibling_sock,))
+            if self.gossip_interval > 0:
+                self.gossip = Gossip(self,self.gossip_interval)
+                self.gossip.start()
+            if self.filter_interval > 0:
+                self.key_filters = KeyFilters(self,self.filter_interval)
+                self.key_filters.start()
+
+            if self.eventloop:
+                self.event_server = EventServer(self,self.event_workers)
+                logging.info("Serving clients from an event loop with %d workers", self.event_workers)
+                self.event_server.serve(server_sock)
 
+            self.pipeline_workers = WorkerPool(self.event_workers)
+            self.pipeline_workers.start()
             while 1:
                 client_sock, client_addr = server_sock.accept()
+                client_sock.setsockopt(IPPROTO_TCP,TCP_NODELAY,1)
                 thread.start_new_thread(self.server_thread, (client_sock,))
         except socket_error:
             errno, errstr = sys.exc_info()[:2]
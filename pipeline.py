@@ -0,0 +1,253 @@
+import itertools
+import logging
+from socket import SHUT_RDWR
+from socket import error as socket_error
+from socket import timeout
+import sys
+import threading
+import traceback
+from dhtcommand import DHTCommand, REQUEST_ID
+from eventserver import BufferedSocket, send_failure
+
+__author__ = 'Johan'
+
+class Future():
+    """ The response of a command that has been sent on `pipeline`
+    """
+    def __init__(self,command,pipeline):
+        self.command = command
+        self.pipeline = pipeline
+        self.response = None
+        self.timestamp = None
+        self._done = threading.Event()
+
+    def set(self,response,timestamp):
+        if self.done():
+            return
+        self.response = response
+        self.timestamp = timestamp
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self,timeout=None):
+        """ Wait at most `timeout` seconds for the response and return it,
+            None if the server didn't answer (like `MyDHTClient.sendcommand`).
+            A command that isn't answered in time is given up, so that
+            it doesn't keep its place in the pipeline.
+        """
+        if not self._done.wait(timeout):
+            self.pipeline.expire(self)
+        return self.response
+
+class Pipeline():
+    """ A connection from `client` (a MyDHTClient) to `server` that has
+        many commands in flight. Every command is sent with a request id
+        (see `DHTCommand.TAGGED`) and the server answers them in the order
+        they are done, a reader thread gives each response to the `Future`
+        of its command. At most `max_in_flight` commands are sent before
+        their responses have been read.
+        If the connection fails all commands in flight get None.
+    """
+    def __init__(self,client,server,max_in_flight=128):
+        self.client = client
+        self.server = server
+        # request id -> Future of the commands in flight
+        self.futures = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(max_in_flight)
+        self.sock = None
+        self.closed = False
+
+    def submit(self,command):
+        """ Send `command` and return its `Future`
+        """
+        future = Future(command,self)
+        self.slots.acquire()
+        self.lock.acquire()
+        try:
+            command.request_id = self.ids.next() & 0xFFFFFFFF
+            self.futures[command.request_id] = future
+            if self.closed:
+                raise socket_error("the pipeline is closed")
+            if self.sock is None:
+                self.open()
+            if not self.client.send_header(command,self.sock,True):
+                self.client.send_value(command,self.sock)
+        except socket_error:
+            errno, errstr = sys.exc_info()[:2]
+            logging.error("Could not send %s to %s: %s", str(command), str(self.server), errstr)
+            self.fail()
+        finally:
+            self.lock.release()
+        return future
+
+    def open(self):
+        """ Connect to the server and start reading the responses
+            Must be called with the lock held.
+        """
+        if not self.client.breakers.allow(self.server):
+            raise socket_error("the server is failing")
+        try:
+            self.sock = self.client.connect(self.server)[0]
+        except socket_error:
+            self.client.breakers.failure(self.server)
+            raise
+        self.sock.settimeout(None)
+        reader = threading.Thread(target=self.reader_thread,args=(self.sock,))
+        reader.daemon = True
+        reader.start()
+
+    def reader_thread(self,sock):
+        try:
+            while 1:
+                length, timestamp = self.client.read_response_header(self.server,sock)
+                tag = self.client.read_from_socket(REQUEST_ID.size,sock)
+                data = self.client.read_from_socket(length,sock)
+                if len(tag) < REQUEST_ID.size or len(data) < length:
+                    raise socket_error("connection closed by server")
+                request_id, = REQUEST_ID.unpack(tag)
+                future = self.futures.pop(request_id,None)
+                if future is None:
+                    logging.debug("Response to an expired request %d from %s", request_id, str(self.server))
+                    continue
+                self.slots.release()
+                future.set(data,timestamp)
+        except socket_error:
+            errno, errstr = sys.exc_info()[:2]
+            if not self.closed:
+                logging.error("Pipeline to %s failed: %s", str(self.server), errstr)
+        self.lock.acquire()
+        if self.sock is sock:
+            self.fail()
+        self.lock.release()
+
+    def fail(self):
+        """ Close the connection and answer None to all commands in flight,
+            the next command opens a new connection.
+            Must be called with the lock held.
+        """
+        if self.sock is not None:
+            # The reader thread is blocked on the socket, shut it down
+            # so that the server sees that it is closed
+            try:
+                self.sock.shutdown(SHUT_RDWR)
+            except socket_error:
+                pass
+            self.sock.close()
+            self.sock = None
+        futures, self.futures = self.futures, {}
+        for future in futures.values():
+            self.slots.release()
+            future.set(None,None)
+
+    def expire(self,future):
+        """ Give up waiting for the response of `future`, it gets None
+        """
+        # The reader thread pops the futures it answers without the lock
+        if self.futures.pop(future.command.request_id,None) is future:
+            self.slots.release()
+            future.set(None,None)
+
+    def close(self):
+        self.lock.acquire()
+        self.closed = True
+        self.fail()
+        self.lock.release()
+
+class PipelineHandler():
+    """ Serves a client connection of `server` (a MyDHTServer) that sends
+        commands with request ids. The connection is read by one thread
+        while the commands are performed by `workers` (a WorkerPool that
+        is shared by the connections), and the responses are sent one at
+        a time in the order the commands are done.
+        A value of at least `stream_threshold` bytes is read by the command
+        itself before the next command is read. At most `max_in_flight`
+        commands are performed at the same time, then the connection
+        isn't read until one is done.
+    """
+    def __init__(self,server,sock,workers,sibling=False,max_in_flight=128):
+        self.server = server
+        self.sock = sock
+        self.workers = workers
+        self.sibling = sibling
+        # Only one response is sent at a time
+        self.lock = threading.Lock()
+        self.slots = threading.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.done = threading.Condition()
+
+    def serve(self,command):
+        """ Perform `command` and the following commands on the connection
+            until the client closes it or it has been idle for
+            `keepalive_timeout` seconds, then the socket is closed.
+        """
+        while command:
+            command.sibling = self.sibling
+            if not self.dispatch(command):
+                break
+            # Wait for the next command on this connection
+            command = None
+            while command is None:
+                self.sock.settimeout(self.server.keepalive_timeout)
+                try:
+                    command = self.server.client.read_command(self.sock)
+                    break
+                except timeout:
+                    if not self.in_flight:
+                        break
+                except socket_error:
+                    break
+            self.sock.settimeout(None)
+
+        self.done.acquire()
+        while self.in_flight:
+            self.done.wait()
+        self.done.release()
+        try:
+            self.sock.shutdown(2)
+        except socket_error:
+            pass
+        self.sock.close()
+
+    def dispatch(self,command):
+        """ Start performing `command`, returns False if the connection
+            should be closed
+        """
+        if command.request_id is None or command.action == DHTCommand.UNKNOWN \
+                or command.size >= self.server.stream_threshold:
+            return self.perform(command,self.sock)
+        value = self.server.client.read_from_socket(command.size,self.sock)
+        if len(value) < command.size:
+            return False
+        self.slots.acquire()
+        self.done.acquire()
+        self.in_flight += 1
+        self.done.release()
+        self.workers.put(self.perform_in_flight,(command,BufferedSocket(self.sock,value)))
+        return True
+
+    def perform(self,command,sock):
+        """ Perform `command` and send the response on `sock`, returns
+            False if the connection should be closed
+        """
+        try:
+            return self.server.handle_request(command,sock,self.lock)
+        except socket_error:
+            logging.debug("Client connection failed: %s", str(command))
+        except Exception:
+            logging.error("Command %s failed: %s", str(command), traceback.format_exc())
+            send_failure(self.server,command,sock,self.lock)
+        return False
+
+    def perform_in_flight(self,command,sock):
+        try:
+            self.perform(command,sock)
+        finally:
+            self.slots.release()
+            self.done.acquire()
+            self.in_flight -= 1
+            self.done.notify_all()
+            self.done.release()
@@ -0,0 +1,927 @@
+import array
+import collections
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+__author__ = 'Johan'
+
+# Size of the chunks when a value is copied from or to a stream
+_chunk = 65536
+
+def stream_size(value):
+    """ Returns the size of `value`, a string or a seekable stream
+    """
+    if isinstance(value,str):
+        return len(value)
+    value.seek(0,os.SEEK_END)
+    size = value.tell()
+    value.seek(0)
+    return size
+
+def sync_directory(path):
+    """ Fsync the directory of `path` so that a file that was created or
+        renamed to `path` is still there after a crash
+    """
+    if os.name == "nt":
+        # Directories can't be opened on Windows
+        return
+    directory = os.open(os.path.dirname(os.path.abspath(path)),os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+class EntryTable():
+    """ A compact map from key to (offset, size, timestamp, flags)
+        The key is mapped to a slot number and the fields are kept in one
+        array per field, so an entry costs one dict item and an int
+        instead of a tuple and one boxed object per field.
+        Slots of removed keys are reused. Callers must lock.
+    """
+    def __init__(self):
+        # key -> slot
+        self._slots = {}
+        self._offsets = array.array("L")
+        self._sizes = array.array("L")
+        self._timestamps = array.array("d")
+        self._flags = array.array("B")
+        # Slots that are free to reuse
+        self._free = array.array("L")
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self,key):
+        return key in self._slots
+
+    def keys(self):
+        return self._slots.keys()
+
+    def items(self):
+        """ Returns a list of (key, (offset, size, timestamp, flags))
+        """
+        return [(key,self.entry(slot)) for key, slot in self._slots.items()]
+
+    def entry(self,slot):
+        return self._offsets[slot], self._sizes[slot], self._timestamps[slot], self._flags[slot]
+
+    def get(self,key):
+        """ Returns (offset, size, timestamp, flags) of `key` or None
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            return None
+        return self.entry(slot)
+
+    def get_timestamp(self,key):
+        slot = self._slots.get(key)
+        if slot is None:
+            return None
+        return self._timestamps[slot]
+
+    def get_size(self,key):
+        slot = self._slots.get(key)
+        if slot is None:
+            return None
+        return self._sizes[slot]
+
+    def set(self,key,offset,size,timestamp,flags=0):
+        """ Add or replace the entry of `key`
+        """
+        slot = self._slots.get(key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = len(self._offsets)
+                self._offsets.append(0)
+                self._sizes.append(0)
+                self._timestamps.append(0.0)
+                self._flags.append(0)
+        self._offsets[slot] = offset
+        self._sizes[slot] = size
+        self._timestamps[slot] = timestamp
+        self._flags[slot] = flags
+        self._slots[key] = slot
+
+    def set_offset(self,key,offset):
+        """ Move the value of `key` to `offset`
+        """
+        self._offsets[self._slots[key]] = offset
+
+    def remove(self,key):
+        """ Remove `key` and return its entry, None if it wasn't found
+        """
+        slot = self._slots.pop(key,None)
+        if slot is None:
+            return None
+        self._free.append(slot)
+        return self.entry(slot)
+
+class MemoryStorage():
+    """ Keeps all values and timestamps in memory.
+        This is the default storage of `MyDHTTable`.
+
+        A storage maps a key to a value and the timestamp of the value.
+        Values are strings, `put` also accepts a seekable stream.
+        Every method locks the storage, so reads don't need the
+        lock of the table.
+
+        The entries are kept in an `EntryTable` and the values are packed
+        into arenas of `arena_size` bytes instead of one string object per
+        value. Values larger than a quarter of an arena are kept as strings.
+        The arenas are compacted when more than half of them is garbage.
+    """
+    # Flag for values that are kept as strings outside the arenas
+    LARGE = 1
+
+    def __init__(self,arena_size=1024*1024):
+        self.arena_size = arena_size
+        self._entries = EntryTable()
+        self._arenas = []
+        # Next free position in the last arena
+        self._position = arena_size
+        # key -> value of large values
+        self._large = {}
+        # Bytes in the arenas that belong to live and to removed values
+        self._used = 0
+        self._garbage = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self,key):
+        return key in self._entries
+
+    def keys(self):
+        self._lock.acquire()
+        try:
+            return self._entries.keys()
+        finally:
+            self._lock.release()
+
+    def get(self,key):
+        """ Returns the value of `key` or None
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            offset, size, timestamp, flags = entry
+            if flags & self.LARGE:
+                return self._large[key]
+            return self.read(self._arenas,offset,size)
+        finally:
+            self._lock.release()
+
+    def open(self,key):
+        """ Returns the value of `key` as a stream with a length,
+            the value is already in memory so it is returned as a string.
+        """
+        return self.get(key)
+
+    def get_timestamp(self,key):
+        """ Returns the timestamp of `key` or None
+        """
+        self._lock.acquire()
+        try:
+            return self._entries.get_timestamp(key)
+        finally:
+            self._lock.release()
+
+    def get_size(self,key):
+        """ Returns the size of the value of `key` or None
+        """
+        self._lock.acquire()
+        try:
+            return self._entries.get_size(key)
+        finally:
+            self._lock.release()
+
+    def read(self,arenas,offset,size):
+        """ Returns `size` bytes at `offset` in `arenas`
+        """
+        start = offset % self.arena_size
+        return str(buffer(arenas[offset / self.arena_size],start,size))
+
+    def write(self,value):
+        """ Write `value` to the arenas and return its offset
+            Must be called with the lock held.
+        """
+        if not self._arenas or self._position + len(value) > self.arena_size:
+            self._arenas.append(bytearray(self.arena_size))
+            self._position = 0
+        offset = (len(self._arenas) - 1) * self.arena_size + self._position
+        self._arenas[-1][self._position:self._position + len(value)] = value
+        self._position += len(value)
+        self._used += len(value)
+        return offset
+
+    def free(self,key,entry):
+        """ Free the value of `key` with `entry`
+            Must be called with the lock held.
+        """
+        offset, size, timestamp, flags = entry
+        if flags & self.LARGE:
+            del self._large[key]
+        else:
+            self._used -= size
+            self._garbage += size
+
+    def put(self,key,value,timestamp):
+        """ Store `value` with `timestamp` at `key` and return
+            a sequence number that can be given to `commit`
+        """
+        if not isinstance(value,str):
+            value.seek(0)
+            value = value.read()
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.free(key,entry)
+            if len(value) > self.arena_size / 4:
+                self._large[key] = value
+                self._entries.set(key,0,len(value),timestamp,self.LARGE)
+            else:
+                self._entries.set(key,self.write(value),len(value),timestamp)
+            if self._garbage > self.arena_size and self._garbage > self._used:
+                self.compact()
+        finally:
+            self._lock.release()
+        return 0
+
+    def delete(self,key):
+        """ Remove `key` and return a sequence number that can be
+            given to `commit`, None if the key wasn't found.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.remove(key)
+            if entry is None:
+                return None
+            self.free(key,entry)
+            return 0
+        finally:
+            self._lock.release()
+
+    def compact(self):
+        """ Copy all values in the arenas to new arenas
+            Must be called with the lock held.
+        """
+        arenas = self._arenas
+        self._arenas = []
+        self._position = self.arena_size
+        self._used = 0
+        self._garbage = 0
+        for key, (offset, size, timestamp, flags) in self._entries.items():
+            if not flags & self.LARGE:
+                self._entries.set_offset(key,self.write(self.read(arenas,offset,size)))
+
+    def commit(self,sequence):
+        """ Memory is never written to disk, nothing to wait for
+        """
+        pass
+
+    def close(self):
+        pass
+
+class LogValue():
+    """ A read only stream of a value at `offset` in the open log `file`
+        of a `LogStorage`. A value that is sent to a client gets its own
+        file handle so it can be read while the log is written or compacted.
+    """
+    def __init__(self,file,offset,length):
+        self._file = file
+        self._offset = offset
+        self._length = length
+        self._position = 0
+
+    def __len__(self):
+        return self._length
+
+    def seek(self,position,whence=os.SEEK_SET):
+        if whence == os.SEEK_END:
+            position += self._length
+        elif whence == os.SEEK_CUR:
+            position += self._position
+        self._position = max(0,min(position,self._length))
+
+    def tell(self):
+        return self._position
+
+    def read(self,size=-1):
+        if size < 0 or size > self._length - self._position:
+            size = self._length - self._position
+        self._file.seek(self._offset + self._position)
+        data = self._file.read(size)
+        self._position += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+class LogStorage():
+    """ Stores values in an append-only log file in `path`, only an index
+        with key -> (offset, length, timestamp) is kept in memory in an `EntryTable`.
+
+        Every PUT and DEL appends a record to the log. A record is RECORD,
+        the key, the value and a crc32 of all of it, so a record that was
+        half written when the server died is found and cut off on startup.
+        If `sync` is True `commit` waits until the record has been fsynced,
+        writes that arrive while a fsync is running share the next one.
+
+        Values that have been replaced or deleted are removed by compacting
+        the log in the background when more than `compact_ratio` of it is
+        garbage. The index is written to a hint file after compaction and
+        when the storage is closed, on startup the hint file is read and
+        only the log written after it is scanned.
+    """
+    # type, key length, value length, timestamp
+    RECORD = struct.Struct("!BHQd")
+    CRC = struct.Struct("!I")
+    # magic, generation
+    LOG_HEADER = struct.Struct("!8sQ")
+    # magic, generation of the log, end of the log, garbage in the log
+    HINT_HEADER = struct.Struct("!8sQQQ")
+    # key length, offset, value length, timestamp
+    HINT_ENTRY = struct.Struct("!HQQd")
+    LOG_MAGIC = "MYDHTLOG"
+    HINT_MAGIC = "MYDHTHNT"
+    PUT = 1
+    DEL = 2
+
+    def __init__(self,path,sync=True,compact_ratio=0.5,compact_interval=60):
+        self.path = path
+        self.sync = sync
+        self.compact_ratio = compact_ratio
+        self.compact_interval = compact_interval
+        # Logs smaller than this are never compacted
+        self.compact_min_size = 1024 * 1024
+        self.log_path = os.path.join(path,"data.log")
+        self.hint_path = os.path.join(path,"data.hints")
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # key -> (offset of the value, length of the value, timestamp)
+        self._index = EntryTable()
+        # Bytes in the log that belong to replaced or deleted values
+        self._garbage = 0
+        # Protects the index and the log file
+        self._lock = threading.RLock()
+        # Only one compaction at a time
+        self._compact_lock = threading.Lock()
+        # Group commit, records up to `_synced` have been fsynced
+        self._commit = threading.Condition(threading.Lock())
+        self._written = 0
+        self._synced = 0
+        self._closed = False
+        # End of the log when the hint file was written
+        self._hints_end = 0
+
+        self.load()
+        self._log = open(self.log_path,"ab")
+        self._reader = open(self.log_path,"rb")
+
+        for target in (self.commit_thread,self.compact_thread):
+            worker = threading.Thread(target=target)
+            worker.daemon = True
+            worker.start()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self,key):
+        return key in self._index
+
+    def keys(self):
+        self._lock.acquire()
+        try:
+            return self._index.keys()
+        finally:
+            self._lock.release()
+
+    def get(self,key):
+        """ Returns the value of `key` or None
+        """
+        self._lock.acquire()
+        try:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            offset, length, timestamp, flags = entry
+            self._reader.seek(offset)
+            return self._reader.read(length)
+        finally:
+            self._lock.release()
+
+    def open(self,key):
+        """ Returns the value of `key` as a `LogValue` stream or None
+        """
+        self._lock.acquire()
+        try:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            return LogValue(open(self.log_path,"rb"),entry[0],entry[1])
+        finally:
+            self._lock.release()
+
+    def get_timestamp(self,key):
+        """ Returns the timestamp of `key` or None
+        """
+        self._lock.acquire()
+        try:
+            return self._index.get_timestamp(key)
+        finally:
+            self._lock.release()
+
+    def get_size(self,key):
+        """ Returns the size of the value of `key` or None
+        """
+        self._lock.acquire()
+        try:
+            return self._index.get_size(key)
+        finally:
+            self._lock.release()
+
+    def put(self,key,value,timestamp):
+        """ Append `value` with `timestamp` for `key` to the log and return
+            a sequence number that can be given to `commit`
+            `value` can be a string or a seekable stream.
+        """
+        length = stream_size(value)
+        self._lock.acquire()
+        try:
+            offset = self.write_record(self._log,self.PUT,key,value,length,timestamp)
+            self._log.flush()
+            self.forget(key)
+            self._index.set(key,offset,length,timestamp)
+            return self.written()
+        finally:
+            self._lock.release()
+
+    def delete(self,key):
+        """ Append a delete record for `key` to the log and return a sequence
+            number that can be given to `commit`, None if the key wasn't found.
+        """
+        self._lock.acquire()
+        try:
+            if key not in self._index:
+                return None
+            self.write_record(self._log,self.DEL,key,"",0,0.0)
+            self._log.flush()
+            self.forget(key)
+            self._index.remove(key)
+            # The delete record is also garbage after a compaction
+            self._garbage += self.RECORD.size + len(key) + self.CRC.size
+            return self.written()
+        finally:
+            self._lock.release()
+
+    def forget(self,key):
+        """ Count the record of `key` as garbage
+            Must be called with the lock held.
+        """
+        entry = self._index.get(key)
+        if entry is not None:
+            self._garbage += self.RECORD.size + len(key) + entry[1] + self.CRC.size
+
+    def written(self):
+        """ Returns the sequence number of the last record
+        """
+        self._commit.acquire()
+        self._written += 1
+        written = self._written
+        self._commit.notify_all()
+        self._commit.release()
+        return written
+
+    def commit(self,sequence):
+        """ Wait until the record with `sequence` has been fsynced
+        """
+        if not self.sync or not sequence:
+            return
+        self._commit.acquire()
+        try:
+            while self._synced < sequence and not self._closed:
+                self._commit.wait()
+        finally:
+            self._commit.release()
+
+    def commit_thread(self):
+        """ Fsync the log whenever there are new records, all writers
+            that wait in `commit` are released by the same fsync.
+        """
+        while True:
+            self._commit.acquire()
+            while self._synced >= self._written and not self._closed:
+                self._commit.wait()
+            written = self._written
+            self._commit.release()
+            if self._closed:
+                return
+
+            self._lock.acquire()
+            log = self._log
+            self._lock.release()
+            try:
+                os.fsync(log.fileno())
+            except (OSError, ValueError):
+                # The log has been replaced by a compaction, it is synced
+                pass
+
+            self._commit.acquire()
+            self._synced = max(self._synced,written)
+            self._commit.notify_all()
+            self._commit.release()
+
+    def write_record(self,log,type,key,value,length,timestamp):
+        """ Write a record to `log` and return the offset of the value
+        """
+        header = self.RECORD.pack(type,len(key),length,timestamp)
+        log.write(header)
+        log.write(key)
+        crc = zlib.crc32(header + key)
+        offset = log.tell()
+        if isinstance(value,str):
+            log.write(value)
+            crc = zlib.crc32(value,crc)
+        else:
+            value.seek(0)
+            copied = 0
+            while copied < length:
+                chunk = value.read(min(_chunk,length - copied))
+                if not chunk:
+                    raise IOError("stream ended after %d of %d bytes" % (copied, length))
+                log.write(chunk)
+                crc = zlib.crc32(chunk,crc)
+                copied += len(chunk)
+        log.write(self.CRC.pack(crc & 0xffffffff))
+        return offset
+
+    def read_records(self,log,start):
+        """ Read the records in `log` from `start` and yield
+            (type, key, offset of the value, length, timestamp, end of the record)
+            Stops at the end of the log or at the first broken record.
+        """
+        log.seek(0,os.SEEK_END)
+        size = log.tell()
+        position = start
+        while position + self.RECORD.size <= size:
+            log.seek(position)
+            header = log.read(self.RECORD.size)
+            type, keylength, length, timestamp = self.RECORD.unpack(header)
+            end = position + self.RECORD.size + keylength + length + self.CRC.size
+            if type not in (self.PUT,self.DEL) or end > size:
+                return
+            key = log.read(keylength)
+            crc = zlib.crc32(header + key)
+            copied = 0
+            while copied < length:
+                chunk = log.read(min(_chunk,length - copied))
+                crc = zlib.crc32(chunk,crc)
+                copied += len(chunk)
+            if self.CRC.unpack(log.read(self.CRC.size))[0] != crc & 0xffffffff:
+                return
+            yield type, key, end - self.CRC.size - length, length, timestamp, end
+            position = end
+
+    def apply_records(self,log,start,index):
+        """ Apply the records in `log` from `start` to `index`
+            and return (end of the last record, garbage).
+        """
+        end = start
+        garbage = 0
+        for type, key, offset, length, timestamp, end in self.read_records(log,start):
+            entry = index.remove(key)
+            if entry is not None:
+                garbage += self.RECORD.size + len(key) + entry[1] + self.CRC.size
+            if type == self.PUT:
+                index.set(key,offset,length,timestamp)
+            else:
+                garbage += self.RECORD.size + len(key) + self.CRC.size
+        return end, garbage
+
+    def load(self):
+        """ Build the index from the hint file and the log
+            A broken record at the end of the log is cut off.
+        """
+        if not os.path.exists(self.log_path):
+            self.generation = int(time.time() * 1000)
+            with open(self.log_path,"wb") as log:
+                log.write(self.LOG_HEADER.pack(self.LOG_MAGIC,self.generation))
+                log.flush()
+                os.fsync(log.fileno())
+            sync_directory(self.log_path)
+            return
+
+        started = time.time()
+        with open(self.log_path,"r+b") as log:
+            magic, self.generation = self.LOG_HEADER.unpack(log.read(self.LOG_HEADER.size))
+            if magic != self.LOG_MAGIC:
+                raise IOError("%s is not a MyDHT log" % self.log_path)
+            start = self.read_hints()
+            if start is None:
+                start = self.LOG_HEADER.size
+                self._index = EntryTable()
+                self._garbage = 0
+            end, garbage = self.apply_records(log,start,self._index)
+            self._garbage += garbage
+            log.seek(0,os.SEEK_END)
+            if log.tell() > end:
+                logging.warning("Cutting off %d bytes of broken records at the end of %s",
+                                log.tell() - end, self.log_path)
+                log.truncate(end)
+        logging.info("Loaded %d keys from %s in %.2f seconds, the log was scanned from offset %d",
+                     len(self._index), self.log_path, time.time() - started, start)
+
+    def read_hints(self):
+        """ Read the index from the hint file and return the end of
+            the log it covers, None if there is no usable hint file.
+        """
+        if not os.path.exists(self.hint_path):
+            return None
+        with open(self.hint_path,"rb") as hints:
+            data = hints.read()
+        if len(data) < self.HINT_HEADER.size:
+            return None
+        magic, generation, end, garbage = self.HINT_HEADER.unpack_from(data)
+        if magic != self.HINT_MAGIC or generation != self.generation or end > os.path.getsize(self.log_path):
+            logging.warning("Ignoring hint file %s from another log", self.hint_path)
+            return None
+        index = EntryTable()
+        position = self.HINT_HEADER.size
+        while position < len(data):
+            keylength, offset, length, timestamp = self.HINT_ENTRY.unpack_from(data,position)
+            position += self.HINT_ENTRY.size
+            index.set(data[position:position+keylength],offset,length,timestamp)
+            position += keylength
+        self._index = index
+        self._garbage = garbage
+        return end
+
+    def write_hints(self):
+        """ Write the index to the hint file
+        """
+        self._lock.acquire()
+        try:
+            self._log.flush()
+            end = self._log.tell()
+            index = self._index.items()
+            header = self.HINT_HEADER.pack(self.HINT_MAGIC,self.generation,end,self._garbage)
+        finally:
+            self._lock.release()
+
+        temporary = self.hint_path + ".tmp"
+        with open(temporary,"wb") as hints:
+            hints.write(header)
+            for key, (offset, length, timestamp, flags) in index:
+                hints.write(self.HINT_ENTRY.pack(len(key),offset,length,timestamp))
+                hints.write(key)
+            hints.flush()
+            os.fsync(hints.fileno())
+        os.rename(temporary,self.hint_path)
+        sync_directory(self.hint_path)
+        self._hints_end = end
+
+    def needs_compaction(self):
+        """ Returns True if enough of the log is garbage
+        """
+        size = self._log.tell()
+        return size > self.compact_min_size and self._garbage > size * self.compact_ratio
+
+    def compact_thread(self):
+        """ Compact the log when needed, the hint file is
+            also rewritten when the log has grown
+        """
+        while not self._closed:
+            time.sleep(self.compact_interval)
+            if self._closed:
+                return
+            try:
+                if self.needs_compaction():
+                    self.compact()
+                elif self._log.tell() - self._hints_end > 64 * 1024 * 1024:
+                    self.write_hints()
+            except (IOError, OSError), e:
+                logging.error("Compaction of %s failed: %s", self.log_path, e)
+
+    def compact(self):
+        """ Write all live values to a new log and replace the old log
+            with it. The live values are copied without holding the lock,
+            records written in the meantime are copied at the end.
+        """
+        self._compact_lock.acquire()
+        try:
+            self._lock.acquire()
+            self._log.flush()
+            start = self._log.tell()
+            snapshot = self._index.items()
+            self._lock.release()
+
+            before = start
+            generation = max(int(time.time() * 1000),self.generation + 1)
+            temporary = self.log_path + ".compact"
+            index = EntryTable()
+            reader = open(self.log_path,"rb")
+            out = open(temporary,"wb")
+            try:
+                out.write(self.LOG_HEADER.pack(self.LOG_MAGIC,generation))
+                snapshot.sort(key=lambda item: item[1][0])
+                for key, (offset, length, timestamp, flags) in snapshot:
+                    index.set(key,self.copy_record(reader,out,self.PUT,key,offset,length,timestamp),length,timestamp)
+
+                self._lock.acquire()
+                try:
+                    # Copy the records that were written during the copy
+                    self._log.flush()
+                    for type, key, offset, length, timestamp, end in self.read_records(reader,start):
+                        index.remove(key)
+                        if type == self.PUT:
+                            index.set(key,self.copy_record(reader,out,type,key,offset,length,timestamp),length,timestamp)
+                    out.flush()
+                    os.fsync(out.fileno())
+                    os.rename(temporary,self.log_path)
+                    sync_directory(self.log_path)
+                    self._log.close()
+                    self._reader.close()
+                    self._log = open(self.log_path,"ab")
+                    self._reader = open(self.log_path,"rb")
+                    self._index = index
+                    self._garbage = 0
+                    self.generation = generation
+                    after = self._log.tell()
+                finally:
+                    self._lock.release()
+            finally:
+                reader.close()
+                out.close()
+
+            # Everything written before the swap has been fsynced
+            self._commit.acquire()
+            self._synced = self._written
+            self._commit.notify_all()
+            self._commit.release()
+
+            self.write_hints()
+            logging.info("Compacted %s from %d to %d bytes", self.log_path, before, after)
+        finally:
+            self._compact_lock.release()
+
+    def copy_record(self,reader,out,type,key,offset,length,timestamp):
+        """ Copy a value from `reader` to a new record in `out`
+            and return the offset of the value in `out`
+        """
+        return self.write_record(out,type,key,LogValue(reader,offset,length),length,timestamp)
+
+    def close(self):
+        """ Fsync the log, write the hint file and close the log
+        """
+        self._lock.acquire()
+        try:
+            if self._closed:
+                return
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self.write_hints()
+            self._closed = True
+            self._log.close()
+            self._reader.close()
+        finally:
+            self._lock.release()
+        self._commit.acquire()
+        self._commit.notify_all()
+        self._commit.release()
+
+class TieredStorage():
+    """ Keeps the most recently used values in memory and all values in
+        `disk`, a `LogStorage`. At most `memory_limit` bytes of values are
+        kept in memory, the least recently used values are evicted when
+        the limit is reached. Every write goes to `disk` before it is
+        answered, so an evicted value is never lost.
+        Values larger than 1/8 of the limit are never kept in memory.
+
+        `hits`, `misses` and `evictions` count how the memory is used.
+    """
+    def __init__(self,disk,memory_limit):
+        self.disk = disk
+        self.memory_limit = memory_limit
+        # key -> value, the least recently used first
+        self._cache = collections.OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.disk)
+
+    def __contains__(self,key):
+        return key in self.disk
+
+    def keys(self):
+        return self.disk.keys()
+
+    def get_timestamp(self,key):
+        return self.disk.get_timestamp(key)
+
+    def get_size(self,key):
+        return self.disk.get_size(key)
+
+    def get(self,key):
+        """ Returns the value of `key` from memory if it is there,
+            or else from disk, None if the key is missing.
+        """
+        self._lock.acquire()
+        value = self._cache.pop(key,None)
+        if value is not None:
+            # Most recently used
+            self._cache[key] = value
+            self.hits += 1
+            self._lock.release()
+            return value
+        self.misses += 1
+        self._lock.release()
+
+        timestamp = self.disk.get_timestamp(key)
+        value = self.disk.get(key)
+        if value is not None:
+            self._lock.acquire()
+            # Don't cache the value if it was replaced while it was read
+            if self.disk.get_timestamp(key) == timestamp:
+                self.cache(key,value)
+            self._lock.release()
+        return value
+
+    def open(self,key):
+        """ Returns the value of `key` from memory or as a stream from disk
+        """
+        self._lock.acquire()
+        value = self._cache.get(key)
+        self._lock.release()
+        if value is not None:
+            return value
+        return self.disk.open(key)
+
+    def cache(self,key,value):
+        """ Keep `value` in memory and evict the least recently used
+            values until the values fit in the limit.
+            Must be called with the lock held.
+        """
+        self.uncache(key)
+        if len(value) > self.memory_limit / 8:
+            return
+        self._cache[key] = value
+        self._cached_bytes += len(value)
+        while self._cached_bytes > self.memory_limit:
+            evicted_key, evicted = self._cache.popitem(False)
+            self._cached_bytes -= len(evicted)
+            self.evictions += 1
+
+    def uncache(self,key):
+        """ Remove `key` from memory
+            Must be called with the lock held.
+        """
+        value = self._cache.pop(key,None)
+        if value is not None:
+            self._cached_bytes -= len(value)
+
+    def put(self,key,value,timestamp):
+        """ Write `value` to disk and keep it in memory if it is a string
+        """
+        sequence = self.disk.put(key,value,timestamp)
+        self._lock.acquire()
+        if isinstance(value,str):
+            self.cache(key,value)
+        else:
+            self.uncache(key)
+        self._lock.release()
+        return sequence
+
+    def delete(self,key):
+        sequence = self.disk.delete(key)
+        self._lock.acquire()
+        self.uncache(key)
+        self._lock.release()
+        return sequence
+
+    def commit(self,sequence):
+        self.disk.commit(sequence)
+
+    def close(self):
+        self.disk.close()
+
+    def get_stats(self):
+        """ Returns a list of (name, value) of the memory counters
+        """
+        return [("memory used",self._cached_bytes),("memory limit",self.memory_limit),
+                ("values in memory",len(self._cache)),("hits",self.hits),
+                ("misses",self.misses),("evictions",self.evictions)]
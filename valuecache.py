@@ -0,0 +1,63 @@
+import collections
+import threading
+
+__author__ = 'Johan'
+
+class ValueCache():
+    """ The values and timestamps of the most recently read keys of a
+        client, at most `max_bytes` bytes of values are kept and the least
+        recently used are evicted when the limit is reached.
+    """
+    def __init__(self,max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # key -> (value, timestamp), the least recently used first
+        self._cache = collections.OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self,key):
+        """ Returns (value, timestamp) of `key` or (None, 0.0)
+        """
+        self._lock.acquire()
+        try:
+            entry = self._cache.pop(key,None)
+            if entry is None:
+                return None, 0.0
+            # Most recently used
+            self._cache[key] = entry
+            return entry
+        finally:
+            self._lock.release()
+
+    def put(self,key,value,timestamp):
+        """ Keep `value` with `timestamp` and evict the least recently used
+            values until the values fit in the limit. Only string values
+            are kept.
+        """
+        self._lock.acquire()
+        try:
+            self._remove(key)
+            if not isinstance(value,str) or len(value) > self.max_bytes:
+                return
+            self._cache[key] = (value,timestamp)
+            self._cached_bytes += len(value)
+            while self._cached_bytes > self.max_bytes:
+                evicted_key, (evicted, evicted_timestamp) = self._cache.popitem(False)
+                self._cached_bytes -= len(evicted)
+        finally:
+            self._lock.release()
+
+    def remove(self,key):
+        self._lock.acquire()
+        try:
+            self._remove(key)
+        finally:
+            self._lock.release()
+
+    def _remove(self,key):
+        entry = self._cache.pop(key,None)
+        if entry is not None:
+            self._cached_bytes -= len(entry[0])
@@ -0,0 +1,94 @@
+import socket
+import sys
+from merkletree import MerkleTree
+
+__author__ = 'Johan'
+
+# Python 2 doesn't have the constant, 15 is the value on Linux
+SO_REUSEPORT = getattr(socket,"SO_REUSEPORT",sys.platform.startswith("linux") and 15 or None)
+
+def reuseport_socket():
+    """ Returns a TCP socket that more processes can bind to the same port,
+        the kernel spreads the new connections between them.
+    """
+    if SO_REUSEPORT is None:
+        raise RuntimeError("SO_REUSEPORT is not supported on " + sys.platform)
+    sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET,SO_REUSEPORT,1)
+    return sock
+
+class WorkerAddress():
+    """ The unix socket where a worker process of a node
+        takes commands from the other processes of the node.
+        It can be used instead of a `Server` with `MyDHTClient`.
+    """
+    family = socket.AF_UNIX
+
+    def __init__(self,path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def bindaddress(self):
+        return self.path
+
+class Partitioning():
+    """ Splits the keys of a node between `workers` processes.
+        A key belongs to the worker of the leaf it has in the hash
+        trees (`MerkleTree`), every worker has a range of leaves.
+        So a subtree that is inside one range is a subtree of the
+        tree of that worker and the other workers don't have to be
+        asked when the trees of two nodes are compared.
+    """
+    def __init__(self,workers):
+        self.workers = workers
+        # Only the shape of the tree is used
+        self.tree = MerkleTree()
+
+    def worker_for_leaf(self,leaf):
+        return (leaf - self.tree.first_leaf) * self.workers / self.tree.leaves
+
+    def worker_for(self,key):
+        """ Returns the worker that `key` belongs to
+        """
+        return self.worker_for_leaf(self.tree.leaf(key))
+
+    def worker_for_node(self,node):
+        """ Returns the worker that has all leaves below `node`,
+            None if they are split between more workers
+        """
+        first, last = self.tree.leaf_range(node)
+        worker = self.worker_for_leaf(first)
+        if worker != self.worker_for_leaf(last):
+            return None
+        return worker
+
+    def roots(self,worker):
+        """ Returns the largest subtrees that only have leaves of `worker`
+        """
+        roots = []
+        nodes = [0]
+        while nodes:
+            node = nodes.pop(0)
+            owner = self.worker_for_node(node)
+            if owner == worker:
+                roots.append(node)
+            elif owner is None:
+                nodes.extend(self.tree.children(node))
+        return roots
+
+    def split(self,nodes):
+        """ Split `nodes` into subtrees that only have leaves of one worker
+            Returns a dictionary with worker -> list of subtrees
+        """
+        subtrees = {}
+        nodes = list(nodes)
+        while nodes:
+            node = nodes.pop(0)
+            owner = self.worker_for_node(node)
+            if owner is None:
+                nodes.extend(self.tree.children(node))
+            else:
+                subtrees.setdefault(owner,[]).append(node)
+        return subtrees